@@ -0,0 +1,97 @@
+"""
+Benchmark the AST calculator of the python tool against the eval based one it replaced.
+
+Before, use_calculator scanned the expression for allowed characters and dangerous patterns, then ran eval
+under a signal.alarm timeout: a signal handler installed and a full compile on every call, main thread only.
+Now it walks the AST with a whitelist (see nanochat/engine.py), bounded by expression and integer size, and
+caches its results. The expressions are the tool calls of the GSM8K and SpellingBee training data.
+
+python -m dev.bench_calculator
+python -m dev.bench_calculator --spellingbee-size 20000 --repeats 5
+"""
+import argparse
+import re
+import signal
+import time
+import warnings
+from contextlib import contextmanager
+
+from nanochat.engine import use_calculator
+from tasks.gsm8k import GSM8K
+from tasks.spellingbee import SpellingBee
+
+parser = argparse.ArgumentParser(description="Benchmark the calculator tool")
+parser.add_argument("--spellingbee-size", type=int, default=10000, help="SpellingBee examples to take expressions from")
+parser.add_argument("--repeats", type=int, default=3, help="passes over all expressions (RL rollouts repeat them)")
+args = parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# The previous calculator, for reference
+
+@contextmanager
+def timeout(duration, formula):
+    def timeout_handler(signum, frame):
+        raise Exception(f"'{formula}': timed out after {duration} seconds")
+
+    signal.signal(signal.SIGALRM, timeout_handler)
+    signal.alarm(duration)
+    yield
+    signal.alarm(0)
+
+def eval_with_timeout(formula, max_time=3):
+    try:
+        with timeout(max_time, formula):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", SyntaxWarning)
+                return eval(formula, {"__builtins__": {}}, {})
+    except Exception as e:
+        signal.alarm(0)
+        return None
+
+def eval_calculator(expr):
+    expr = expr.replace(",", "")
+    if all([x in "0123456789*+-/.() " for x in expr]):
+        if "**" in expr:
+            return None
+        return eval_with_timeout(expr)
+    allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'\"()._ "
+    if not all([x in allowed_chars for x in expr]):
+        return None
+    dangerous_patterns = ['__', 'import', 'exec', 'eval', 'compile', 'open', 'file',
+                         'input', 'raw_input', 'globals', 'locals', 'vars', 'dir',
+                         'getattr', 'setattr', 'delattr', 'hasattr']
+    if any(pattern in expr.lower() for pattern in dangerous_patterns):
+        return None
+    if '.count(' not in expr:
+        return None
+    return eval_with_timeout(expr)
+
+# -----------------------------------------------------------------------------
+
+def tool_calls(task):
+    for i in range(task.num_examples()):
+        for part in task.get_example(i)["messages"][-1]["content"]:
+            if isinstance(part, dict) and part["type"] == "python":
+                yield part["text"]
+
+exprs = {
+    "gsm8k": list(tool_calls(GSM8K(subset="main", split="train"))),
+    "spellingbee": list(tool_calls(SpellingBee(size=args.spellingbee_size, split="train"))),
+}
+
+def bench(fn, calls):
+    t0 = time.perf_counter()
+    for _ in range(args.repeats):
+        for expr in calls:
+            fn(expr)
+    return (time.perf_counter() - t0) / (args.repeats * len(calls)) * 1e6
+
+for name, calls in exprs.items():
+    use_calculator.cache_clear()
+    uncached = bench(use_calculator.__wrapped__, calls)
+    cached = bench(use_calculator, calls)
+    mismatches = sum(use_calculator(expr) != eval_calculator(expr) for expr in calls)
+    print(f"{name}: {len(calls)} expressions ({len(set(calls))} unique), {mismatches} with a different result")
+    print(f"  {'eval + signal.alarm':<24s} {bench(eval_calculator, calls):8.2f} us/call")
+    print(f"  {'AST':<24s} {uncached:8.2f} us/call")
+    print(f"  {'AST, cached':<24s} {cached:8.2f} us/call")
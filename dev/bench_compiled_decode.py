@@ -0,0 +1,54 @@
+"""
+Benchmark the compiled decode step (Engine(compile_decode=True)) against the eager one.
+
+Eager, every decode step runs GPT.forward op by op from Python: the loop over the blocks, the value embedding
+lookups, rotary gathers and (SDPA fallback) a host sync to read the rows' positions. Compiled, the step is one
+graph over a fixed capacity KV cache (CUDA graphs on GPU), for small models that overhead is most of the step.
+
+python -m dev.bench_compiled_decode
+python -m dev.bench_compiled_decode --n-layer 4 --n-embd 256 --num-samples 8
+"""
+import argparse
+import time
+from contextlib import nullcontext
+
+import torch
+
+from nanochat.engine import Engine
+from nanochat.gpt import GPT, GPTConfig
+from nanochat.tokenizer import get_tokenizer
+
+parser = argparse.ArgumentParser(description="Benchmark the compiled decode step")
+parser.add_argument("--n-layer", type=int, default=2, help="layers of the randomly initialized model")
+parser.add_argument("--n-embd", type=int, default=128, help="model width")
+parser.add_argument("--sequence-len", type=int, default=256, help="KV cache capacity")
+parser.add_argument("--num-samples", type=int, default=4, help="rows decoded together")
+parser.add_argument("--max-tokens", type=int, default=128, help="tokens per sample")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+device = torch.device(args.device)
+tokenizer = get_tokenizer()
+config = GPTConfig(sequence_len=args.sequence_len, vocab_size=tokenizer.get_vocab_size(), n_layer=args.n_layer,
+                   n_head=max(args.n_embd // 64, 1), n_kv_head=max(args.n_embd // 64, 1), n_embd=args.n_embd)
+with torch.device("meta"):
+    model = GPT(config)
+model.to_empty(device=device)
+model.init_weights()
+model.eval()
+autocast_ctx = torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16) if device.type == "cuda" else nullcontext()
+prompt = tokenizer.encode("The chemical formula of water is", prepend=tokenizer.get_bos_token_id())
+
+print(f"device={device} n_layer={args.n_layer} n_embd={args.n_embd} num_samples={args.num_samples}")
+for label, engine in [("eager", Engine(model, tokenizer)), ("compiled", Engine(model, tokenizer, compile_decode=True))]:
+    with autocast_ctx:
+        if engine.compiled_decode is not None:
+            t0 = time.perf_counter()
+            engine.warmup(num_samples=args.num_samples)
+            print(f"{'warmup (compile)':<10s} {time.perf_counter() - t0:8.1f} s")
+        kwargs = dict(num_samples=args.num_samples, max_tokens=args.max_tokens, temperature=1.0)
+        engine.generate_batch(prompt, **kwargs) # warm up the allocator and the kernels
+        engine.num_steps, engine.step_time, engine.host_time = 0, 0.0, 0.0
+        engine.generate_batch(prompt, **kwargs)
+    step_ms, host_ms = engine.step_stats()
+    print(f"{label:<10s} {step_ms:8.3f} ms/step ({host_ms:.3f} ms host)")
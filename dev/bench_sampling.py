@@ -0,0 +1,112 @@
+"""
+Benchmark the batched sampler of the BatchScheduler against the per-request one it replaced.
+
+Before, every decode step sampled each request's rows separately with sample_next_token (one scalar
+temperature/top_k per call). Now the whole batch goes through token_probs + sample_from_probs once,
+every row with its own settings held in per-row tensors, including top-p, min-p and the penalties.
+
+python -m dev.bench_sampling
+python -m dev.bench_sampling --batch-size 64 --vocab-size 65536 --num-requests 16
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from nanochat.engine import token_probs, sample_from_probs, _num_candidates, counter_uniforms, rng_keys, SAMPLING_DEFAULTS
+
+parser = argparse.ArgumentParser(description="Benchmark the batched per-row sampler")
+parser.add_argument("--batch-size", type=int, default=32, help="rows in the decode batch")
+parser.add_argument("--vocab-size", type=int, default=65536, help="vocab size")
+parser.add_argument("--num-requests", type=int, default=8, help="requests the rows belong to (each with its own settings)")
+parser.add_argument("--steps", type=int, default=50, help="timed steps")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+device = torch.device(args.device)
+B, V, R = args.batch_size, args.vocab_size, args.num_requests
+logits = torch.randn(B, V, device=device) * 3
+groups = [list(range(r, B, R)) for r in range(R)] # rows of each request
+rngs = [torch.Generator(device=device).manual_seed(r) for r in range(R)]
+temperatures = [0.6 + 0.1 * r for r in range(R)]
+top_ks = [50 if r % 2 == 0 else None for r in range(R)]
+
+@torch.inference_mode()
+def sample_next_token(logits, rng, temperature=1.0, top_k=None):
+    """The old per-request sampler, kept here as the baseline: one token per row of logits (B, vocab_size). Returns (B, 1)."""
+    assert temperature >= 0.0, "temperature must be non-negative"
+    if temperature == 0.0:
+        return torch.argmax(logits, dim=-1, keepdim=True)
+    if top_k is not None and top_k > 0:
+        k = min(top_k, logits.size(-1))
+        vals, idx = torch.topk(logits, k, dim=-1)
+        vals = vals / temperature
+        probs = F.softmax(vals, dim=-1)
+        choice = torch.multinomial(probs, num_samples=1, generator=rng)
+        return idx.gather(1, choice)
+    else:
+        logits = logits / temperature
+        probs = F.softmax(logits, dim=-1)
+        return torch.multinomial(probs, num_samples=1, generator=rng)
+
+def sync():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def bench(fn):
+    for _ in range(5): # warm up
+        fn()
+    sync()
+    t0 = time.perf_counter()
+    for _ in range(args.steps):
+        fn()
+    sync()
+    return (time.perf_counter() - t0) / args.steps * 1e3
+
+def per_request():
+    # the old path: one sample_next_token call per request, then .tolist()
+    tokens = {}
+    for r, idx in enumerate(groups):
+        next_ids = sample_next_token(logits[idx], rngs[r], temperatures[r], top_ks[r])
+        tokens.update(zip(idx, next_ids[:, 0].tolist()))
+    return tokens
+
+def per_row_tensors(**extra):
+    settings = {name: torch.full((B,), float(value), device=device) for name, value in SAMPLING_DEFAULTS.items()}
+    for r, idx in enumerate(groups):
+        settings["temperature"][idx] = temperatures[r]
+        settings["top_k"][idx] = float(top_ks[r] or 0)
+    for name, value in extra.items():
+        settings[name][:] = value
+    return settings
+
+keys = rng_keys(42, torch.arange(B, device=device))
+steps = torch.zeros(B, dtype=torch.long, device=device)
+counts = torch.zeros(B, V, device=device)
+counts[:, :1000] = 1
+one_top_p = per_row_tensors()
+one_top_p["top_p"][1] = 0.9 # a single request (no top-k) with top-p, the rest temperature + top-k
+setups = {
+    "temperature + top-k": (per_row_tensors(), ["temperature", "top_k"]),
+    "+ top-p on one row": (one_top_p, ["temperature", "top_k", "top_p"]),
+    "+ top-p + min-p": (per_row_tensors(top_p=0.9, min_p=0.05), ["temperature", "top_k", "top_p", "min_p"]),
+    "+ penalties": (per_row_tensors(top_p=0.9, min_p=0.05, repetition_penalty=1.1, frequency_penalty=0.2), list(SAMPLING_DEFAULTS)),
+}
+
+def batched(settings, names):
+    top_k_list = settings["top_k"].tolist()
+    def fn():
+        u = counter_uniforms(keys, steps) # per-row counter-based streams, as in BatchScheduler._uniforms
+        kwargs = {name: settings[name] for name in names}
+        # the per-row sort widths from host copies of the settings, as in BatchScheduler._sampling_args
+        kwargs["num_candidates"] = [_num_candidates(k, p, V) for k, p in zip(top_k_list, settings["top_p"].tolist())]
+        if "repetition_penalty" in names:
+            kwargs["counts"] = counts
+        return sample_from_probs(token_probs(logits, **kwargs), u).tolist()
+    return fn
+
+print(f"device={device} batch_size={B} vocab_size={V} num_requests={R}")
+print(f"{'per request sample_next_token (temperature + top-k)':<55s} {bench(per_request):8.3f} ms/step")
+for label, (settings, names) in setups.items():
+    print(f"{'batched token_probs, ' + label:<55s} {bench(batched(settings, names)):8.3f} ms/step")
@@ -13,73 +13,164 @@ The whole thing is made as efficient as possible.
 
 import torch
 import torch.nn.functional as F
-import signal
-import warnings
-from contextlib import contextmanager
+import ast
+import heapq
+import time
+import operator
+import functools
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from nanochat.execution import execute_code
+from nanochat.flash_attention import Cascade
+from nanochat.grammar import compile_grammar
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
 from contextlib import nullcontext
 
 # -----------------------------------------------------------------------------
 # Calculator tool helpers
-@contextmanager
-def timeout(duration, formula):
-    def timeout_handler(signum, frame):
-        raise Exception(f"'{formula}': timed out after {duration} seconds")
+# The calculator walks the AST of the expression itself and only allows number and string literals, arithmetic on
+# numbers (no power) and str.count. Its work is bounded by the size of the expression and of the integers in it,
+# not by a wall-clock alarm, so there are no signals involved and it can run on any thread.
+CALCULATOR_MAX_LENGTH = 1000 # characters
+CALCULATOR_MAX_NODES = 256 # AST nodes
+CALCULATOR_MAX_INT_BITS = 1024 # an integer that grows larger gives no result
+_ARITHMETIC = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv}
+_UNARY = {ast.UAdd: operator.pos, ast.USub: operator.neg}
 
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(duration)
-    yield
-    signal.alarm(0)
+class _NotAllowed(Exception):
+    pass
 
-def eval_with_timeout(formula, max_time=3):
-    try:
-        with timeout(max_time, formula):
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", SyntaxWarning)
-                return eval(formula, {"__builtins__": {}}, {})
-    except Exception as e:
-        signal.alarm(0)
-        # print(f"Warning: Failed to eval {formula}, exception: {e}") # it's ok ignore wrong calculator usage
-        return None
+def _calculate(node, types=(int, float, str)):
+    """Value of an expression node, which must be one of types."""
+    if isinstance(node, ast.Constant):
+        value = node.value
+    elif isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC:
+        value = _ARITHMETIC[type(node.op)](_calculate(node.left, (int, float)), _calculate(node.right, (int, float)))
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+        value = _UNARY[type(node.op)](_calculate(node.operand, (int, float)))
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "count"
+          and len(node.args) == 1 and not node.keywords):
+        value = _calculate(node.func.value, (str,)).count(_calculate(node.args[0], (str,)))
+    else:
+        raise _NotAllowed(type(node).__name__)
+    if type(value) not in types or (type(value) is int and value.bit_length() > CALCULATOR_MAX_INT_BITS):
+        raise _NotAllowed(type(value).__name__)
+    return value
 
+@functools.lru_cache(maxsize=4096)
 def use_calculator(expr):
     """
-    Evaluate a Python expression safely.
-    Supports both math expressions and string operations like .count()
+    Evaluate a calculator expression safely: math on numbers (+ - * / // and parentheses, no power)
+    or string operations like .count(), e.g. "12/60" or "'strawberry'.count('r')". None if it is anything else.
+    Results are cached, RL rollouts send the same expressions over and over.
     """
     # Remove commas from numbers
-    expr = expr.replace(",", "")
-
-    # Check if it's a pure math expression (old behavior)
-    if all([x in "0123456789*+-/.() " for x in expr]):
-        if "**" in expr:  # disallow power operator
+    expr = expr.replace(",", "").strip()
+    if len(expr) > CALCULATOR_MAX_LENGTH or "\\" in expr: # no escape sequences either
+        return None
+    try:
+        tree = ast.parse(expr, mode="eval")
+        if sum(1 for _ in ast.walk(tree)) > CALCULATOR_MAX_NODES:
             return None
-        return eval_with_timeout(expr)
-
-    # Check if it's a string operation we support
-    # Allow: strings (single/double quotes), .count(), letters, numbers, spaces, parens
-    allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'\"()._ "
-    if not all([x in allowed_chars for x in expr]):
+        return _calculate(tree.body)
+    except (_NotAllowed, SyntaxError, ValueError, ArithmeticError, RecursionError, MemoryError):
         return None
 
-    # Disallow dangerous patterns
-    dangerous_patterns = ['__', 'import', 'exec', 'eval', 'compile', 'open', 'file',
-                         'input', 'raw_input', 'globals', 'locals', 'vars', 'dir',
-                         'getattr', 'setattr', 'delattr', 'hasattr']
-    expr_lower = expr.lower()
-    if any(pattern in expr_lower for pattern in dangerous_patterns):
-        return None
+def calculator_tool(expr):
+    """The calculator as a ToolExecutor backend: the result of use_calculator as text, None if there is none."""
+    result = use_calculator(expr)
+    return str(result) if result is not None else None
 
-    # Only allow .count() method for now (can expand later)
-    if '.count(' not in expr:
-        return None
+def python_tool(code, timeout=5.0):
+    """Run code in the nanochat.execution sandbox (a process of its own) as a ToolExecutor backend: what it printed, None if it failed."""
+    result = execute_code(code, timeout=timeout)
+    return result.stdout.strip() if result.success else None
+
+class ToolExecutor:
+    """
+    Runs the tool calls of a BatchScheduler on a pool of threads, off the decode loop: a row waiting on a call is
+    parked while the other rows keep decoding, and the result is forced into it once the call is done.
+    backend(code) returns the result text or None (no output forced), e.g. calculator_tool or python_tool.
+    A call that is not done after timeout seconds is given up on, as if it had returned None.
+    """
 
-    # Evaluate with timeout
-    return eval_with_timeout(expr)
+    def __init__(self, backend=calculator_tool, max_workers=4, timeout=5.0):
+        self.backend = backend
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def submit(self, code):
+        """Start a call, returns a concurrent.futures.Future of its result."""
+        return self.pool.submit(self.backend, code)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
 # -----------------------------------------------------------------------------
+class KVPool:
+    """
+    KV cache storage recycled across generate() calls, owned by the Engine: rollout and eval loops build a
+    scheduler per call with nearly the same shapes, and would otherwise allocate and zero fresh caches every time.
+    Storage is handed out by capacity class, the caches asking for a capacity shape rounded up from their own
+    (rows to a power of two, positions to a multiple of 256, paged blocks to a multiple of 16) and getting a view
+    of their exact shape. It is zeroed once when first allocated and not again when recycled: caches track their
+    valid length, and the stale KV past it is finite, so masked attention weighs it 0 (fresh torch.empty memory
+    could hold NaNs, which a 0 weight does not cancel). At most max_bytes of returned storage is kept
+    (None: no limit), the least recently returned dropped first.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.free = [] # returned storage, least recently returned first
+        self.lent = {} # id of a handed out view -> its storage (under inference_mode views have no ._base)
+        self.num_allocs = 0 # fresh allocations
+        self.num_reuses = 0 # and recycled ones
+
+    @staticmethod
+    def rows_class(n):
+        return 1 << (n - 1).bit_length()
+
+    @staticmethod
+    def positions_class(n):
+        return -(-n // 256) * 256
+
+    @staticmethod
+    def blocks_class(n):
+        return -(-n // 16) * 16
+
+    @property
+    def num_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self.free)
+
+    def alloc(self, shape, dtype, device, capacity):
+        """A tensor of shape (the leading part of a recycled or new one of shape capacity), stale or zero filled."""
+        device = torch.device(device)
+        for i in reversed(range(len(self.free))):
+            t = self.free[i]
+            if t.shape == capacity and t.dtype == dtype and t.device == device:
+                storage = self.free.pop(i)
+                self.num_reuses += 1
+                break
+        else:
+            storage = torch.zeros(capacity, dtype=dtype, device=device)
+            self.num_allocs += 1
+        view = storage[tuple(slice(0, n) for n in shape)]
+        self.lent[id(view)] = storage
+        return view
+
+    def release(self, *tensors):
+        """Give tensors handed out by alloc back to the pool."""
+        for t in tensors:
+            if t is not None:
+                self.free.append(self.lent.pop(id(t)))
+        while self.max_bytes is not None and self.free and self.num_bytes > self.max_bytes:
+            self.free.pop(0)
+
+    def clear(self):
+        self.free.clear()
+
+
 class KVCache:
     """
     KV Cache designed for Flash Attention 3's flash_attn_with_kvcache API.
@@ -87,36 +178,118 @@ class KVCache:
     Key differences from FA2-style cache:
     - Tensors are (B, T, H, D) not (B, H, T, D)
     - FA3 updates the cache in-place during flash_attn_with_kvcache
-    - Position tracked per batch element via cache_seqlens tensor
+    - Position tracked per batch element via cache_seqlens tensor, mirrored on the host in host_seqlens
+      so positions can be read (get_pos, the SDPA fallback) without a device -> host sync
+    - With quantize=True, K/V are stored as int8 with one scale per token and head (k_scale, v_scale
+      of shape (n_layers, B, T, H) in dtype), about 2x smaller than bf16 and 4x smaller than fp32.
+      flash_attn_with_kvcache quantizes on insert and dequantizes inside the attention call.
+    - With window_sizes (the model's per-layer (left, right) windows), a sliding-window layer whose window
+      is shorter than seq_len only keeps a ring buffer of its last window + ring_margin positions
+      (k_ring, v_ring of shape (n_ring_layers, B, ring_size, H, D)), position p living in slot p % ring_size.
+      ring_margin is room for positions that may be rolled back (speculative drafts).
+      Full layers stay in k_cache, v_cache (n_full_layers, B, T, H, D).
+    - With a pool (KVPool) the storage comes from, and goes back to (release), recycled storage.
+    - With attention_sinks > 0 a row never runs out of room (StreamingLLM): make_room evicts the positions right after
+      its first attention_sinks ones (the sinks, which soak up attention whatever they hold) and moves the later ones
+      down, their keys re-rotated to the new positions by shift_keys(k, shift) (see GPT.shift_rotary). A row then
+      keeps its sinks and a recent window of seq_len - attention_sinks positions at most, for as long as it goes.
     """
 
-    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype):
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype, quantize=False,
+                 window_sizes=None, ring_margin=0, pool=None, attention_sinks=0, shift_keys=None):
         self.batch_size = batch_size
         self.max_seq_len = seq_len
         self.n_layers = num_layers
         self.n_heads = num_heads
         self.head_dim = head_dim
+        # Decide which layers get a ring buffer, and where each layer lives: (is_ring, index in its stack)
+        windows = [w[0] for w in window_sizes] if window_sizes is not None else [-1] * num_layers
+        is_ring = [0 <= w and w + ring_margin < seq_len for w in windows]
+        self.ring_size = max([w + ring_margin for w, r in zip(windows, is_ring) if r], default=0)
+        self.layer_slots = [(r, sum(1 for r2 in is_ring[:i] if r2 == r)) for i, r in enumerate(is_ring)]
+        num_ring = sum(is_ring)
+        # keys are moved along the positions of the full cache, not the ring slots or the int8 scales
+        assert attention_sinks == 0 or (num_ring == 0 and not quantize and shift_keys is not None and attention_sinks < seq_len)
+        self.attention_sinks = attention_sinks
+        self.shift_keys = shift_keys
         # Pre-allocate cache tensors: (n_layers, B, T, H, D)
-        self.k_cache = torch.zeros(num_layers, batch_size, seq_len, num_heads, head_dim, device=device, dtype=dtype)
-        self.v_cache = torch.zeros(num_layers, batch_size, seq_len, num_heads, head_dim, device=device, dtype=dtype)
-        # Current sequence length per batch element (FA3 needs int32)
+        self.pool = pool
+        rows, positions = (pool.rows_class(batch_size), pool.positions_class(seq_len)) if pool is not None else (batch_size, seq_len)
+        def alloc(*shape, dtype, capacity):
+            if pool is None:
+                return torch.zeros(shape, device=device, dtype=dtype)
+            return pool.alloc(shape, dtype, device, capacity)
+        cache_dtype = torch.int8 if quantize else dtype
+        num_full = num_layers - num_ring
+        self.k_cache = alloc(num_full, batch_size, seq_len, num_heads, head_dim, dtype=cache_dtype, capacity=(num_full, rows, positions, num_heads, head_dim))
+        self.v_cache = alloc(num_full, batch_size, seq_len, num_heads, head_dim, dtype=cache_dtype, capacity=(num_full, rows, positions, num_heads, head_dim))
+        self.k_scale = self.v_scale = None
+        if quantize:
+            self.k_scale = alloc(num_full, batch_size, seq_len, num_heads, dtype=dtype, capacity=(num_full, rows, positions, num_heads))
+            self.v_scale = alloc(num_full, batch_size, seq_len, num_heads, dtype=dtype, capacity=(num_full, rows, positions, num_heads))
+        self.k_ring = self.v_ring = self.k_ring_scale = self.v_ring_scale = None
+        if num_ring > 0:
+            R = self.ring_size
+            self.k_ring = alloc(num_ring, batch_size, R, num_heads, head_dim, dtype=cache_dtype, capacity=(num_ring, rows, R, num_heads, head_dim))
+            self.v_ring = alloc(num_ring, batch_size, R, num_heads, head_dim, dtype=cache_dtype, capacity=(num_ring, rows, R, num_heads, head_dim))
+            if quantize:
+                self.k_ring_scale = alloc(num_ring, batch_size, R, num_heads, dtype=dtype, capacity=(num_ring, rows, R, num_heads))
+                self.v_ring_scale = alloc(num_ring, batch_size, R, num_heads, dtype=dtype, capacity=(num_ring, rows, R, num_heads))
+        # Current sequence length per batch element (FA3 needs int32), and its host copy
         self.cache_seqlens = torch.zeros(batch_size, dtype=torch.int32, device=device)
+        self.host_seqlens = torch.zeros(batch_size, dtype=torch.int32)
+        self.block_table = None # dense cache, see PagedKVCache
+        self.cascade = None # paged caches only, see PagedKVCache.shared_prefixes
 
     def reset(self):
         """Reset cache to empty state."""
         self.cache_seqlens.zero_()
+        self.host_seqlens.zero_()
+
+    def release(self):
+        """Give the storage back to the pool it came from (if any). The cache can't be used anymore."""
+        if self.pool is not None:
+            self.pool.release(self.k_cache, self.v_cache, self.k_scale, self.v_scale,
+                              self.k_ring, self.v_ring, self.k_ring_scale, self.v_ring_scale)
+            self.pool = None
+        self.k_cache = self.v_cache = self.k_scale = self.v_scale = None
+        self.k_ring = self.v_ring = self.k_ring_scale = self.v_ring_scale = None
 
     def get_pos(self):
         """Get current position (assumes all batch elements at same position)."""
-        return self.cache_seqlens[0].item()
+        return int(self.host_seqlens[0])
+
+    def set_pos(self, start, positions):
+        """Set the positions of rows [start, start + len(positions)) to a list of ints."""
+        end = start + len(positions)
+        self.host_seqlens[start:end] = torch.tensor(positions, dtype=torch.int32)
+        self.cache_seqlens[start:end] = self.host_seqlens[start:end].to(self.cache_seqlens.device)
 
     def get_layer_cache(self, layer_idx):
-        """Return (k_cache, v_cache) views for a specific layer."""
-        return self.k_cache[layer_idx], self.v_cache[layer_idx]
+        """Return (k_cache, v_cache) views for a specific layer (ring buffers for ring layers)."""
+        ring, i = self.layer_slots[layer_idx]
+        if ring:
+            return self.k_ring[i], self.v_ring[i]
+        return self.k_cache[i], self.v_cache[i]
+
+    def get_layer_scales(self, layer_idx):
+        """Return (k_scale, v_scale) for a specific layer of an int8 cache, (None, None) otherwise."""
+        if self.k_scale is None:
+            return None, None
+        ring, i = self.layer_slots[layer_idx]
+        if ring:
+            return self.k_ring_scale[i], self.v_ring_scale[i]
+        return self.k_scale[i], self.v_scale[i]
+
+    def is_ring_layer(self, layer_idx):
+        """Whether a layer keeps a ring buffer of its last ring_size positions instead of the full sequence."""
+        return self.layer_slots[layer_idx][0]
 
     def advance(self, num_tokens):
         """Advance the cache position by num_tokens."""
         self.cache_seqlens += num_tokens
+        if not torch.compiler.is_compiling(): # a compiled step advances the host copy itself, see CompiledDecode
+            self.host_seqlens += num_tokens
 
     def prefill(self, other):
         """
@@ -129,163 +302,1774 @@ class KVCache:
         other_pos = other.get_pos()
         self.k_cache[:, :, :other_pos, :, :] = other.k_cache[:, :, :other_pos, :, :]
         self.v_cache[:, :, :other_pos, :, :] = other.v_cache[:, :, :other_pos, :, :]
+        if self.k_scale is not None:
+            self.k_scale[:, :, :other_pos] = other.k_scale[:, :, :other_pos]
+            self.v_scale[:, :, :other_pos] = other.v_scale[:, :, :other_pos]
+        if self.k_ring is not None:
+            # position p is in slot p % ring_size in both caches, copy the rings whole
+            assert self.ring_size == other.ring_size
+            for name in ("k_ring", "v_ring", "k_ring_scale", "v_ring_scale"):
+                if getattr(self, name) is not None:
+                    getattr(self, name)[:] = getattr(other, name)
         self.cache_seqlens.fill_(other_pos)
+        self.host_seqlens.fill_(other_pos)
+
+    def rows(self, start, end):
+        """
+        Return a KVCache over rows [start, end) that shares storage with this one.
+        Writes and advance() through the view land in this cache, so a scheduler can
+        run a forward on any contiguous block of rows without copying anything.
+        """
+        view = object.__new__(KVCache)
+        view.__dict__.update(self.__dict__)
+        view.batch_size = end - start
+        for name in ("k_cache", "v_cache", "k_scale", "v_scale", "k_ring", "v_ring", "k_ring_scale", "v_ring_scale"):
+            if getattr(self, name) is not None:
+                setattr(view, name, getattr(self, name)[:, start:end])
+        view.cache_seqlens = self.cache_seqlens[start:end]
+        view.host_seqlens = self.host_seqlens[start:end]
+        return view
+
+    # Row management used by the BatchScheduler (PagedKVCache implements the same methods)
+
+    def can_fit(self, num_tokens, num_rows):
+        """Whether num_rows new rows holding num_tokens tokens each fit (free rows are tracked by the scheduler)."""
+        return num_tokens <= self.max_seq_len or self.attention_sinks > 0
+
+    def can_fit_all(self, items):
+        """Whether several prompts fit at once, items being (num_tokens, num_rows) pairs as for can_fit."""
+        return all(self.can_fit(num_tokens, num_rows) for num_tokens, num_rows in items)
+
+    def reserve(self, row, num_tokens):
+        """Make sure row can hold num_tokens tokens. Returns False if it can't."""
+        return num_tokens <= self.max_seq_len or self.attention_sinks > 0
+
+    def make_room(self, row, num_tokens):
+        """
+        Attention sinks: make room for num_tokens more positions in row, evicting the oldest positions after the sinks if
+        it is full. A quarter of the window goes at once, so the move (and the re-rotation) happens every so many tokens.
+        """
+        pos = int(self.host_seqlens[row])
+        overflow = pos + num_tokens - self.max_seq_len
+        if overflow <= 0:
+            return
+        s = self.attention_sinks
+        assert overflow <= pos - s, "more new tokens than the window holds"
+        num_evict = min(max(overflow, (self.max_seq_len - s) // 4), pos - s)
+        kept = slice(s + num_evict, pos)
+        self.k_cache[:, row, s:pos - num_evict] = self.shift_keys(self.k_cache[:, row, kept], -num_evict)
+        self.v_cache[:, row, s:pos - num_evict] = self.v_cache[:, row, kept].clone()
+        self.set_pos(row, [pos - num_evict])
+
+    def free_row(self, row):
+        """Empty a row."""
+        self.rows(row, row + 1).reset()
+
+    def fork_row(self, src, start, end):
+        """Copy the contents of row src into the (empty) rows [start, end)."""
+        self.rows(start, end).prefill(self.rows(src, src + 1))
+
+    def move_row(self, src, dst):
+        """Move row src into row dst (overwriting it) and leave src empty."""
+        self.free_row(dst)
+        self.fork_row(src, dst, dst + 1)
+        self.free_row(src)
+
+
+class PagedKVCache:
+    """
+    Paged KV cache: one fixed pool of fixed-size KV blocks shared by all rows, plus a block table per row.
+
+    - Pool tensors are (n_layers, num_blocks, block_size, H, D), row r's i-th block is block_table[r, i]
+    - Blocks are allocated on demand as a row grows (reserve) and go back to the pool when it is freed,
+      so memory follows the tokens actually cached instead of batch_size * max_seq_len
+    - Blocks are reference counted: rows forked from one prompt share its full blocks
+    - Same interface as KVCache, and flash_attn_with_kvcache consumes block_table directly
+      (the FA kernels need block_size to be a multiple of 256, the SDPA fallback takes any size)
+    - quantize=True stores int8 blocks with per token and head scales, like KVCache
+    """
+
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype, num_blocks, block_size=256, quantize=False,
+                 pool=None):
+        self.batch_size = batch_size
+        self.max_seq_len = seq_len
+        self.n_layers = num_layers
+        self.n_heads = num_heads
+        self.head_dim = head_dim
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        max_blocks_per_row = -(-seq_len // block_size)
+        # Pre-allocate the block pool: (n_layers, num_blocks, block_size, H, D), from the KVPool if given
+        self.pool = pool
+        blocks = pool.blocks_class(num_blocks) if pool is not None else num_blocks
+        def alloc(*shape, dtype):
+            if pool is None:
+                return torch.zeros(shape, device=device, dtype=dtype)
+            return pool.alloc(shape, dtype, device, (shape[0], blocks) + shape[2:])
+        cache_dtype = torch.int8 if quantize else dtype
+        self.k_cache = alloc(num_layers, num_blocks, block_size, num_heads, head_dim, dtype=cache_dtype)
+        self.v_cache = alloc(num_layers, num_blocks, block_size, num_heads, head_dim, dtype=cache_dtype)
+        self.k_scale = self.v_scale = None
+        if quantize:
+            self.k_scale = alloc(num_layers, num_blocks, block_size, num_heads, dtype=dtype)
+            self.v_scale = alloc(num_layers, num_blocks, block_size, num_heads, dtype=dtype)
+        self.cache_seqlens = torch.zeros(batch_size, dtype=torch.int32, device=device)
+        self.host_seqlens = torch.zeros(batch_size, dtype=torch.int32) # host copy of the positions, see KVCache
+        # Block table on device for the attention kernels, and a host copy for the allocator
+        self.block_table = torch.zeros(batch_size, max_blocks_per_row, dtype=torch.int32, device=device)
+        self.row_blocks = [[] for _ in range(batch_size)]
+        self.free_blocks = list(range(num_blocks - 1, -1, -1)) # stack, pops block 0 first
+        self.ref_counts = [0] * num_blocks
+        self.prefix_cache = None # optional PrefixCache holding references on blocks of past prompts
+        self.shared_lens = [0] * batch_size # leading tokens of row r in full blocks shared with the rows forked with it
+        self.cascade = None # set on a view by the scheduler for cascade attention, see shared_prefixes()
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    @property
+    def num_available_blocks(self):
+        """Free blocks plus the blocks the prefix cache would give up if asked."""
+        evictable = self.prefix_cache.num_evictable() if self.prefix_cache is not None else 0
+        return self.num_free_blocks + evictable
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def reset(self):
+        """Reset cache to empty state, returning every block to the pool."""
+        for row in range(self.batch_size):
+            self.free_row(row)
+
+    def release(self):
+        """Give the block pool storage back to the KVPool it came from (if any). The cache can't be used anymore."""
+        if self.pool is not None:
+            self.pool.release(self.k_cache, self.v_cache, self.k_scale, self.v_scale)
+            self.pool = None
+        self.k_cache = self.v_cache = self.k_scale = self.v_scale = None
+
+    def get_pos(self):
+        """Get current position (assumes all batch elements at same position)."""
+        return int(self.host_seqlens[0])
+
+    def set_pos(self, start, positions):
+        """Set the positions of rows [start, start + len(positions)) to a list of ints."""
+        end = start + len(positions)
+        self.host_seqlens[start:end] = torch.tensor(positions, dtype=torch.int32)
+        self.cache_seqlens[start:end] = self.host_seqlens[start:end].to(self.cache_seqlens.device)
+
+    def get_layer_cache(self, layer_idx):
+        """Return (k_cache, v_cache) block pools for a specific layer."""
+        return self.k_cache[layer_idx], self.v_cache[layer_idx]
+
+    def get_layer_scales(self, layer_idx):
+        """Return (k_scale, v_scale) block pools for a specific layer of an int8 cache, (None, None) otherwise."""
+        if self.k_scale is None:
+            return None, None
+        return self.k_scale[layer_idx], self.v_scale[layer_idx]
+
+    def is_ring_layer(self, layer_idx):
+        return False # every layer keeps all its positions, in blocks
+
+    def advance(self, num_tokens):
+        """Advance the cache position by num_tokens."""
+        self.cache_seqlens += num_tokens
+        if not torch.compiler.is_compiling():
+            self.host_seqlens += num_tokens
+
+    def rows(self, start, end):
+        """
+        Return a view over rows [start, end) for running a forward, sharing the pool and positions.
+        Blocks must be reserved through this (parent) cache, not through the view.
+        """
+        view = object.__new__(PagedKVCache)
+        view.__dict__.update(self.__dict__)
+        view.batch_size = end - start
+        view.cache_seqlens = self.cache_seqlens[start:end]
+        view.host_seqlens = self.host_seqlens[start:end]
+        view.block_table = self.block_table[start:end]
+        view.shared_lens = self.shared_lens[start:end]
+        return view
+
+    def shared_prefixes(self, start, end):
+        """
+        The rows among [start, end) that share the blocks of a prefix with other rows (the samples of one prompt), as
+        a Cascade for flash_attn_with_kvcache, or None if no two rows share anything. Set it as the cascade of the
+        rows(start, end) view the forward runs on.
+        """
+        groups = {}
+        for row in range(start, end):
+            if self.shared_lens[row] > 0:
+                blocks = tuple(self.row_blocks[row][:self.shared_lens[row] // self.block_size])
+                groups.setdefault(blocks, []).append(row - start)
+        groups = {blocks: rows for blocks, rows in groups.items() if len(rows) > 1}
+        if not groups:
+            return None
+        prefix_lens = [0] * (end - start)
+        device = self.block_table.device
+        for blocks, rows in groups.items():
+            for row in rows:
+                prefix_lens[row] = len(blocks) * self.block_size
+        groups = [(torch.tensor(rows, device=device), torch.tensor(blocks, dtype=torch.int32, device=device), len(blocks) * self.block_size)
+                  for blocks, rows in groups.items()]
+        return Cascade(groups, prefix_lens, device)
+
+    def _alloc(self):
+        if not self.free_blocks and self.prefix_cache is not None:
+            self.prefix_cache.evict(1)
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def _release(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def _set_blocks(self, row, blocks):
+        self.row_blocks[row] = blocks
+        if blocks:
+            self.block_table[row, :len(blocks)] = torch.tensor(blocks, dtype=torch.int32)
+
+    def can_fit(self, num_tokens, num_rows):
+        """Whether num_rows new rows of num_tokens tokens fit, keeping one spare block per row to start decoding."""
+        return self.can_fit_all([(num_tokens, num_rows)])
+
+    def can_fit_all(self, items):
+        """Whether several prompts fit at once, items being (num_tokens, num_rows) pairs as for can_fit."""
+        needed = 0
+        for num_tokens, num_rows in items:
+            if num_tokens > self.max_seq_len:
+                return False
+            partial = 1 if num_tokens % self.block_size else 0
+            needed += self.blocks_needed(num_tokens) + (num_rows - 1) * partial + num_rows
+        return needed <= self.num_available_blocks
+
+    def reserve(self, row, num_tokens):
+        """Make sure row has blocks for num_tokens tokens. Returns False if the pool ran dry."""
+        if num_tokens > self.max_seq_len:
+            return False
+        blocks = self.row_blocks[row]
+        need = self.blocks_needed(num_tokens) - len(blocks)
+        if need <= 0:
+            return True
+        if need > self.num_available_blocks:
+            return False
+        self._set_blocks(row, blocks + [self._alloc() for _ in range(need)])
+        return True
+
+    def attach(self, row, blocks):
+        """Start an empty row from already filled blocks (e.g. a cached prompt prefix), taking a reference on each."""
+        assert not self.row_blocks[row], "Cannot attach blocks to a non-empty row"
+        for block in blocks:
+            self.ref_counts[block] += 1
+        self._set_blocks(row, list(blocks))
+        self.set_pos(row, [len(blocks) * self.block_size])
+
+    def free_row(self, row):
+        """Empty a row and give its blocks back to the pool (shared blocks stay alive for the other rows)."""
+        for block in self.row_blocks[row]:
+            self._release(block)
+        self.row_blocks[row] = []
+        self.shared_lens[row] = 0
+        self.set_pos(row, [0])
+
+    def fork_row(self, src, start, end):
+        """
+        Make rows [start, end) copies of row src. Full blocks are shared (copy-free) since rows only ever
+        append after them, the partially filled last block is copied into a fresh block for every row.
+        """
+        length = int(self.host_seqlens[src])
+        num_full = length // self.block_size
+        shared = self.row_blocks[src][:num_full]
+        for row in range(start, end):
+            assert not self.row_blocks[row], "Cannot fork into a non-empty row"
+            for block in shared:
+                self.ref_counts[block] += 1
+            blocks = list(shared)
+            if length % self.block_size:
+                last, block = self.row_blocks[src][num_full], self._alloc()
+                self.k_cache[:, block] = self.k_cache[:, last]
+                self.v_cache[:, block] = self.v_cache[:, last]
+                if self.k_scale is not None:
+                    self.k_scale[:, block] = self.k_scale[:, last]
+                    self.v_scale[:, block] = self.v_scale[:, last]
+                blocks.append(block)
+            self._set_blocks(row, blocks)
+        self.set_pos(start, [length] * (end - start))
+        if num_full > 0:
+            for row in [src, *range(start, end)]:
+                self.shared_lens[row] = num_full * self.block_size
+
+    def move_row(self, src, dst):
+        """Move row src into row dst (overwriting it) and leave src empty. Only the block table moves."""
+        self.free_row(dst)
+        self._set_blocks(dst, self.row_blocks[src])
+        self.set_pos(dst, [int(self.host_seqlens[src])])
+        self.shared_lens[dst] = self.shared_lens[src]
+        self.row_blocks[src] = []
+        self.shared_lens[src] = 0
+        self.set_pos(src, [0])
+
+class PrefixNode:
+    # One full block of a cached prefix, keyed by its block_size tokens under its parent
+    def __init__(self, parent=None, key=None, block=None):
+        self.parent = parent
+        self.key = key
+        self.block = block
+        self.children = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+    """
+    Radix tree over token ids mapping prompt prefixes to the PagedKVCache blocks that hold their KV.
+
+    Every node is one full block, keyed by its block_size tokens under its parent, so a lookup walks
+    the prompt one block at a time and returns the blocks of the longest cached prefix. A new request
+    starts from those blocks and only prefills the rest of its prompt. Matching is token exact, reuse is
+    in whole blocks: the partially filled last block of a prompt is always recomputed.
+
+    The cache holds one reference on each of its blocks. Blocks nobody else references are evicted
+    least recently used first (leaves before their parents), whenever the pool needs a block or the
+    cache grows past max_blocks.
+    """
+
+    def __init__(self, kv_cache, max_blocks=None):
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        self.max_blocks = max_blocks if max_blocks is not None else kv_cache.num_blocks
+        self.root = PrefixNode()
+        self.num_blocks = 0 # blocks referenced by the tree
+        self.clock = 0 # logical time for LRU
+        kv_cache.prefix_cache = self
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
+
+    def _evictable(self, node):
+        return node is not self.root and not node.children and self.kv_cache.ref_counts[node.block] == 1
+
+    def match(self, tokens):
+        """Return the blocks holding the longest cached prefix of tokens (a whole number of blocks)."""
+        self.clock += 1
+        bs = self.block_size
+        node, blocks = self.root, []
+        for i in range(len(tokens) // bs):
+            node = node.children.get(tuple(tokens[i * bs:(i + 1) * bs]))
+            if node is None:
+                break
+            node.last_access = self.clock
+            blocks.append(node.block)
+        return blocks
+
+    def insert(self, tokens, blocks):
+        """Cache the full blocks of a row, where blocks[i] holds the KV of tokens[i * block_size:(i + 1) * block_size]."""
+        self.clock += 1
+        bs = self.block_size
+        node = self.root
+        for i in range(min(len(tokens) // bs, len(blocks))):
+            key = tuple(tokens[i * bs:(i + 1) * bs])
+            child = node.children.get(key)
+            if child is None:
+                # first time we see this prefix: keep the row's block alive for future requests
+                child = PrefixNode(node, key, blocks[i])
+                node.children[key] = child
+                self.kv_cache.ref_counts[blocks[i]] += 1
+                self.num_blocks += 1
+            child.last_access = self.clock
+            node = child
+        if self.num_blocks > self.max_blocks:
+            self.evict(self.num_blocks - self.max_blocks)
+
+    def num_evictable(self):
+        # Blocks only the tree references. A row using a block also uses all its ancestors,
+        # so this set is closed under descendants and can be fully evicted leaves first.
+        return sum(1 for node in self._nodes() if self.kv_cache.ref_counts[node.block] == 1)
+
+    def evict(self, num_blocks):
+        """Give up to num_blocks unused blocks back to the pool, least recently used leaves first."""
+        heap = [(node.last_access, id(node), node) for node in self._nodes() if self._evictable(node)]
+        heapq.heapify(heap)
+        freed = 0
+        while heap and freed < num_blocks:
+            _, _, node = heapq.heappop(heap)
+            parent = node.parent
+            del parent.children[node.key]
+            self.kv_cache._release(node.block)
+            self.num_blocks -= 1
+            freed += 1
+            if self._evictable(parent):
+                heapq.heappush(heap, (parent.last_access, id(parent), parent))
+        return freed
+
+    def clear(self):
+        """Drop every cached prefix, e.g. after the model weights changed."""
+        for node in self._nodes():
+            self.kv_cache._release(node.block)
+        self.root = PrefixNode()
+        self.num_blocks = 0
 
 # -----------------------------------------------------------------------------
-@torch.inference_mode()
-def sample_next_token(logits, rng, temperature=1.0, top_k=None):
-    """Sample a single next token from given logits of shape (B, vocab_size). Returns (B, 1)."""
-    assert temperature >= 0.0, "temperature must be non-negative"
-    if temperature == 0.0:
-        return torch.argmax(logits, dim=-1, keepdim=True)
-    if top_k is not None and top_k > 0:
-        k = min(top_k, logits.size(-1))
-        vals, idx = torch.topk(logits, k, dim=-1)
-        vals = vals / temperature
-        probs = F.softmax(vals, dim=-1)
-        choice = torch.multinomial(probs, num_samples=1, generator=rng)
-        return idx.gather(1, choice)
-    else:
-        logits = logits / temperature
-        probs = F.softmax(logits, dim=-1)
-        return torch.multinomial(probs, num_samples=1, generator=rng)
+def _per_row(x, like):
+    """A setting given as a scalar or a per-row (B,) tensor, shaped to broadcast against like (B, ..., vocab_size)."""
+    x = torch.as_tensor(x, dtype=torch.float32, device=like.device)
+    return x.view(-1, *[1] * (like.dim() - 1)) if x.dim() > 0 else x
+
+def _num_candidates(top_k, top_p, vocab_size):
+    """How many of the largest logits token_probs sorts for a row: its top_k ones, all of them for top_p alone."""
+    top_k = int(top_k)
+    return min(top_k, vocab_size) if top_k > 0 else (vocab_size if top_p < 1 else 1)
+
+def _top_cutoff(logits, k, p, use_top_p, num_candidates=None):
+    """How many of its largest logits every row keeps for top_k / top_p (k, p shaped (B, ..., 1)), and the smallest kept."""
+    V = logits.size(-1)
+    num_keep = torch.where(k > 0, k.clamp(max=V), V)
+    # sort only the candidates: the largest top_k logits of a row, all of them for top_p without top_k
+    if num_candidates is None:
+        num_candidates = int(torch.where(k > 0, num_keep, torch.where(p < 1, V, 1)).max())
+    sorted_logits = logits.topk(num_candidates, dim=-1).values
+    K = sorted_logits.size(-1)
+    if use_top_p:
+        # the smallest prefix of the (top-k) sorted tokens that holds top_p of the mass
+        sorted_logits = sorted_logits.masked_fill(torch.arange(K, device=logits.device) >= num_keep, -float("inf"))
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        nucleus = ((sorted_probs.cumsum(dim=-1) - sorted_probs) < p).sum(dim=-1, keepdim=True).clamp(min=1)
+        num_keep = torch.where(p < 1, torch.minimum(num_keep, nucleus), num_keep)
+    return num_keep, sorted_logits.gather(-1, (num_keep - 1).clamp(max=K - 1))
+
+def token_probs(logits, temperature=1.0, top_k=None, top_p=None, min_p=None,
+                counts=None, repetition_penalty=None, frequency_penalty=None, num_candidates=None, allowed=None):
+    """
+    The distribution the next token is sampled from, as probabilities over the vocab (one-hot where temperature is 0).
+    logits are (B, ..., vocab_size) and every setting is a scalar or a per-row (B,) tensor, so rows with different
+    settings are processed together. None turns a setting off, as do top_k <= 0, top_p >= 1 and min_p <= 0 per row.
+    counts (shaped like logits) is how often each token was generated so far, for the penalties:
+    repetition_penalty divides the positive logits of seen tokens (multiplies the negative ones), and
+    frequency_penalty is subtracted once per occurrence.
+    num_candidates is the _num_candidates() of every row (a list) or the largest of them, if the caller knows it:
+    otherwise it is read back from the device, one sync. With the list, the rows that sort the most candidates (top_p
+    alone: the whole vocab) are sorted apart, so one such row doesn't make the whole batch sort the vocab.
+    allowed (shaped like logits, bool) restricts sampling to those tokens, e.g. the ones a grammar allows next.
+    """
+    logits = logits.float()
+    if allowed is not None:
+        logits = logits.masked_fill(~allowed, -float("inf"))
+    V = logits.size(-1)
+    if counts is not None:
+        if repetition_penalty is not None:
+            penalty = _per_row(repetition_penalty, logits)
+            logits = torch.where(counts > 0, torch.where(logits > 0, logits / penalty, logits * penalty), logits)
+        if frequency_penalty is not None:
+            logits = logits - _per_row(frequency_penalty, logits) * counts
+    temperature = _per_row(temperature, logits)
+    greedy = temperature == 0
+    argmax = logits.argmax(dim=-1, keepdim=True)
+    logits = logits / torch.where(greedy, 1.0, temperature)
+    if top_k is not None or top_p is not None:
+        k = _per_row(top_k if top_k is not None else 0, logits).long().expand(*logits.shape[:-1], 1)
+        p = _per_row(top_p if top_p is not None else 1.0, logits).expand(*logits.shape[:-1], 1)
+        widest = max(num_candidates) if isinstance(num_candidates, list) else num_candidates
+        if isinstance(num_candidates, list) and min(num_candidates) < widest:
+            num_keep = torch.empty(k.shape, dtype=torch.long, device=logits.device)
+            cutoff = torch.empty(k.shape, device=logits.device)
+            for wide in (True, False):
+                rows = [i for i, c in enumerate(num_candidates) if (c == widest) == wide]
+                index = torch.tensor(rows, device=logits.device)
+                num_keep[index], cutoff[index] = _top_cutoff(logits[index], k[index], p[index], top_p is not None,
+                                                             max(num_candidates[i] for i in rows))
+        else:
+            num_keep, cutoff = _top_cutoff(logits, k, p, top_p is not None, widest)
+        logits = logits.masked_fill((num_keep < V) & (logits < cutoff), -float("inf"))
+    probs = F.softmax(logits, dim=-1)
+    if min_p is not None:
+        # drop the tokens less likely than min_p times the most likely one
+        probs = probs.masked_fill(probs < _per_row(min_p, logits) * probs.amax(dim=-1, keepdim=True), 0)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+    # greedy rows: all the mass on the argmax (a scatter, not a one-hot over the vocab of every row)
+    return probs.masked_fill(greedy, 0).scatter_add(-1, argmax, greedy.float().expand_as(argmax))
+
+def sample_from_probs(probs, u):
+    """Inverse CDF sampling: the token drawn from every distribution of probs (..., vocab_size) with uniforms u (...)."""
+    cdf = probs.cumsum(dim=-1)
+    x = (u * cdf[..., -1]).unsqueeze(-1)
+    return torch.searchsorted(cdf, x, right=True).squeeze(-1).clamp(max=probs.size(-1) - 1)
+
+def _mix32(x):
+    # lowbias32 integer hash: avalanches the low 32 bits of an int64 tensor into [0, 2**32)
+    x = x & 0xFFFFFFFF
+    x = x ^ (x >> 16)
+    x = (x * 0x7FEB352D) & 0xFFFFFFFF
+    x = x ^ (x >> 15)
+    x = (x * 0x846CA68B) & 0xFFFFFFFF
+    return x ^ (x >> 16)
+
+def rng_keys(seed, samples):
+    """The random stream key of each sample index in samples (an int64 tensor) of a request with this seed."""
+    seed = torch.tensor(seed, dtype=torch.long, device=samples.device)
+    return _mix32(_mix32(_mix32(seed) ^ (seed >> 32)) ^ samples)
+
+def counter_uniforms(key, counter, stream=0):
+    """
+    Counter-based random numbers: a uniform in [0, 1) for every (key, stream, counter), given as int64 tensors that
+    broadcast. Each draw is a pure function of its inputs (unlike a torch.Generator, whose draws depend on how many
+    numbers were drawn before and alongside), so a row gets the same numbers however the batch is laid out.
+    """
+    x = _mix32(_mix32(key ^ stream) ^ counter)
+    return (x >> 8).float() * 2.0 ** -24
+
+# Random streams of a row (counter_uniforms): token samples, speculative acceptance tests and draft samples
+RNG_SAMPLE, RNG_ACCEPT, RNG_DRAFT = 0, 1, 2
+
+# Bits of the per-row flags a decode step sends back to the host along with the tokens
+FORCED_TOKEN, TOOL_TOKEN, END_TOKEN, OUT_OF_TOKENS, PARKED = 1, 2, 4, 8, 16
+
+# The neutral value of every sampling setting, what a row that has it off holds in per-row tensors
+SAMPLING_DEFAULTS = dict(temperature=1.0, top_k=0, top_p=1.0, min_p=0.0, repetition_penalty=1.0, frequency_penalty=0.0)
 
 # -----------------------------------------------------------------------------
 
+class NgramIndex:
+    # Where each n-gram (n <= max_ngram) of a row's tokens last ended, for prompt lookup drafting
+    def __init__(self, max_ngram=3):
+        self.max_ngram = max_ngram
+        self.last_end = {} # n-gram tuple -> index of its last token
+        self.num_indexed = 0 # tokens[:num_indexed] are indexed
+
+    def propose(self, tokens, k):
+        """Up to k tokens that followed the latest earlier occurrence of the longest (<= max_ngram) suffix of tokens."""
+        # index the n-grams ending before the last token, so the suffix can't match itself
+        while self.num_indexed < len(tokens) - 1:
+            end = self.num_indexed
+            for n in range(1, min(self.max_ngram, end + 1) + 1):
+                self.last_end[tuple(tokens[end - n + 1:end + 1])] = end
+            self.num_indexed += 1
+        for n in range(min(self.max_ngram, len(tokens)), 0, -1):
+            end = self.last_end.get(tuple(tokens[-n:]))
+            if end is not None:
+                return tokens[end + 1:end + 1 + k]
+        return []
+
 class RowState:
     # Per-row state tracking during generation
-    def __init__(self, current_tokens=None):
+    def __init__(self, current_tokens=None, request=None, sample_idx=0):
         self.current_tokens = current_tokens or [] # Current token sequence for this row
         self.forced_tokens = deque() # Queue of tokens to force inject
         self.in_python_block = False # Whether we are inside a python block
         self.python_expr_tokens = [] # Tokens of the current python expression
+        self.tool_call = None # Future of the tool call this row is parked on (with a ToolExecutor)
+        self.tool_deadline = 0.0 # when to give up on it (time.monotonic())
         self.completed = False # Whether this row has completed generation
+        self.request = request # The Request this row is sampling for
+        self.sample_idx = sample_idx # Which of the request's num_samples this row is
+        self.num_generated = 0 # Number of tokens emitted so far
+        self.finished = False # Whether this row has left the batch (completed, out of tokens or cancelled)
+        self.draft_len = 0 # Number of current_tokens already in the draft model's KV cache (speculative decoding)
+        self.ngram_index = NgramIndex() # For prompt lookup drafting
+        self.logprobs = [] # (logprob, [(token, logprob)] of the top alternatives) per emitted token, if the request asked
+        self.grammar_state = None # State of the request's grammar, saved while the row is preempted
 
-class Engine:
+class Request:
+    # One prompt submitted to a BatchScheduler, sampled num_samples times with its own settings
+    def __init__(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42,
+                 top_p=None, min_p=None, repetition_penalty=1.0, frequency_penalty=0.0, logprobs=None, grammar=None, first_sample=0):
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        assert temperature >= 0.0, "temperature must be non-negative"
+        self.tokens = tokens
+        self.num_samples = num_samples
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.frequency_penalty = frequency_penalty
+        self.seed = seed
+        self.logprobs = logprobs # None, or record the logprob of every emitted token and its logprobs top alternatives
+        self.grammar = grammar # None, or the Grammar (see nanochat/grammar.py) every sample must match
+        self.first_sample = first_sample # sample j draws random numbers as sample first_sample + j of this seed
+        self.rows = [] # RowStates of this request, filled in at admission
+
+    def sampling(self):
+        """The request's sampling settings as {name: value}, value None when the setting is off."""
+        return dict(
+            temperature=self.temperature,
+            top_k=self.top_k if self.top_k is not None and self.top_k > 0 else None,
+            top_p=self.top_p if self.top_p is not None and self.top_p < 1 else None,
+            min_p=self.min_p if self.min_p is not None and self.min_p > 0 else None,
+            repetition_penalty=self.repetition_penalty if self.repetition_penalty != 1 else None,
+            frequency_penalty=self.frequency_penalty if self.frequency_penalty != 0 else None,
+        )
+
+    @property
+    def finished(self):
+        return len(self.rows) > 0 and all(state.finished for state in self.rows)
+
+class CompiledDecode:
+    """
+    The decode forward (one token per row) compiled with torch.compile: no Python loop over the blocks, module
+    lookups or host syncs per token (under compile the attention runs over the whole fixed-capacity cache, masked
+    per row, see flash_attention), and CUDA graphs where available. Only shapes that were warmed up run compiled,
+    anything else (another batch size or cache size) runs the eager forward, so serving never stalls on a compile.
+    """
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model):
         self.model = model
-        self.tokenizer = tokenizer # needed for tool use
+        mode = "reduce-overhead" if model.get_device().type == "cuda" else None # CUDA graphs
+        self.compiled = torch.compile(self._forward, mode=mode)
+        self.shapes = set() # the warmed up shapes, see _shape
+
+    def _forward(self, ids, kv_cache):
+        return self.model.forward(ids, kv_cache=kv_cache)[:, -1, :]
+
+    @staticmethod
+    def _shape(ids, kv_cache):
+        tensors = (ids, kv_cache.k_cache, getattr(kv_cache, "k_ring", None), kv_cache.block_table, kv_cache.k_scale)
+        return tuple(None if t is None else (tuple(t.shape), t.dtype) for t in tensors)
+
+    def __call__(self, ids, kv_cache):
+        """Logits (B, vocab_size) of the next token after ids (B, 1), compiled if this shape was warmed up."""
+        if self._shape(ids, kv_cache) not in self.shapes:
+            return self._forward(ids, kv_cache)
+        logits = self.compiled(ids, kv_cache)
+        kv_cache.host_seqlens += 1 # the graph only advances the positions on the device
+        return logits
 
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
-        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
-        device = self.model.get_device()
+    def warmup(self, kv_cache, batch_sizes):
+        """
+        Compile the step for rows [0, n) of kv_cache for every n in batch_sizes. The rows must be empty (they are
+        written to, and emptied again after), so warm up an idle cache.
+        Run it under the autocast context generation will use, the compiled code is specialized to it.
+        """
+        for n in batch_sizes:
+            for row in range(n):
+                assert kv_cache.reserve(row, 1) # a block of its own to write into (paged cache)
+            view = kv_cache.rows(0, n)
+            ids = torch.zeros(n, 1, dtype=torch.long, device=view.cache_seqlens.device)
+            for _ in range(3): # CUDA graphs are recorded on the first calls after compiling
+                self.compiled(ids, view)
+                view.cache_seqlens.zero_()
+            self.shapes.add(self._shape(ids, view))
+            for row in range(n):
+                kv_cache.free_row(row)
+
+class BatchScheduler:
+    """
+    Continuous batching on top of a single model.
+
+    Requests can be added at any time and join the running decode batch at the next step().
+    Rows leave the batch as soon as they finish, so no compute is spent on dead rows.
+    The active rows are kept packed in slots [0, n) of one KV cache: a finished row is
+    swapped with the last one, so every forward runs on a contiguous view of the cache.
+    Each row has its own position in the cache (cache_seqlens), there is no shared get_pos().
+
+    With paged=True the rows live in a PagedKVCache of num_blocks blocks instead of a dense
+    (max_batch_size, max_seq_len) cache, so many more rows fit in the same memory. If the block
+    pool runs dry mid-decode, the most recently admitted rows are preempted: they give their
+    blocks back and are re-prefilled (prompt + tokens generated so far) once blocks free up.
+
+    With prefix_cache=True (paged only) the full blocks of every prompt and finished row are kept in a
+    PrefixCache of up to prefix_cache_blocks blocks, so a request that starts with an already seen
+    prefix (system prompt, few-shot examples, earlier turns of a chat) only prefills the rest.
+
+    With a draft_model (a smaller GPT sharing the tokenizer) every step is speculative: the draft
+    proposes num_draft_tokens tokens per row, the model scores them all in one forward and rejection
+    sampling keeps a prefix of them, so the output distribution is exactly the model's while each
+    step can emit up to num_draft_tokens + 1 tokens per row.
+    With prompt_lookup=True the drafts come from the row itself instead: whatever followed the last
+    earlier occurrence of its final few tokens. No extra weights, and copy-heavy generations
+    (numbers, variable names, code quoted from the prompt) get long runs of accepted drafts.
+    With draft_layers=N the model drafts for itself (self-speculative, early exit): its first N blocks, then
+    its final norm and lm_head, propose the tokens. They run on the model's own KV cache, whose first N layers
+    already hold the context, so there is no second checkpoint nor draft cache to keep up to date.
+
+    With quantize_kv=True the KV cache is stored in int8 (per token and head scales), so about twice
+    (bf16) or four times (fp32) as many tokens fit in the same memory, for a small accuracy cost.
+
+    With prefill_chunk_size set, at most that many prompt tokens are prefilled per step: a long prompt
+    is fed through the KV cache in chunks over several steps, each interleaved with a decode step of
+    the rows already streaming, so their inter-token latency (and the prefill activation memory) stays bounded.
+
+    With compiled_decode (see CompiledDecode, shared through the Engine) the plain decode steps run compiled
+    whenever the batch has a warmed up size, see warmup().
+
+    With cascade=True (paged only) the plain decode steps use cascade attention: the samples of a prompt share
+    its full blocks anyway, and now the queries of all of them attend to those blocks in one go (the prompt KV
+    is read once per step, not once per sample), each row to its own blocks after them, merged by log-sum-exp.
+
+    With attention_sinks > 0 (dense cache only) a row never runs out of cache: once it is full, the positions after its
+    first attention_sinks tokens are evicted and the rest move down (StreamingLLM, see KVCache.make_room), so a chat can
+    go on for any number of tokens at constant memory and cost per token. Prompts longer than the cache are prefilled in
+    chunks of at most half its window, evicting along the way.
+
+    With a kv_pool (see KVPool) the KV caches are carved out of recycled storage, and release() hands it back
+    once the scheduler is done with.
+
+    With a tool_executor (see ToolExecutor) the python tool runs off the decode loop: a row that closes a
+    python block is parked until its call is done, while the other rows keep decoding. A parked row stays in
+    the batch and forwards its last token again every step (its position does not advance, the sampled token
+    is dropped), and the result is forced in once it is there. Without one, tools run inline in step().
+    Speculative steps wait for the call right away, the drafts of a row continue from its result.
+
+    A request with logprobs=N gets the logprob of every token its rows emit (under the model's own distribution,
+    log_softmax of the logits, whatever the sampling settings) and the N most likely tokens with theirs, gathered
+    from the logits of the step on the device. They stay there until flush_logprobs() copies them to state.logprobs.
+
+    Every request has its own sampling settings (temperature, top_k, top_p, min_p, repetition and
+    frequency penalties, seed). They live in per-row tensors next to the KV cache rows, so the whole
+    batch is sampled with one set of tensor ops (see token_probs), whatever mix of requests it holds.
+    The random numbers are counter-based (see counter_uniforms): the draws for the t-th token of sample j
+    depend only on (seed, j, t), so a request's outputs are the same whatever it shares the batch with,
+    in whichever row it sits, and however the batch gets compacted.
+    """
+
+    def __init__(self, engine, max_batch_size=8, max_seq_len=None, paged=False, num_blocks=None, block_size=256,
+                 prefix_cache=False, prefix_cache_blocks=None, draft_model=None, prompt_lookup=False, num_draft_tokens=4,
+                 prefill_chunk_size=None, quantize_kv=False, tool_executor=None, compiled_decode=None, cascade=False,
+                 kv_pool=None, attention_sinks=0, draft_layers=None):
+        self.model = engine.model
+        self.tokenizer = engine.tokenizer
+        self.device = torch.device(self.model.get_device())
         # NOTE: setting the dtype here and in this way is an ugly hack.
         # Currently the repo assumes that cuda -> bfloat16 and everything else -> float32.
         # We need to know the dtype here to call __init__ on KVCache and pre-allocate its tensors.
-        # As a quick hack, we're making generate() function inherit and know about this repo-wise assumption.
+        # As a quick hack, we're making the scheduler inherit and know about this repo-wise assumption.
         # I think there has to be a bigger refactor to deal with device/dtype tracking across the codebase.
         # In particular, the KVCache should allocate its tensors lazily
-        dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
-        rng = torch.Generator(device=device)
-        rng.manual_seed(seed)
-
-        # Get the special tokens we need to coordinate the tool use state machine
-        get_special = lambda s: self.tokenizer.encode_special(s)
-        python_start = get_special("<|python_start|>")
-        python_end = get_special("<|python_end|>")
-        output_start = get_special("<|output_start|>")
-        output_end = get_special("<|output_end|>")
-        assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
-        bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
-
-        # 1) Run a batch 1 prefill of the prompt tokens
+        dtype = torch.bfloat16 if self.device.type == "cuda" else torch.float32
         m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
-        kv_cache_prefill = KVCache(
-            batch_size=1,
-            seq_len=len(tokens),
-            device=device,
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len if max_seq_len is not None else m.sequence_len
+        assert (draft_model is not None) + prompt_lookup + (draft_layers is not None) <= 1, "pick one source of drafts"
+        assert draft_layers is None or 0 < draft_layers < self.model.config.n_layer, "draft with a prefix of the blocks"
+        self.draft_model = draft_model
+        self.draft_layers = draft_layers
+        self.speculative = draft_model is not None or prompt_lookup or draft_layers is not None
+        self.num_draft_tokens = num_draft_tokens if self.speculative else 0
+        self.lookahead = self.num_draft_tokens # room each row needs in the cache beyond its tokens, for drafts
+        # the scheduler tracks rows by their number of tokens, which only match their cache positions without eviction
+        assert not (attention_sinks and (paged or self.speculative or quantize_kv)), "attention sinks need a plain dense cache"
+        self.attention_sinks = attention_sinks
+        kv_kwargs = dict(
+            batch_size=max_batch_size,
+            seq_len=self.max_seq_len + self.lookahead,
+            num_heads=m.n_kv_head,
+            head_dim=m.n_embd // m.n_head,
+            num_layers=m.n_layer,
+            device=self.device,
             dtype=dtype,
-            **kv_model_kwargs,
+            quantize=quantize_kv,
+            pool=kv_pool,
         )
-        ids = torch.tensor([tokens], dtype=torch.long, device=device)
-        logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
-        logits = logits[:, -1, :].expand(num_samples, -1)  # (num_samples, vocab_size)
-
-        # 2) Replicate the KV cache for each sample/row
-        kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None else self.model.config.sequence_len
-        kv_cache_decode = KVCache(
-            batch_size=num_samples,
-            seq_len=kv_length_hint,
-            device=device,
-            dtype=dtype,
-            **kv_model_kwargs,
+        if paged:
+            # by default the pool gets the same memory as the dense cache would, pass num_blocks to set a budget
+            num_blocks = num_blocks if num_blocks is not None else max_batch_size * -(-kv_kwargs["seq_len"] // block_size)
+            self.kv_cache = PagedKVCache(num_blocks=num_blocks, block_size=block_size, **kv_kwargs)
+        else:
+            # sliding-window layers only keep their window (plus room for rolled back drafts) in a ring buffer,
+            # unless rows evict positions (the cache is bounded then anyway)
+            window_sizes = getattr(self.model, "window_sizes", None) if not attention_sinks else None
+            shift_keys = self.model.shift_rotary if attention_sinks else None
+            self.kv_cache = KVCache(**kv_kwargs, window_sizes=window_sizes, ring_margin=self.lookahead,
+                                    attention_sinks=attention_sinks, shift_keys=shift_keys)
+        assert paged or not prefix_cache, "the prefix cache shares blocks, it needs paged=True"
+        assert paged or not cascade, "cascade attention reads shared blocks, it needs paged=True"
+        self.prefix_cache = PrefixCache(self.kv_cache, prefix_cache_blocks) if prefix_cache else None
+        if draft_model is not None:
+            d = draft_model.config
+            self.draft_kv_cache = KVCache(
+                batch_size=max_batch_size,
+                seq_len=kv_kwargs["seq_len"],
+                num_heads=d.n_kv_head,
+                head_dim=d.n_embd // d.n_head,
+                num_layers=d.n_layer,
+                device=self.device,
+                dtype=dtype,
+                window_sizes=getattr(draft_model, "window_sizes", None),
+                ring_margin=self.lookahead,
+                pool=kv_pool,
+            )
+        self.num_drafted = 0 # speculative decoding stats: draft tokens proposed
+        self.num_accepted = 0 # and kept
+        self.waiting = deque() # Requests not yet admitted (and preempted RowStates waiting to resume)
+        self.prefill_chunk_size = prefill_chunk_size # max prompt tokens prefilled per step (None = no limit)
+        if attention_sinks:
+            # a chunk must fit next to the sinks and keep some of the window as context
+            self.prefill_chunk_size = min(prefill_chunk_size or self.max_seq_len, (self.max_seq_len - attention_sinks) // 2)
+        self.prefilling = None # the waiting item being prefilled, into row len(self.rows)
+        self.num_prefilled = 0 # how many of its tokens are in the cache so far
+        self.rows = [] # Active rows, self.rows[i] lives in row i of the KV cache
+        # Sampling settings of row i at [i] (a disabled setting holds its neutral value), moved along with the rows
+        self.sampling = {name: torch.full((max_batch_size,), value, dtype=torch.float32, device=self.device)
+                         for name, value in SAMPLING_DEFAULTS.items()}
+        self.host_sampling = {name: [value] * max_batch_size for name, value in SAMPLING_DEFAULTS.items()} # same, on the host
+        self.num_using = dict.fromkeys(SAMPLING_DEFAULTS, 0) # active rows that have each setting on
+        self.host_logprobs = [None] * max_batch_size # logprobs setting of row i's request
+        self.pending_logprobs = [] # (states, token logprobs, top alternatives) recorded on the device, see flush_logprobs
+        self.rng_keys = torch.zeros(max_batch_size, dtype=torch.long, device=self.device) # random stream of row i
+        self.rng_steps = torch.zeros(max_batch_size, dtype=torch.long, device=self.device) # tokens row i emitted so far
+        # Decode state of row i on the device, so a plain decode step needs no per-row host work to build its input
+        # or to pick forced tokens: its last token, its next forced token (-1 if none) and how many tokens it may emit
+        self.last_tokens = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self.force_tokens = torch.full((max_batch_size,), -1, dtype=torch.long, device=self.device)
+        self.token_limits = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self.compiled_decode = compiled_decode
+        self.cascade = cascade
+        assert not (cascade and compiled_decode is not None), "cascade attention runs eagerly"
+        self.tool_executor = tool_executor
+        self.parked = torch.zeros(max_batch_size, dtype=torch.bool, device=self.device) # row i waits on a tool call
+        self.num_parked = 0 # active rows parked
+        self.step_time = 0.0 # seconds spent in step()
+        self.device_time = 0.0 # of which in model forwards and waiting for device results, the rest is host work
+        self.num_steps = 0
+        self.token_counts = None # (max_batch_size, vocab_size) generated token counts for the penalties, created on first use
+        self.token_flags = None # (vocab_size,) TOOL_TOKEN / END_TOKEN bits of every token, created on first use
+        # The grammars of the requests so far stacked into one table, state 0 being "unconstrained" (every token allowed),
+        # so every row indexes its allowed tokens and next state with its own state: see _grammar_start
+        self.grammar_offsets = {} # Grammar -> its state 0 in the tables
+        self.grammar_next = self.grammar_allowed = self.grammar_final = None # created on first use
+        self.grammar_states = torch.zeros(max_batch_size, dtype=torch.long, device=self.device) # grammar state of row i
+        self.num_constrained = 0 # active rows with a grammar
+        self.emitted = [] # (row, token) emitted this step, counted at the end of it
+        # Get the special tokens we need to coordinate the tool use state machine
+        get_special = lambda s: self.tokenizer.encode_special(s)
+        self.python_start = get_special("<|python_start|>")
+        self.python_end = get_special("<|python_end|>")
+        self.output_start = get_special("<|output_start|>")
+        self.output_end = get_special("<|output_end|>")
+        self.assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
+        self.bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
+
+    def add_request(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, **sampling):
+        """
+        Queue a prompt for generation. It joins the batch at the next step() with enough free rows.
+        grammar (a Grammar, or a regex compiled for the tokenizer) constrains the samples to match it.
+        """
+        assert 1 <= num_samples <= self.max_batch_size, "num_samples must fit in the batch"
+        assert len(tokens) < self.max_seq_len or self.attention_sinks, "prompt does not fit in the KV cache"
+        if sampling.get("grammar") is not None:
+            if self.speculative:
+                raise ValueError("constrained decoding samples one token per step: not with draft_model or prompt_lookup")
+            if isinstance(sampling["grammar"], str):
+                sampling["grammar"] = compile_grammar(sampling["grammar"], self.tokenizer)
+        request = Request(tokens, num_samples, max_tokens, temperature, top_k, seed, **sampling)
+        self.waiting.append(request)
+        return request
+
+    @torch.inference_mode()
+    def cancel(self, request):
+        """Drop a request, e.g. because the client went away. Its rows leave the batch right away."""
+        for item in list(self.waiting):
+            if item is request or getattr(item, "request", None) is request:
+                self.waiting.remove(item)
+                if isinstance(item, RowState):
+                    self._drop_tool_call(item)
+        if self.prefilling is request or getattr(self.prefilling, "request", None) is request:
+            self.kv_cache.free_row(len(self.rows))
+            self.prefilling = None
+        for i in reversed(range(len(self.rows))):
+            if self.rows[i].request is request:
+                self._retire(i)
+
+    def has_work(self):
+        return len(self.rows) > 0 or len(self.waiting) > 0 or self.prefilling is not None
+
+    def warmup(self, batch_sizes=None):
+        """Compile the decode step for these numbers of active rows (default: all), before any request comes in."""
+        assert self.compiled_decode is not None, "the scheduler was created without compiled_decode"
+        assert not self.has_work(), "warm up an idle scheduler"
+        self.compiled_decode.warmup(self.kv_cache, batch_sizes or range(1, self.max_batch_size + 1))
+
+    def release(self):
+        """Give the KV cache storage back to the kv_pool (if any), for the next scheduler. This one is done."""
+        assert not self.has_work(), "release an idle scheduler"
+        self.kv_cache.release()
+        if self.draft_model is not None:
+            self.draft_kv_cache.release()
+
+    @property
+    def host_time(self):
+        """Seconds step() spent on host work: everything but model forwards and waiting for the device."""
+        return self.step_time - self.device_time
+
+    @property
+    def num_active(self):
+        return len(self.rows)
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        Advance every active row by one token (or more, when speculating) and admit waiting requests.
+        Returns a list of (row_state, token, mask) for the tokens emitted in this step, in order,
+        where mask is 1 if the token was sampled and 0 if it was forced by the tool.
+        """
+        # 1) Advance the active rows: forward the last emitted token of every row, all rows at their own
+        # position, or verify a few drafted tokens per row at once
+        t0 = time.perf_counter()
+        events, logits = [], []
+        if self.num_parked > 0:
+            self._poll_tools()
+        self._reserve_decode()
+        n = len(self.rows)
+        if n > 0 and self.speculative:
+            events.extend(self._speculate(n))
+        elif n > 0:
+            ids = self.last_tokens[:n].unsqueeze(1) # (n, 1), already on the device
+            if self.compiled_decode is not None:
+                logits.append(self._device(self.compiled_decode, ids, self.kv_cache.rows(0, n))) # (n, vocab_size)
+            else:
+                kv_cache = self.kv_cache.rows(0, n)
+                if self.cascade:
+                    kv_cache.cascade = self.kv_cache.shared_prefixes(0, n)
+                logits.append(self._device(self.model.forward, ids, kv_cache=kv_cache)[:, -1, :])
+            if self.num_parked > 0: # parked rows forwarded their last token again, they stay at their position
+                self.kv_cache.cache_seqlens[:n] -= self.parked[:n].int()
+                self.kv_cache.host_seqlens[[i for i, state in enumerate(self.rows) if state.tool_call is not None]] -= 1
+        first = n if self.speculative else 0 # rows [first, ...) sample their next token from logits
+        # 2) Admit waiting requests (FIFO) into the free rows at the end of the batch, prefilling
+        # at most prefill_chunk_size prompt tokens in this step (a long prompt continues next step)
+        budget = self.prefill_chunk_size or float("inf")
+        while budget > 0:
+            if self.prefilling is None:
+                if not self.waiting:
+                    break
+                prefilled = self._prefill_many(budget) # several whole prompts in one forward, if they fit
+                if prefilled is not None:
+                    logits.extend(prefilled[0])
+                    budget -= prefilled[1]
+                    continue
+                item = self.waiting[0]
+                if isinstance(item, RowState): # a preempted row, resumes with its tokens so far
+                    num_rows, num_tokens = 1, len(item.current_tokens)
+                else:
+                    num_rows, num_tokens = item.num_samples, len(item.tokens)
+                if len(self.rows) + num_rows > self.max_batch_size or not self.kv_cache.can_fit(num_tokens, num_rows):
+                    break
+                self._start_prefill(self.waiting.popleft())
+            tokens = self._prefill_tokens(self.prefilling)
+            chunk = tokens[self.num_prefilled:self.num_prefilled + min(budget, len(tokens) - self.num_prefilled)]
+            ids = torch.tensor([chunk], dtype=torch.long, device=self.device)
+            row = len(self.rows)
+            if self.attention_sinks:
+                self.kv_cache.make_room(row, len(chunk))
+            chunk_logits = self._device(self.model.forward, ids, kv_cache=self.kv_cache.rows(row, row + 1), logit_positions=1)
+            self.num_prefilled += len(chunk)
+            budget -= len(chunk)
+            if self.num_prefilled == len(tokens):
+                item, self.prefilling = self.prefilling, None
+                logits.append(self._finish_prefill(item, chunk_logits[:, -1, :]))
+
+        if len(self.rows) > first:
+            logits = torch.cat(logits, dim=0)
+            # 3) Sample the next token for each row, all rows at once with their own settings
+            end = len(self.rows)
+            probs = token_probs(logits, **self._sampling_args(first, end, logits.size(-1)))
+            sampled = sample_from_probs(probs, self._uniforms(first, end, RNG_SAMPLE))
+            # 4) Process each row: choose the next token, update state, optional tool use
+            events.extend(self._emit_batch(first, end, sampled, logits))
+
+        # 5) Count the emitted tokens (penalties), and finished rows leave the batch right away
+        self._count_emitted()
+        for i in reversed(range(len(self.rows))):
+            if self.rows[i].finished:
+                self._retire(i)
+        self.step_time += time.perf_counter() - t0
+        self.num_steps += 1
+        return events
+
+    def _device(self, fn, *args, **kwargs):
+        """Call fn (a model forward, or a device -> host copy), counting its time as device time."""
+        t0 = time.perf_counter()
+        out = fn(*args, **kwargs)
+        self.device_time += time.perf_counter() - t0
+        return out
+
+    def _emit_batch(self, start, end, sampled, logits):
+        """
+        Emit the next token of rows [start, end) given their sampled tokens (on the device), like _emit for every row,
+        but with forced tokens, special tokens and the end of rows worked out with masks on the device. The host only
+        appends the tokens, and runs the tool state machine for the rows that are forced or hit a tool token.
+        """
+        forced = self.force_tokens[start:end]
+        is_forced = forced >= 0
+        tokens = torch.where(is_forced, forced, sampled)
+        emits = 1
+        if self.num_parked > 0: # parked rows emit nothing, they keep their last token
+            parked = self.parked[start:end]
+            tokens = torch.where(parked, self.last_tokens[start:end], tokens)
+            emits = (~parked).long()
+        self.last_tokens[start:end] = tokens
+        self.rng_steps[start:end] += emits
+        self.token_counts[torch.arange(start, end, device=self.device), tokens] += emits
+        out_of_tokens = self.rng_steps[start:end] >= self.token_limits[start:end]
+        flags = self.token_flags[tokens] + FORCED_TOKEN * is_forced + OUT_OF_TOKENS * out_of_tokens + PARKED * (1 - emits)
+        if self.num_constrained > 0:
+            # sampled tokens move the rows along their grammar (forced tool output is not part of the constrained text),
+            # and a row whose text is a match that nothing could extend is done
+            states = self.grammar_states[start:end]
+            states = torch.where(is_forced | (emits == 0), states, self.grammar_next[states, tokens].long())
+            self.grammar_states[start:end] = states
+            flags = flags | END_TOKEN * self.grammar_final[states]
+        rows = self._device(torch.stack([tokens, flags], dim=1).tolist) # the one device -> host copy of the step
+        events, refills, parks, scored = [], [], [], []
+        for i, (token, flag) in enumerate(rows, start=start):
+            if flag & PARKED:
+                continue
+            state = self.rows[i]
+            if self.host_logprobs[i] is not None:
+                scored.append(i)
+            state.current_tokens.append(token)
+            state.num_generated += 1
+            if flag & (FORCED_TOKEN | TOOL_TOKEN) or state.in_python_block:
+                if flag & FORCED_TOKEN:
+                    state.forced_tokens.popleft() # already picked on the device
+                self._run_tool(state, token)
+                refills.append((i, state.forced_tokens[0] if state.forced_tokens else -1))
+                if state.tool_call is not None:
+                    parks.append(i)
+            state.completed = bool(flag & END_TOKEN)
+            state.finished = bool(flag & (END_TOKEN | OUT_OF_TOKENS))
+            events.append((state, token, 0 if flag & FORCED_TOKEN else 1))
+        if refills:
+            refill_rows, refill_tokens = zip(*refills)
+            self.force_tokens[list(refill_rows)] = torch.tensor(refill_tokens, device=self.device)
+        if parks:
+            self.parked[parks] = True
+            self.num_parked += len(parks)
+        if scored:
+            index = torch.tensor(scored, device=self.device) - start
+            self._record_logprobs([self.rows[i] for i in scored], logits[index], tokens[index])
+        return events
+
+    def _record_logprobs(self, states, logits, tokens):
+        """Keep the logprobs of tokens (m,) emitted by states, given the logits (m, vocab_size) they came from, on the device."""
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        token_logprobs = logprobs.gather(1, tokens.unsqueeze(1)).squeeze(1)
+        num_top = max(state.request.logprobs for state in states)
+        top = logprobs.topk(num_top, dim=-1) if num_top > 0 else None
+        self.pending_logprobs.append((states, token_logprobs, top))
+
+    def flush_logprobs(self):
+        """Append the logprobs recorded since the last call to the state.logprobs of their rows (in the order emitted)."""
+        if not self.pending_logprobs:
+            return
+        records, self.pending_logprobs = self.pending_logprobs, []
+        def to_host():
+            return [(lp.tolist(), None if top is None else (top.values.tolist(), top.indices.tolist())) for _, lp, top in records]
+        for (states, _, _), (logprobs, top) in zip(records, self._device(to_host)):
+            for j, (state, logprob) in enumerate(zip(states, logprobs)):
+                n = state.request.logprobs
+                state.logprobs.append((logprob, list(zip(top[1][j][:n], top[0][j][:n])) if n else []))
+
+    def idle_on_tools(self):
+        """Whether a step could only spin: every active row is parked on a running tool call and no request is waiting."""
+        if self.num_parked < len(self.rows) or self.waiting or self.prefilling is not None:
+            return False
+        now = time.monotonic()
+        return not any(state.tool_call.done() or now >= state.tool_deadline for state in self.rows)
+
+    def _poll_tools(self):
+        """Unpark the rows whose tool call is done (or timed out), forcing in the results. Waits if no row could decode."""
+        pending = [(i, state) for i, state in enumerate(self.rows) if state.tool_call is not None]
+        if self.idle_on_tools():
+            # sleep until a call is done instead of spinning on the parked rows (not host work either)
+            deadline = min(state.tool_deadline for _, state in pending)
+            timeout = max(deadline - time.monotonic(), 0)
+            self._device(wait, [state.tool_call for _, state in pending], timeout=timeout, return_when=FIRST_COMPLETED)
+        now = time.monotonic()
+        done = [(i, state) for i, state in pending if state.tool_call.done() or now >= state.tool_deadline]
+        if not done:
+            return
+        for i, state in done:
+            self._force_result(state, self._tool_result(state.tool_call))
+            self._drop_tool_call(state)
+        rows = [i for i, _ in done]
+        self.parked[rows] = False
+        self.num_parked -= len(rows)
+        self.force_tokens[rows] = torch.tensor([state.forced_tokens[0] if state.forced_tokens else -1 for _, state in done], device=self.device)
+
+    @staticmethod
+    def _tool_result(call, timeout=0):
+        """The result of a tool call, None if it failed or is not done within timeout seconds."""
+        try:
+            return call.result(timeout=timeout)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _drop_tool_call(state):
+        if state.tool_call is not None:
+            state.tool_call.cancel() # a no-op if it is already running, its result is just never used
+            state.tool_call = None
+
+    def _sampling_args(self, start, end, vocab_size):
+        """token_probs settings of rows [start, end), leaving out the settings no row has on."""
+        args = {name: values[start:end] for name, values in self.sampling.items() if self.num_using[name] > 0}
+        args["temperature"] = self.sampling["temperature"][start:end]
+        if self.token_counts is None:
+            self.token_counts = torch.zeros(self.max_batch_size, vocab_size, dtype=torch.float32, device=self.device)
+            self.token_flags = torch.zeros(vocab_size, dtype=torch.long, device=self.device)
+            self.token_flags[[self.python_start, self.python_end]] = TOOL_TOKEN
+            self.token_flags[[self.assistant_end, self.bos]] = END_TOKEN
+        if "repetition_penalty" in args or "frequency_penalty" in args:
+            args["counts"] = self.token_counts[start:end]
+        if self.num_constrained > 0:
+            args["allowed"] = self.grammar_allowed[self.grammar_states[start:end]]
+        if "top_k" in args or "top_p" in args:
+            # the sort width from the host copies, so token_probs does not read it back from the device
+            top_ks, top_ps = self.host_sampling["top_k"][start:end], self.host_sampling["top_p"][start:end]
+            args["num_candidates"] = [_num_candidates(k, p, vocab_size) for k, p in zip(top_ks, top_ps)]
+        return args
+
+    def _uniforms(self, start, end, stream, num=None, offset=0):
+        """
+        Uniforms for rows [start, end) from their own random streams: (end - start,) for the next token of every row,
+        or (end - start, num) for its next num tokens. offset skips that many tokens ahead.
+        """
+        keys, counters = self.rng_keys[start:end], self.rng_steps[start:end] + offset
+        if num is not None:
+            keys, counters = keys.unsqueeze(1), counters.unsqueeze(1) + torch.arange(num, device=self.device)
+        return counter_uniforms(keys, counters, stream)
+
+    def _set_sampling(self, start, item):
+        """Rows [start, start + num rows) now sample for item (the rows of a new Request, or a resumed RowState)."""
+        if isinstance(item, RowState):
+            request, samples, step = item.request, torch.tensor([item.sample_idx], device=self.device), item.num_generated
+        else:
+            request, samples, step = item, torch.arange(item.num_samples, device=self.device), 0
+        end = start + len(samples)
+        self.rng_keys[start:end] = rng_keys(request.seed, samples + request.first_sample)
+        self.rng_steps[start:end] = step
+        max_tokens = request.max_tokens if request.max_tokens is not None else self.max_seq_len
+        self.token_limits[start:end] = max_tokens if self.attention_sinks else min(max_tokens, self.max_seq_len + 1 - len(request.tokens))
+        forced = item.forced_tokens[0] if isinstance(item, RowState) and item.forced_tokens else -1
+        self.force_tokens[start:end] = forced
+        self.parked[start:end] = False
+        for name, value in request.sampling().items():
+            setting = value if value is not None else SAMPLING_DEFAULTS[name]
+            self.sampling[name][start:end] = setting
+            self.host_sampling[name][start:end] = [setting] * (end - start)
+            self.num_using[name] += (end - start) * (value is not None)
+        self.host_logprobs[start:end] = [request.logprobs] * (end - start)
+        self.grammar_states[start:end] = 0
+        if request.grammar is not None:
+            resumed = isinstance(item, RowState) and item.grammar_state is not None
+            self.grammar_states[start:end] = item.grammar_state if resumed else self._grammar_start(request.grammar)
+            self.num_constrained += end - start
+
+    def _grammar_start(self, grammar):
+        """The start state of grammar in the stacked tables, adding its tables the first time it is used."""
+        if grammar not in self.grammar_offsets:
+            if self.grammar_next is None:
+                V = grammar.vocab_size
+                self.grammar_next = torch.zeros(1, V, dtype=torch.int32, device=self.device)
+                self.grammar_allowed = torch.ones(1, V, dtype=torch.bool, device=self.device)
+                self.grammar_final = torch.zeros(1, dtype=torch.bool, device=self.device)
+            offset = self.grammar_next.size(0)
+            self.grammar_next = torch.cat([self.grammar_next, grammar.next_states.to(self.device) + offset])
+            self.grammar_allowed = torch.cat([self.grammar_allowed, grammar.allowed.to(self.device)])
+            self.grammar_final = torch.cat([self.grammar_final, grammar.final.to(self.device)])
+            self.grammar_offsets[grammar] = offset
+        return self.grammar_offsets[grammar] + grammar.start
+
+    def _count_emitted(self):
+        if self.emitted:
+            rows, tokens = zip(*self.emitted)
+            index = (torch.tensor(rows, device=self.device), torch.tensor(tokens, device=self.device))
+            self.token_counts.index_put_(index, torch.ones(len(rows), device=self.device), accumulate=True)
+            self.rng_steps.index_put_(index[:1], torch.ones(len(rows), dtype=torch.long, device=self.device), accumulate=True)
+            self.emitted = []
+
+    def _emit(self, i, sampled_token):
+        """Append the next token to row i (see _process_token) and check whether the row is done."""
+        state = self.rows[i]
+        token, mask = self._process_token(state, sampled_token)
+        self.emitted.append((i, token))
+        state.num_generated += 1
+        max_tokens = state.request.max_tokens
+        state.finished = (
+            state.completed
+            or (max_tokens is not None and state.num_generated >= max_tokens)
+            or len(state.current_tokens) > self.max_seq_len # no room left to forward the next token
         )
-        kv_cache_decode.prefill(kv_cache_prefill)
-        del kv_cache_prefill # no need to keep this memory around
+        return state, token, mask
+
+    def _speculate(self, n):
+        """
+        Speculative step for rows [0, n): draft k tokens per row, score [last token, drafts] with one
+        forward of the model, then walk each row's drafts and keep draft j with probability
+        min(1, p(d_j) / q(d_j)). The first rejected draft is replaced by a sample from the leftover
+        mass max(p - q, 0), and if all k are kept a bonus token is sampled from the last position.
+        This is standard rejection sampling, the tokens are distributed exactly as without drafts.
+        Forced tokens are emitted as usual, a row stops as soon as a token differs from its draft
+        (the cache only holds the drafts), and the cache is rolled back to the tokens kept.
+        """
+        k = self.num_draft_tokens
+        drafts, draft_probs = self._lookup(n) if self.draft_model is None and self.draft_layers is None else self._draft(n) # (n, k), (n, k, vocab_size)
+        last = torch.tensor([[state.current_tokens[-1]] for state in self.rows[:n]], dtype=torch.long, device=self.device)
+        logits = self._device(self.model.forward, torch.cat([last, drafts], dim=1), kv_cache=self.kv_cache.rows(0, n)) # (n, k+1, vocab_size)
+        args = self._sampling_args(0, n, logits.size(-1))
+        if "counts" in args:
+            # position j comes after drafts[:j], which count towards the penalties too
+            seen = torch.cat([torch.zeros_like(logits[:, :1]), F.one_hot(drafts, logits.size(-1)).float().cumsum(dim=1)], dim=1)
+            args["counts"] = args["counts"].unsqueeze(1) + seen
+        p = token_probs(logits, **args) # (n, k+1, vocab_size)
+        q = draft_probs if draft_probs is not None else F.one_hot(drafts, p.size(-1)).float()
+        d = drafts.unsqueeze(-1)
+        ratio = (p[:, :k].gather(-1, d) / q.gather(-1, d)).squeeze(-1)
+        accepted = self._uniforms(0, n, RNG_ACCEPT, k) < ratio
+        residual = (p[:, :k] - q).clamp(min=0)
+        residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, p[:, :k]) # p == q: any draft is kept
+        resampled = sample_from_probs(torch.cat([residual, p[:, k:]], dim=1), self._uniforms(0, n, RNG_SAMPLE, k + 1))
+        accepted, resampled, drafts = self._device(lambda: (accepted.tolist(), resampled.tolist(), drafts.tolist()))
+
+        events, scored = [], []
+        for i, state in enumerate(self.rows[:n]):
+            num_tokens = len(state.current_tokens)
+            for j in range(k + 1):
+                token = drafts[i][j] if j < k and accepted[i][j] else resampled[i][j]
+                events.append(self._emit(i, token)) # a forced token takes precedence, as always
+                if state.finished or j == k or state.current_tokens[-1] != drafts[i][j]:
+                    break
+            num_emitted = len(state.current_tokens) - num_tokens
+            self.num_drafted += k
+            self.num_accepted += num_emitted - 1
+            state.draft_len = num_tokens + min(num_emitted - 1, k - 1) # the draft cache saw the kept drafts, but not the last one
+            if self.host_logprobs[i] is not None: # emitted token j came from the logits at position j
+                scored.extend((i, j, token) for j, token in enumerate(state.current_tokens[num_tokens:]))
+        if scored:
+            rows, positions, tokens = (torch.tensor(x, device=self.device) for x in zip(*scored))
+            self._record_logprobs([self.rows[i] for i, _, _ in scored], logits[rows, positions], tokens)
+        # Roll back: every row keeps the KV of all its tokens but the last emitted one
+        seqlens = [len(state.current_tokens) - 1 for state in self.rows[:n]]
+        self.kv_cache.set_pos(0, seqlens)
+        # this path runs on the host, bring the rows' device decode state up to date
+        self.last_tokens[:n] = torch.tensor([state.current_tokens[-1] for state in self.rows[:n]], device=self.device)
+        self.force_tokens[:n] = torch.tensor([state.forced_tokens[0] if state.forced_tokens else -1 for state in self.rows[:n]], device=self.device)
+        return events
 
-        # 3) Initialize states for each sample
-        row_states = [RowState(tokens.copy()) for _ in range(num_samples)]
+    def _lookup(self, n):
+        """
+        Prompt lookup drafts for rows [0, n): each row's forced tokens, then the continuation of the latest
+        earlier occurrence of its last tokens (see NgramIndex), padded to num_draft_tokens by repeating.
+        Returns the drafts (n, k) and None for their distributions: the drafts are deterministic (one-hot).
+        """
+        k = self.num_draft_tokens
+        drafts = []
+        for state in self.rows[:n]:
+            tokens = state.current_tokens + list(state.forced_tokens)[:k]
+            guess = tokens[len(state.current_tokens):]
+            guess += state.ngram_index.propose(tokens, k - len(guess))
+            guess += [guess[-1] if guess else tokens[-1]] * (k - len(guess))
+            drafts.append(guess)
+        return torch.tensor(drafts, dtype=torch.long, device=self.device), None
+
+    def _draft(self, n):
+        """
+        Propose num_draft_tokens tokens for each of rows [0, n) with the draft model, or the first draft_layers blocks.
+        Returns the drafts (n, k) and the distributions they were sampled from (n, k, vocab_size).
+        """
+        rows = self.rows[:n]
+        if self.draft_layers is not None:
+            # early exit: the cache holds the first layers of every token but the last one, which the verifying forward
+            # starts from again, rewriting the draft positions of those layers with the same KV
+            cache, forward = self.kv_cache, functools.partial(self.model.forward, num_layers=self.draft_layers)
+            last = torch.tensor([[state.current_tokens[-1]] for state in rows], dtype=torch.long, device=self.device)
+            logits = self._device(forward, last, kv_cache=cache.rows(0, n))[:, -1, :]
+            drafts, probs = self._sample_drafts(n, logits, forward, cache)
+            cache.set_pos(0, [len(state.current_tokens) - 1 for state in rows])
+            return drafts, probs
+        cache = self.draft_kv_cache
+        # Catch up on the tokens the draft model has not seen yet: 1 or 2 after a speculative step, whole prompts for new rows
+        for i, state in enumerate(rows):
+            if len(state.current_tokens) - state.draft_len > 2:
+                cache.set_pos(i, [state.draft_len])
+                ids = torch.tensor([state.current_tokens[state.draft_len:-1]], dtype=torch.long, device=self.device)
+                self._device(self.draft_model.forward, ids, kv_cache=cache.rows(i, i + 1), logit_positions=1)
+                state.draft_len = len(state.current_tokens) - 1
+        missing = [len(state.current_tokens) - state.draft_len for state in rows]
+        T = max(missing)
+        ids = [state.current_tokens[state.draft_len:] + [0] * (T - m) for state, m in zip(rows, missing)] # right padded
+        cache.set_pos(0, [state.draft_len for state in rows])
+        last = torch.tensor(missing, device=self.device).unsqueeze(1) - 1 # last real position of each row
+        ids = torch.tensor(ids, dtype=torch.long, device=self.device)
+        logits = self._device(self.draft_model.forward, ids, kv_cache=cache.rows(0, n), logit_positions=last)[:, 0, :] # (n, vocab_size)
+        cache.set_pos(0, [len(state.current_tokens) for state in rows])
+        return self._sample_drafts(n, logits, self.draft_model.forward, cache)
+
+    def _sample_drafts(self, n, logits, forward, cache):
+        """Sample the drafts of rows [0, n) from the draft logits of their next token, forwarding each through forward."""
+        k = self.num_draft_tokens
+        # Tokens a row is forced to emit next are its drafts, so the draft model continues from the right context
+        forced = {i: list(state.forced_tokens)[:k] for i, state in enumerate(self.rows[:n]) if state.forced_tokens}
+        args = self._sampling_args(0, n, logits.size(-1))
+        drafts, probs = [], []
+        for j in range(k):
+            q = token_probs(logits, **args)
+            d = sample_from_probs(q, self._uniforms(0, n, RNG_DRAFT, offset=j))
+            for i, tokens in forced.items():
+                if j < len(tokens):
+                    d[i] = tokens[j]
+            drafts.append(d)
+            probs.append(q)
+            if j < k - 1:
+                logits = self._device(forward, d.unsqueeze(1), kv_cache=cache.rows(0, n))[:, -1, :]
+        return torch.stack(drafts, dim=1), torch.stack(probs, dim=1)
+
+    def _reserve_decode(self):
+        """Make room for the next token of every row, preempting the most recently admitted rows if needed."""
+        if self.attention_sinks:
+            for i in range(len(self.rows)):
+                self.kv_cache.make_room(i, 1)
+            return
+        i = 0
+        while i < len(self.rows):
+            if self.kv_cache.reserve(i, len(self.rows[i].current_tokens) + self.lookahead):
+                i += 1
+                continue
+            assert len(self.rows) > 1, "KV cache is too small to hold even a single row"
+            last = len(self.rows) - 1
+            state = self.rows[last]
+            if state.request.grammar is not None:
+                state.grammar_state = int(self.grammar_states[last])
+            self._remove(last)
+            self.waiting.appendleft(state) # resumes first, as soon as there is room again
+
+    @staticmethod
+    def _prefill_tokens(item):
+        # a new Request prefills its prompt, a preempted row all its tokens (including the not yet forwarded last one)
+        return item.current_tokens if isinstance(item, RowState) else item.tokens
 
-        # 4) Main generation loop
-        num_generated = 0
-        while True:
-            # Stop condition: we've reached max tokens
-            if max_tokens is not None and num_generated >= max_tokens:
+    def _cached_prefix(self, tokens):
+        """Blocks of the longest cached prefix of tokens, leaving at least one token to forward for the last logits."""
+        return self.prefix_cache.match(tokens[:-1]) if self.prefix_cache is not None else []
+
+    def _start_prefill(self, item):
+        """Claim the next free row for a waiting item, starting from its longest cached prefix if there is one."""
+        row, tokens = len(self.rows), self._prefill_tokens(item)
+        self.num_prefilled = 0
+        if self.prefix_cache is not None:
+            blocks = self._cached_prefix(tokens)
+            self.kv_cache.attach(row, blocks)
+            self.num_prefilled = len(blocks) * self.kv_cache.block_size
+        assert self.kv_cache.reserve(row, len(tokens))
+        self.prefilling = item
+
+    def _prefill_many(self, budget):
+        """
+        Varlen prefill: admit the waiting items whose whole prompts fit in this step and forward them together, one row
+        each, right padded to the longest one. Causal attention never looks at the padding and every row then sits at
+        its own position, so the pad keys are simply overwritten as the row decodes. Returns (their logits, the number
+        of tokens forwarded), or None if fewer than two items fit: the one item path takes over (and chunks long prompts).
+        """
+        n = len(self.rows)
+        ring = getattr(self.kv_cache, "ring_size", 0) > 0 # padding would overwrite the kept slots of a ring: equal lengths only
+        group, prefixes, lengths, num_rows, width = [], [], [], [], 0
+        for item in self.waiting:
+            tokens = self._prefill_tokens(item)
+            blocks = self._cached_prefix(tokens)
+            cached = len(blocks) * self.kv_cache.block_size if blocks else 0
+            k = 1 if isinstance(item, RowState) else item.num_samples
+            T = max(width, len(tokens) - cached)
+            if n + sum(num_rows) + k > self.max_batch_size or (len(group) + 1) * T > budget:
                 break
-            # Stop condition: all rows are completed
-            if all(state.completed for state in row_states):
+            if ring and group and len(tokens) - cached != width:
                 break
+            starts = [len(b) * self.kv_cache.block_size if b else 0 for b in prefixes] + [cached]
+            if not self.kv_cache.can_fit_all([(start + T, rows) for start, rows in zip(starts, num_rows + [k])]):
+                break
+            group.append(item)
+            prefixes.append(blocks)
+            lengths.append(len(tokens) - cached)
+            num_rows.append(k)
+            width = T
+        if len(group) < 2:
+            return None
+        m = len(group)
+        for _ in range(m):
+            self.waiting.popleft()
+        # claim rows n, n + 1, ...: attach all the prefixes first, so reserving blocks never evicts one of them
+        starts = [len(blocks) * self.kv_cache.block_size if blocks else 0 for blocks in prefixes]
+        if self.prefix_cache is not None:
+            for j, blocks in enumerate(prefixes):
+                self.kv_cache.attach(n + j, blocks)
+        for j, start in enumerate(starts):
+            assert self.kv_cache.reserve(n + j, start + width)
+        ids = [self._prefill_tokens(item)[start:] + [self.bos] * (width - length) for item, start, length in zip(group, starts, lengths)]
+        ids = torch.tensor(ids, dtype=torch.long, device=self.device)
+        last = torch.tensor([[length - 1] for length in lengths], dtype=torch.long, device=self.device)
+        logits = self._device(self.model.forward, ids, kv_cache=self.kv_cache.rows(n, n + m), logit_positions=last)[:, 0, :]
+        self.kv_cache.set_pos(n, [start + length for start, length in zip(starts, lengths)])
+        # move every item to the first of the rows its samples take, last item first so no row is overwritten
+        firsts = [n + sum(num_rows[:j]) for j in range(m)]
+        for j in reversed(range(m)):
+            if firsts[j] != n + j:
+                self.kv_cache.move_row(n + j, firsts[j])
+        return [self._finish_prefill(item, logits[j:j + 1]) for j, item in enumerate(group)], m * width
+
+    def _finish_prefill(self, item, logits):
+        """The item's tokens are all in row len(self.rows): add its row(s) to the batch. Returns their logits."""
+        n, tokens = len(self.rows), self._prefill_tokens(item)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(tokens, self.kv_cache.row_blocks[n]) # concurrent requests can share it right away
+        self._set_sampling(n, item)
+        if self.token_counts is not None:
+            self.token_counts[n:n + (1 if isinstance(item, RowState) else item.num_samples)] = 0
+        if isinstance(item, RowState):
+            item.draft_len = 0 # its row in the draft cache is gone too
+            if self.token_counts is not None:
+                generated = item.current_tokens[len(item.request.tokens):]
+                self.token_counts[n].index_add_(0, torch.tensor(generated, dtype=torch.long, device=self.device),
+                                                torch.ones(len(generated), device=self.device))
+            if item.tool_call is not None:
+                # preempted while parked: park again, one position back so the next step forwards its last token
+                self.parked[n] = True
+                self.num_parked += 1
+                self.last_tokens[n] = item.current_tokens[-1]
+                self.kv_cache.set_pos(n, [len(item.current_tokens) - 1])
+            self.rows.append(item)
+            return logits
+        # a new request: clone the prefilled row into one row per sample
+        request, k = item, item.num_samples
+        if k > 1:
+            self.kv_cache.fork_row(n, n + 1, n + k)
+        request.rows = [RowState(request.tokens.copy(), request=request, sample_idx=j) for j in range(k)]
+        self.rows.extend(request.rows)
+        return logits.expand(k, -1) # (k, vocab_size)
+
+    def _retire(self, i):
+        """Row i is done: mark it finished and remove it from the batch."""
+        state = self.rows[i]
+        state.finished = True
+        if self.prefix_cache is not None:
+            # the last token was never forwarded, everything before it is in the cache
+            self.prefix_cache.insert(state.current_tokens[:-1], self.kv_cache.row_blocks[i])
+        self._remove(i)
+        self._drop_tool_call(state)
+
+    def _remove(self, i):
+        """Remove row i from the batch, moving the last row into its place to keep rows packed."""
+        last = len(self.rows) - 1
+        caches = [self.kv_cache] + ([self.draft_kv_cache] if self.draft_model is not None else [])
+        for cache in caches:
+            if i != last:
+                cache.move_row(last, i)
+            else:
+                cache.free_row(i)
+        for name, value in self.rows[i].request.sampling().items():
+            self.num_using[name] -= value is not None
+        self.num_parked -= self.rows[i].tool_call is not None
+        self.num_constrained -= self.rows[i].request.grammar is not None
+        per_row = [*self.sampling.values(), self.rng_keys, self.rng_steps, self.last_tokens, self.force_tokens, self.token_limits,
+                   self.parked, self.grammar_states]
+        for values in per_row + list(self.host_sampling.values()) + [self.host_logprobs] + ([self.token_counts] if self.token_counts is not None else []):
+            values[i] = values[last]
+        self.rows[i] = self.rows[last]
+        self.rows.pop()
+        if self.prefilling is not None:
+            self.kv_cache.move_row(last + 1, last) # keep the row being prefilled right after the active rows
+
+    def _process_token(self, state, sampled_token):
+        """Choose the next token of a row (sampled or forced), update its state and run the tool if needed."""
+        # Select the next token in this row
+        is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
+        mask = 0 if is_forced else 1 # mask is 0 if forced, 1 if sampled
+        next_token = state.forced_tokens.popleft() if is_forced else sampled_token
+        # Update the state of this row to include the next token
+        state.current_tokens.append(next_token)
+        # On <|assistant_end|> or <|bos|>, mark the row as completed
+        if next_token == self.assistant_end or next_token == self.bos:
+            state.completed = True
+        self._run_tool(state, next_token)
+        return next_token, mask
+
+    def _run_tool(self, state, next_token):
+        """The tool state machine: collect the python expression of a row and force the result after it."""
+        if next_token == self.python_start:
+            state.in_python_block = True
+            state.python_expr_tokens = []
+        elif next_token == self.python_end and state.in_python_block:
+            state.in_python_block = False
+            if state.python_expr_tokens:
+                expr = self.tokenizer.decode(state.python_expr_tokens)
+                if self.tool_executor is None:
+                    self._force_result(state, use_calculator(expr))
+                elif self.speculative:
+                    call = self.tool_executor.submit(expr)
+                    self._force_result(state, self._tool_result(call, self.tool_executor.timeout))
+                else:
+                    # the row is parked until the call is done, see _poll_tools
+                    state.tool_call = self.tool_executor.submit(expr)
+                    state.tool_deadline = time.monotonic() + self.tool_executor.timeout
+            state.python_expr_tokens = []
+        elif state.in_python_block:
+            state.python_expr_tokens.append(next_token)
+
+    def _force_result(self, state, result):
+        """Queue the tool result (if any) as the next forced tokens of the row."""
+        if result is not None:
+            result_tokens = self.tokenizer.encode(str(result))
+            state.forced_tokens.append(self.output_start)
+            state.forced_tokens.extend(result_tokens)
+            state.forced_tokens.append(self.output_end)
+
+class Engine:
+
+    def __init__(self, model, tokenizer, prefix_cache_tokens=0, block_size=256, draft_model=None, prompt_lookup=False, num_draft_tokens=4,
+                 prefill_chunk_size=None, quantize_kv=False, tool_executor=None, compile_decode=False, cascade=False,
+                 attention_sinks=0, draft_layers=None, kv_pool_bytes=1 << 30):
+        self.model = model
+        self.tokenizer = tokenizer # needed for tool use
+        # Speculative decoding: drafts from an optional smaller model sharing the tokenizer (e.g. a d6 for a d26),
+        # from n-gram lookups in the row's own tokens (prompt_lookup), or from the first draft_layers blocks of the model
+        self.draft_model = draft_model
+        self.prompt_lookup = prompt_lookup
+        self.draft_layers = draft_layers
+        self.num_draft_tokens = num_draft_tokens
+        self.num_drafted = 0 # speculative decoding stats over all generate() calls: draft tokens proposed
+        self.num_accepted = 0 # and kept
+        self.num_steps = 0 # scheduler steps over all generate() calls
+        self.step_time = 0.0 # and the seconds they took
+        self.host_time = 0.0 # of which host work (see BatchScheduler.host_time)
+        self.prefill_chunk_size = prefill_chunk_size # feed long prompts in chunks of this many tokens, caps prefill memory
+        self.quantize_kv = quantize_kv # int8 KV cache
+        self.tool_executor = tool_executor # run tool calls on a ToolExecutor's pool instead of inline
+        # Compiled decode steps (see warmup): generate() then uses a fixed capacity cache of sequence_len tokens
+        self.compiled_decode = CompiledDecode(model) if compile_decode else None
+        # Cascade attention (see BatchScheduler): generate() then runs on a paged cache that holds the prompt once
+        # and num_samples private suffixes, instead of num_samples copies of the whole sequence
+        self.cascade = cascade
+        assert not (cascade and compile_decode), "cascade attention runs eagerly"
+        # Attention sinks (see BatchScheduler): generate() then takes conversations of any length, on a cache of at most
+        # sequence_len positions that evicts all but the first attention_sinks and the most recent ones
+        self.attention_sinks = attention_sinks
+        assert not (attention_sinks and (cascade or prefix_cache_tokens or quantize_kv or draft_model is not None or prompt_lookup or draft_layers)), \
+            "attention sinks need a plain dense cache"
+        # With prefix_cache_tokens > 0, generate() runs on one persistent paged scheduler whose prefix
+        # cache keeps up to that many tokens of past prompts around, so calls that share a prefix
+        # (e.g. the same question sampled over and over) only prefill what is new
+        self.prefix_cache_tokens = prefix_cache_tokens
+        self.block_size = block_size
+        self._scheduler = None
+        # Every other generate call gets a scheduler of its own, with KV caches carved out of this pool of storage
+        # recycled from the previous calls (same capacity class), so loops over prompts don't allocate every call.
+        # Loops over many shapes would keep the storage of every class they ever used, so the pool holds at most
+        # kv_pool_bytes of it between calls (None: no limit), the least recently used class dropped first
+        self.kv_pool = KVPool(max_bytes=kv_pool_bytes)
+
+    def _cached_scheduler(self, num_samples, max_seq_len):
+        """The persistent prefix caching scheduler, (re)created when a call needs more rows or a longer sequence."""
+        s = self._scheduler
+        if s is None or s.max_batch_size < num_samples or s.max_seq_len < max_seq_len:
+            bs = self.block_size
+            max_batch_size = max(num_samples, s.max_batch_size if s is not None else 1)
+            max_seq_len = max(max_seq_len, self.model.config.sequence_len, s.max_seq_len if s is not None else 0)
+            cache_blocks = -(-self.prefix_cache_tokens // bs)
+            num_blocks = cache_blocks + max_batch_size * -(-max_seq_len // bs) # cache budget + room for the rows
+            self._scheduler = BatchScheduler(
+                self, max_batch_size, max_seq_len, paged=True, num_blocks=num_blocks, block_size=bs,
+                prefix_cache=True, prefix_cache_blocks=cache_blocks,
+                draft_model=self.draft_model, prompt_lookup=self.prompt_lookup, draft_layers=self.draft_layers, num_draft_tokens=self.num_draft_tokens,
+                prefill_chunk_size=self.prefill_chunk_size, quantize_kv=self.quantize_kv, tool_executor=self.tool_executor,
+                compiled_decode=self.compiled_decode, cascade=self.cascade,
+            )
+        return self._scheduler
+
+    def clear_prefix_cache(self):
+        """Forget all cached prefixes. Call this whenever the model weights change (e.g. in RL)."""
+        if self._scheduler is not None:
+            self._scheduler.prefix_cache.clear()
+
+    def scheduler(self, max_batch_size=8, max_seq_len=None, **kwargs):
+        """Create a BatchScheduler for serving many concurrent requests with this model."""
+        kwargs.setdefault("draft_model", self.draft_model)
+        kwargs.setdefault("prompt_lookup", self.prompt_lookup)
+        kwargs.setdefault("draft_layers", self.draft_layers)
+        kwargs.setdefault("prefill_chunk_size", self.prefill_chunk_size)
+        kwargs.setdefault("quantize_kv", self.quantize_kv)
+        kwargs.setdefault("num_draft_tokens", self.num_draft_tokens)
+        kwargs.setdefault("tool_executor", self.tool_executor)
+        kwargs.setdefault("compiled_decode", self.compiled_decode)
+        kwargs.setdefault("attention_sinks", self.attention_sinks)
+        if self.cascade:
+            kwargs.setdefault("paged", True)
+            kwargs.setdefault("block_size", self.block_size)
+            kwargs.setdefault("cascade", True)
+        return BatchScheduler(self, max_batch_size=max_batch_size, max_seq_len=max_seq_len, **kwargs)
+
+    @torch.inference_mode()
+    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, logprobs=None, **sampling):
+        """
+        Stream num_samples completions of a single prompt, yielding one (token_column, token_masks) per step.
+        Further sampling settings (top_p, min_p, repetition_penalty, frequency_penalty) are passed on to the Request.
+        grammar (a Grammar, or a regex compiled for the tokenizer, see nanochat/grammar.py) masks every token that
+        would keep a sample from matching it, and a sample ends as soon as its text is a match nothing could extend.
+        With logprobs=N it yields (token_column, token_masks, logprob_column) instead, logprob_column holding the
+        (logprob, [(token, logprob)] of the N most likely tokens) of every token in the column (None once a row is done).
+        Does a single prefill and then clones the KV cache. Rows that finish leave the decode batch right
+        away (the scheduler compacts the KV cache), but their column keeps repeating their last token
+        (with mask 0) until all rows are done, so columns always map to the same sample index.
+        """
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        scheduler = self._generate_scheduler(num_samples, len(tokens), max_tokens, num_samples)
+        request = scheduler.add_request(tokens, num_samples, max_tokens, temperature, top_k, seed, logprobs=logprobs, **sampling)
+        queues = [deque() for _ in range(num_samples)] # (token, mask) emitted but not yet yielded, per row
+        num_yielded = [0] * num_samples # tokens yielded per row, which is where its next logprobs are in state.logprobs
+        stats = self._scheduler_stats(scheduler)
+        try:
+            while True:
+                # A step can emit several tokens per row (speculative decoding), hand them out one column at a time
+                while request.rows and any(queues) and all(q or state.finished for q, state in zip(queues, request.rows)):
+                    token_column, token_masks, logprob_column = [], [], []
+                    for j, (q, state) in enumerate(zip(queues, request.rows)):
+                        logprob_column.append(state.logprobs[num_yielded[j]] if q and logprobs is not None else None)
+                        num_yielded[j] += bool(q)
+                        token, mask = q.popleft() if q else (state.current_tokens[-1], 0)
+                        token_column.append(token)
+                        token_masks.append(mask)
+                    yield (token_column, token_masks) if logprobs is None else (token_column, token_masks, logprob_column)
+                if request.finished:
+                    break
+                for state, token, mask in scheduler.step():
+                    if state.request is request:
+                        queues[state.sample_idx].append((token, mask))
+                if logprobs is not None:
+                    scheduler.flush_logprobs() # streaming, so every step
+        finally:
+            scheduler.cancel(request) # the caller may stop early, don't leave rows behind in a persistent scheduler
+            self._add_stats(scheduler, stats)
+            self._release_scheduler(scheduler)
+
+    @torch.inference_mode()
+    def generate_many(self, prompts, num_samples=1, max_batch_size=None, max_tokens=None, logprobs=None, **kwargs):
+        """
+        Non-streaming generation of num_samples completions for each of many prompts, all decoded as one batch of
+        up to max_batch_size rows (default: every row at once), the prompts that wait joining as others finish.
+        Prompts admitted together are prefilled in one forward even if their lengths differ (varlen prefill).
+        Returns (results, masks) with one entry per prompt, each holding its num_samples token sequences as
+        generate_batch does (with the same seed, a prompt gets the same samples as from generate_batch).
+        With logprobs=N it returns (results, masks, logprobs), see generate_batch. They are copied from the device
+        once, at the end.
+        """
+        assert all(isinstance(tokens, list) and isinstance(tokens[0], int) for tokens in prompts), "expecting lists of ints"
+        max_batch_size = max_batch_size or len(prompts) * num_samples
+        assert num_samples <= max_batch_size, "every prompt needs room for all its samples"
+        scheduler = self._generate_scheduler(max_batch_size, max(len(tokens) for tokens in prompts), max_tokens, num_samples)
+        requests = [scheduler.add_request(tokens, num_samples, max_tokens, logprobs=logprobs, **kwargs) for tokens in prompts]
+        prompt_idx = {id(request): i for i, request in enumerate(requests)}
+        terminal = (scheduler.assistant_end, scheduler.bos) # end a row, not part of the results
+        results = [[tokens.copy() for _ in range(num_samples)] for tokens in prompts]
+        masks = [[[0] * len(tokens) for _ in range(num_samples)] for tokens in prompts]
+        stats = self._scheduler_stats(scheduler)
+        try:
+            while not all(request.finished for request in requests):
+                for state, token, mask in scheduler.step():
+                    if token not in terminal:
+                        i = prompt_idx[id(state.request)]
+                        results[i][state.sample_idx].append(token)
+                        masks[i][state.sample_idx].append(mask)
+        finally:
+            for request in requests:
+                scheduler.cancel(request)
+            self._add_stats(scheduler, stats)
+            self._release_scheduler(scheduler)
+        if logprobs is None:
+            return results, masks
+        scheduler.flush_logprobs()
+        scores = [[state.logprobs[:len(result) - len(request.tokens)] for state, result in zip(request.rows, results[i])]
+                  for i, request in enumerate(requests)] # the terminal token comes last, and is left out as in results
+        return results, masks, scores
+
+    def _generate_scheduler(self, num_rows, prompt_len, max_tokens, num_samples):
+        """The scheduler a generate call runs on, with room for num_rows rows (num_samples per prompt) of prompt_len + max_tokens tokens."""
+        kv_length_hint = (prompt_len + max_tokens) if max_tokens is not None else self.model.config.sequence_len
+        if self.compiled_decode is not None:
+            kv_length_hint = max(kv_length_hint, self.model.config.sequence_len) # the shape warmup() compiled
+        if self.attention_sinks:
+            kv_length_hint = min(kv_length_hint, self.model.config.sequence_len) # longer rows evict
+        if self.prefix_cache_tokens > 0:
+            return self._cached_scheduler(num_rows, kv_length_hint)
+        if self.cascade:
+            # the full blocks of a prompt are stored once for all its samples, every row adds its own generated tokens
+            # (and drafts) plus a copy of the partial last block of the prompt
+            bs = self.block_size
+            speculative = self.draft_model is not None or self.prompt_lookup or self.draft_layers is not None
+            lookahead = self.num_draft_tokens if speculative else 0
+            num_prompts = max(1, num_rows // num_samples)
+            num_blocks = num_prompts * -(-prompt_len // bs) + num_rows * (-(-(kv_length_hint - prompt_len + lookahead) // bs) + 1)
+            return self.scheduler(max_batch_size=num_rows, max_seq_len=kv_length_hint, num_blocks=num_blocks, kv_pool=self.kv_pool)
+        return self.scheduler(max_batch_size=num_rows, max_seq_len=kv_length_hint, kv_pool=self.kv_pool)
+
+    def _release_scheduler(self, scheduler):
+        """Recycle the KV cache of a finished generate call, unless it is the persistent prefix caching scheduler."""
+        if scheduler is not self._scheduler:
+            scheduler.release()
+
+    @staticmethod
+    def _scheduler_stats(scheduler):
+        return scheduler.num_drafted, scheduler.num_accepted, scheduler.num_steps, scheduler.step_time, scheduler.host_time
+
+    def _add_stats(self, scheduler, before):
+        """Add what scheduler did since its _scheduler_stats were before to the stats of this Engine."""
+        drafted, accepted, steps, step_time, host_time = (now - then for now, then in zip(self._scheduler_stats(scheduler), before))
+        self.num_drafted += drafted
+        self.num_accepted += accepted
+        self.num_steps += steps
+        self.step_time += step_time
+        self.host_time += host_time
+
+    def warmup(self, num_samples=1):
+        """
+        Compile the decode step of generate() for num_samples samples (every batch size it shrinks through as they
+        finish), needs compile_decode=True. Call it under the autocast context generate() will run in.
+        """
+        assert self.compiled_decode is not None, "create the Engine with compile_decode=True"
+        if self.prefix_cache_tokens > 0:
+            self._cached_scheduler(num_samples, self.model.config.sequence_len).warmup(range(1, num_samples + 1))
+        else:
+            # on pooled storage like generate() then gets, so the compiled code sees the same cache strides
+            scheduler = self.scheduler(max_batch_size=num_samples, max_seq_len=self.model.config.sequence_len, kv_pool=self.kv_pool)
+            scheduler.warmup()
+            scheduler.release()
+
+    @property
+    def acceptance_rate(self):
+        """Fraction of drafted tokens kept by speculative decoding so far."""
+        return self.num_accepted / max(self.num_drafted, 1)
+
+    def step_stats(self):
+        """Average milliseconds per scheduler step so far, and how many of them went to host work."""
+        num_steps = max(self.num_steps, 1)
+        return 1000 * self.step_time / num_steps, 1000 * self.host_time / num_steps
+
+    def reset_stats(self):
+        """Start the speculative decoding and step time stats over, e.g. to report them per training step."""
+        self.num_drafted = self.num_accepted = self.num_steps = 0
+        self.step_time = self.host_time = 0.0
 
-            # Sample the next token for each row
-            next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-            sampled_tokens = next_ids[:, 0].tolist()
-
-            # Process each row: choose the next token, update state, optional tool use
-            token_column = [] # contains the next token id along each row
-            token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
-            for i, state in enumerate(row_states):
-                # Select the next token in this row
-                is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
-                token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
-                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
-                token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
-
-            # Yield the token column
-            yield token_column, token_masks
-            num_generated += 1
-
-            # Prepare logits for next iteration
-            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
-            logits = self.model.forward(ids, kv_cache=kv_cache_decode)[:, -1, :]  # (B, vocab_size)
-
-    def generate_batch(self, tokens, num_samples=1, **kwargs):
+    def generate_batch(self, tokens, num_samples=1, logprobs=None, **kwargs):
         """
         Non-streaming batch generation that just returns the final token sequences.
         Returns a list of token sequences (list of lists of ints).
         Terminal tokens (assistant_end, bos) are not included in the results.
+        With logprobs=N it returns (results, masks, logprobs), logprobs holding for every sample the
+        (logprob, [(token, logprob)] of the N most likely tokens) of each of its generated tokens, so scoring
+        the samples (e.g. the old policy's logprobs in RL) needs no second forward.
         """
         assistant_end = self.tokenizer.encode_special("<|assistant_end|>")
         bos = self.tokenizer.get_bos_token_id()
         results = [tokens.copy() for _ in range(num_samples)]
         masks = [[0] * len(tokens) for _ in range(num_samples)]
+        scores = [[] for _ in range(num_samples)]
         completed = [False] * num_samples
-        for token_column, token_masks in self.generate(tokens, num_samples, **kwargs):
+        for column in self.generate(tokens, num_samples, logprobs=logprobs, **kwargs):
+            token_column, token_masks = column[:2]
             for i, (token, mask) in enumerate(zip(token_column, token_masks)):
                 if not completed[i]:
                     if token == assistant_end or token == bos:
@@ -293,10 +2077,12 @@ class Engine:
                     else:
                         results[i].append(token)
                         masks[i].append(mask)
+                        if logprobs is not None:
+                            scores[i].append(column[2][i])
             # Stop if all rows are completed
             if all(completed):
                 break
-        return results, masks
+        return (results, masks) if logprobs is None else (results, masks, scores)
 
 
 if __name__ == "__main__":
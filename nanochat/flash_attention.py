@@ -5,6 +5,7 @@ Exports `flash_attn` module that automatically selects the best available backen
 1. Flash Attention 2 (Official Library) - Best for H100/A100 (Your Setup!)
 2. PyTorch SDPA (Scaled Dot Product Attention) - Fallback for CPU/Login Nodes
 """
+import functools
 import torch
 import torch.nn.functional as F
 import logging
@@ -69,6 +70,16 @@ def _use_fa():
 # =============================================================================
 # SDPA helpers (Fallback for CPU/Login Nodes)
 # =============================================================================
+@functools.lru_cache(maxsize=64)
+def _attention_mask(Tq, Tk, window, device):
+    """Boolean (Tq, Tk) mask of Tq queries at the last Tq key positions: causal, and sliding if window >= 0. Read only."""
+    row_idx = torch.arange(Tq, device=device).unsqueeze(1) + (Tk - Tq)
+    col_idx = torch.arange(Tk, device=device).unsqueeze(0)
+    mask = col_idx <= row_idx
+    if window >= 0:
+        mask = mask & ((row_idx - col_idx) <= window)
+    return mask
+
 def _sdpa_attention(q, k, v, window_size, enable_gqa):
     """
     SDPA attention with sliding window support.
@@ -81,22 +92,212 @@ def _sdpa_attention(q, k, v, window_size, enable_gqa):
         return F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=enable_gqa)
 
     if Tq == 1:
+        # decode: the query sees the last window + 1 keys
+        if 0 <= window < Tk - 1:
+            k, v = k[:, :, -(window + 1):], v[:, :, -(window + 1):]
         return F.scaled_dot_product_attention(q, k, v, is_causal=False, enable_gqa=enable_gqa)
 
-    device = q.device
-    if Tq == Tk:
-        mask = torch.tril(torch.ones(Tq, Tk, device=device, dtype=torch.bool))
-        if window > 0 and window < Tq:
-            row_idx = torch.arange(Tq, device=device).unsqueeze(1)
-            col_idx = torch.arange(Tk, device=device).unsqueeze(0)
-            mask = mask & ((row_idx - col_idx) <= window)
+    # query i sits at key position Tk - Tq + i (the keys before the queries are a cached prefix)
+    mask = _attention_mask(Tq, Tk, window, q.device)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, enable_gqa=enable_gqa)
+
+
+def _sdpa_with_kvcache_rows(q, k_cache, v_cache, k, v, pos, window_size):
+    """SDPA attention over a KV cache where all rows sit at the same position pos."""
+    T_new = q.size(1)
+
+    # Insert new k, v into cache
+    if k is not None and v is not None:
+        k_cache[:, pos:pos+T_new, :, :] = k
+        v_cache[:, pos:pos+T_new, :, :] = v
+
+    end_pos = pos + T_new
+    k_full = k_cache[:, :end_pos, :, :]
+    v_full = v_cache[:, :end_pos, :, :]
+
+    q_sdpa = q.transpose(1, 2)
+    k_sdpa = k_full.transpose(1, 2)
+    v_sdpa = v_full.transpose(1, 2)
+
+    enable_gqa = q_sdpa.size(1) != k_sdpa.size(1)
+    y_sdpa = _sdpa_attention(q_sdpa, k_sdpa, v_sdpa, window_size, enable_gqa)
+
+    return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
+
+
+def _quantize_int8(x):
+    """Symmetric int8 quantization of (B, T, H, D) with one scale per token and head. Returns (int8 values, scales in x.dtype)."""
+    scale = (x.abs().amax(dim=-1).float() / 127.0).clamp(min=1e-8).to(x.dtype) # (B, T, H)
+    q = (x.float() / scale.float().unsqueeze(-1)).round().clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def _insert_kv(k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale):
+    """Write the new k, v of every row at its own position of a dense or paged cache, quantizing them for an int8 cache."""
+    B, T_new = k.shape[:2]
+    pos = cache_seqlens.long().unsqueeze(1) + torch.arange(T_new, device=k.device) # (B, T_new)
+    if block_table is not None:
+        block_size = k_cache.size(1)
+        idx = (block_table.long().gather(1, pos // block_size), pos % block_size)
     else:
-        prefix_len = Tk - Tq
-        mask = torch.zeros(Tq, Tk, device=device, dtype=torch.bool)
-        mask[:, :prefix_len] = True
-        mask[:, prefix_len:] = torch.tril(torch.ones(Tq, Tq, device=device, dtype=torch.bool))
+        idx = (torch.arange(B, device=k.device).unsqueeze(1).expand_as(pos), pos)
+    if k_scale is not None:
+        k, k_scale[idx] = _quantize_int8(k)
+        v, v_scale[idx] = _quantize_int8(v)
+    k_cache[idx] = k
+    v_cache[idx] = v
+
+
+def _read_kv(cache, scale, block_table, length, dtype):
+    """The first length positions of every row as a contiguous (B, length, H, D) cache in dtype (dequantized if int8)."""
+    if block_table is not None:
+        # gather the blocks of every row (the last one may run past length, attention masks it out)
+        num_blocks = -(-length // cache.size(1))
+        table = block_table[:, :num_blocks].long()
+        cache = cache[table].flatten(1, 2)
+        scale = scale[table].flatten(1, 2) if scale is not None else None
+    else:
+        cache = cache[:, :length]
+        scale = scale[:, :length] if scale is not None else None
+    if scale is not None:
+        cache = cache.to(dtype) * scale.to(dtype).unsqueeze(-1)
+    return cache
 
-    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, enable_gqa=enable_gqa)
+
+def _sdpa_masked_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale, window_size, length=None):
+    """
+    SDPA over the first length positions of a dense or paged cache in one batched call, every row masked to its own
+    positions (ragged rows). The new k, v are scattered in at every row's own offset. Without length it attends over
+    the whole capacity: the shapes then only depend on the size of the cache, not on where the rows are, so nothing
+    is read back to the host (torch.compile).
+    """
+    B, T_new = q.shape[:2]
+    if k is not None and v is not None:
+        _insert_kv(k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale)
+    if length is None:
+        length = k_cache.size(1) * (block_table.size(1) if block_table is not None else 1)
+    k_full = _read_kv(k_cache, k_scale, block_table, length, q.dtype)[:, :length]
+    v_full = _read_kv(v_cache, v_scale, block_table, length, q.dtype)[:, :length]
+    # query t of row b sits at position cache_seqlens[b] + t
+    row_idx = cache_seqlens.long().view(B, 1, 1, 1) + torch.arange(T_new, device=q.device).view(1, 1, T_new, 1)
+    col_idx = torch.arange(length, device=q.device)
+    mask = col_idx <= row_idx
+    if window_size[0] >= 0:
+        mask = mask & ((row_idx - col_idx) <= window_size[0])
+    q_sdpa, k_sdpa, v_sdpa = q.transpose(1, 2), k_full.transpose(1, 2), v_full.transpose(1, 2)
+    y = F.scaled_dot_product_attention(q_sdpa, k_sdpa, v_sdpa, attn_mask=mask, enable_gqa=q_sdpa.size(1) != k_sdpa.size(1))
+    return y.transpose(1, 2)
+
+
+def _ring_kv(k_cache, v_cache, k, v, cache_seqlens, k_scale, v_scale):
+    """
+    Ring buffer cache (position p in slot p % R, only the last R positions kept): returns every row's kept
+    positions in order followed by the new k, v, as contiguous (B, R + T_new, H, D) caches in k's dtype, and
+    the number of kept positions per row. Reads before writing, so a chunk longer than the ring still sees
+    the keys before it. Then writes the new k, v into the ring (quantized for an int8 cache).
+    """
+    B, T_new = k.shape[:2]
+    R = k_cache.size(1)
+    rows = torch.arange(B, device=k.device).unsqueeze(1)
+    pos = cache_seqlens.long()
+    num_old = pos.clamp(max=R)
+    old_slots = ((pos - num_old).unsqueeze(1) + torch.arange(R, device=k.device)) % R # slots of the kept positions, in order
+    k_old = _read_kv(k_cache[rows, old_slots], None if k_scale is None else k_scale[rows, old_slots], None, R, k.dtype)
+    v_old = _read_kv(v_cache[rows, old_slots], None if v_scale is None else v_scale[rows, old_slots], None, R, v.dtype)
+    if k_scale is not None:
+        k_q, k_s = _quantize_int8(k)
+        v_q, v_s = _quantize_int8(v)
+        k, v = k_q.to(k.dtype) * k_s.unsqueeze(-1), v_q.to(v.dtype) * v_s.unsqueeze(-1)
+    k_lin = torch.cat([k_old, torch.zeros_like(k)], dim=1)
+    v_lin = torch.cat([v_old, torch.zeros_like(v)], dim=1)
+    new_idx = num_old.unsqueeze(1) + torch.arange(T_new, device=k.device)
+    k_lin[rows, new_idx] = k
+    v_lin[rows, new_idx] = v
+    # only the last R new positions survive in the ring
+    t0 = max(0, T_new - R)
+    slots = (pos.unsqueeze(1) + torch.arange(t0, T_new, device=k.device)) % R
+    if k_scale is not None:
+        k_cache[rows, slots], k_scale[rows, slots] = k_q[:, t0:], k_s[:, t0:]
+        v_cache[rows, slots], v_scale[rows, slots] = v_q[:, t0:], v_s[:, t0:]
+    else:
+        k_cache[rows, slots] = k[:, t0:]
+        v_cache[rows, slots] = v[:, t0:]
+    return k_lin, v_lin, num_old
+
+
+class Cascade:
+    """
+    Rows of a paged cache that share the blocks of a prompt prefix (e.g. the samples of one prompt), for cascade
+    attention: the queries of all the rows of a group attend to their prefix together, so its KV is read once
+    instead of once per row, every row attends to the rest of its own blocks, and the two parts are merged with
+    their log-sum-exps. groups is a list of (rows, blocks, num_tokens): the rows (LongTensor) whose first num_tokens
+    positions live in the blocks (IntTensor) they all share. host_prefix_lens lists num_tokens of every row, 0 for
+    a row outside any group, and prefix_lens is the same on the device.
+    """
+    def __init__(self, groups, host_prefix_lens, device):
+        self.groups = groups
+        self.host_prefix_lens = host_prefix_lens
+        self.prefix_lens = torch.tensor(host_prefix_lens, dtype=torch.int32, device=device)
+
+
+def _attention_lse(q, k, v, mask=None):
+    """Attention of q (B, Tq, H, D) over k, v (B, Tk, Hk, D) in float32, and the log-sum-exp of the scores (B, Tq, H)."""
+    H, Hk = q.size(2), k.size(2)
+    q, k, v = q.float().transpose(1, 2), k.float().transpose(1, 2), v.float().transpose(1, 2)
+    if Hk != H:
+        k, v = k.repeat_interleave(H // Hk, dim=1), v.repeat_interleave(H // Hk, dim=1)
+    scores = (q @ k.transpose(-1, -2)) * q.size(-1) ** -0.5
+    if mask is not None:
+        scores = scores.masked_fill(~mask, -float("inf"))
+    lse = scores.logsumexp(dim=-1, keepdim=True)
+    y = (scores - lse).exp() @ v
+    return y.transpose(1, 2), lse.squeeze(-1).transpose(1, 2)
+
+
+def _merge_attention(y1, lse1, y2, lse2):
+    """Attention over the union of two disjoint sets of keys, from the attention over each and its log-sum-exp."""
+    lse = torch.logaddexp(lse1, lse2)
+    return y1 * (lse1 - lse).exp().unsqueeze(-1) + y2 * (lse2 - lse).exp().unsqueeze(-1)
+
+
+def _cascade_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale, cascade, positions):
+    """Cascade attention over a paged cache (see Cascade): shared prefixes once per group, then every row's own suffix."""
+    B, T_new, H, D = q.shape
+    block_size = k_cache.size(1)
+    if k is not None and v is not None:
+        _insert_kv(k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale)
+    # shared prefixes: the queries of a group, all of them after the prefix, attend to it in one call
+    y_prefix = torch.zeros(B, T_new, H, D, dtype=torch.float32, device=q.device)
+    lse_prefix = torch.full((B, T_new, H), -float("inf"), device=q.device)
+    for rows, blocks, num_tokens in cascade.groups:
+        if _use_fa():
+            k_prefix = _read_kv(k_cache, None, blocks.unsqueeze(0), num_tokens, q.dtype)[:, :num_tokens]
+            v_prefix = _read_kv(v_cache, None, blocks.unsqueeze(0), num_tokens, q.dtype)[:, :num_tokens]
+            y, lse, _ = _fa_func(q[rows].reshape(1, -1, H, D), k_prefix, v_prefix, causal=False, return_attn_probs=True)
+            y, lse = y.float(), lse.transpose(1, 2)
+        else:
+            k_prefix = _read_kv(k_cache, k_scale, blocks.unsqueeze(0), num_tokens, q.dtype)[:, :num_tokens]
+            v_prefix = _read_kv(v_cache, v_scale, blocks.unsqueeze(0), num_tokens, q.dtype)[:, :num_tokens]
+            y, lse = _attention_lse(q[rows].reshape(1, -1, H, D), k_prefix, v_prefix)
+        y_prefix[rows] = y.view(-1, T_new, H, D)
+        lse_prefix[rows] = lse.reshape(-1, T_new, H)
+    # private suffixes: every row attends causally to its blocks after its prefix (prefixes are whole blocks)
+    suffix_lens = cache_seqlens - cascade.prefix_lens
+    length = max(pos - num_tokens for pos, num_tokens in zip(positions, cascade.host_prefix_lens)) + T_new
+    skip = (cascade.prefix_lens // block_size).long().unsqueeze(1)
+    num_blocks = block_table.size(1) if _use_fa() else -(-length // block_size)
+    table = block_table.gather(1, (skip + torch.arange(num_blocks, device=q.device)).clamp(max=block_table.size(1) - 1))
+    if _use_fa():
+        y_suffix, lse_suffix = _fa_kvcache(q, k_cache, v_cache, cache_seqlens=(suffix_lens + T_new).int(), block_table=table,
+                                           causal=True, return_softmax_lse=True)
+        y_suffix, lse_suffix = y_suffix.float(), lse_suffix.transpose(1, 2)
+    else:
+        k_suffix = _read_kv(k_cache, k_scale, table, length, q.dtype)[:, :length]
+        v_suffix = _read_kv(v_cache, v_scale, table, length, q.dtype)[:, :length]
+        row_idx = suffix_lens.long().view(B, 1, 1, 1) + torch.arange(T_new, device=q.device).view(1, 1, T_new, 1)
+        mask = torch.arange(length, device=q.device) <= row_idx
+        y_suffix, lse_suffix = _attention_lse(q, k_suffix, v_suffix, mask)
+    return _merge_attention(y_prefix, lse_prefix, y_suffix, lse_suffix).to(q.dtype)
 
 
 # =============================================================================
@@ -119,38 +320,75 @@ def flash_attn_func(q, k, v, causal=False, window_size=(-1, -1)):
     return y.transpose(1, 2)  # back to (B, T, H, D)
 
 
-def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=None,
-                            causal=False, window_size=(-1, -1)):
+def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=None, block_table=None,
+                            k_scale=None, v_scale=None, causal=False, window_size=(-1, -1), ring_buffer=False, host_seqlens=None,
+                            cascade=None):
     """
     Flash Attention with KV cache for inference.
+    With block_table (B, max_blocks), the caches are paged block pools of shape (num_blocks, block_size, H, D).
+    With k_scale/v_scale (shaped like the caches minus D), the caches are int8: the new k, v are quantized
+    on insert and the cache is dequantized to q's dtype inside the call (FA and SDPA alike).
+    With ring_buffer, the (B, R, H, D) caches only keep the last R >= window_size[0] positions of every row,
+    position p in slot p % R (sliding-window layers): attention reads only those, not the whole prefix.
+    host_seqlens is an optional CPU copy of cache_seqlens: the paths that need the positions on the host
+    (the SDPA fallback, int8 with FA) read them from it instead of syncing with the device.
+    With cascade (a Cascade, paged caches only), rows sharing the blocks of a prefix attend to it together. It only
+    applies when every query sees the whole prefix (a window at least as long as the rows), otherwise it is ignored.
     """
+    B, T_new, H, D = q.shape
+    positions = host_seqlens.tolist() if host_seqlens is not None and not torch.compiler.is_compiling() else None
+    if cascade is not None and not torch.compiler.is_compiling() and not (_use_fa() and k_scale is not None):
+        assert block_table is not None, "cascade attention shares the blocks of a paged cache"
+        positions = positions if positions is not None else cache_seqlens.tolist()
+        if window_size[0] < 0 or max(positions) + T_new - 1 <= window_size[0]:
+            return _cascade_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale, cascade, positions)
+    if ring_buffer:
+        assert block_table is None and k is not None and v is not None
+        if positions is not None:
+            positions = [min(pos, k_cache.size(1)) for pos in positions]
+        k_cache, v_cache, num_old = _ring_kv(k_cache, v_cache, k, v, cache_seqlens, k_scale, v_scale)
+        if _use_fa():
+            return _fa_kvcache(
+                q, k_cache, v_cache, cache_seqlens=(num_old + T_new).int(), causal=causal, window_size=window_size
+            )
+        # carry on with the contiguous copy as a dense cache, the new k, v already sit after the kept positions
+        k = v = k_scale = v_scale = None
+        cache_seqlens = num_old
     if _use_fa():
+        if k_scale is None:
+            return _fa_kvcache(
+                q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens, block_table=block_table,
+                causal=causal, window_size=window_size
+            )
+        # int8 cache: the kernels need q's dtype, so insert the quantized k, v and hand them a dequantized copy
+        if k is not None and v is not None:
+            _insert_kv(k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale)
+        length = (max(positions) if positions is not None else int(cache_seqlens.max().item())) + T_new
         return _fa_kvcache(
-            q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
-            causal=causal, window_size=window_size
+            q, _read_kv(k_cache, k_scale, block_table, length, q.dtype), _read_kv(v_cache, v_scale, block_table, length, q.dtype),
+            cache_seqlens=cache_seqlens + T_new, causal=causal, window_size=window_size
         )
 
     # SDPA fallback: manually manage KV cache
-    B, T_new, H, D = q.shape
-    pos = cache_seqlens[0].item()  # assume uniform position across batch
-
-    # Insert new k, v into cache
-    if k is not None and v is not None:
-        k_cache[:, pos:pos+T_new, :, :] = k
-        v_cache[:, pos:pos+T_new, :, :] = v
-
-    end_pos = pos + T_new
-    k_full = k_cache[:, :end_pos, :, :]
-    v_full = v_cache[:, :end_pos, :, :]
-
-    q_sdpa = q.transpose(1, 2)
-    k_sdpa = k_full.transpose(1, 2)
-    v_sdpa = v_full.transpose(1, 2)
-
-    enable_gqa = q_sdpa.size(1) != k_sdpa.size(1)
-    y_sdpa = _sdpa_attention(q_sdpa, k_sdpa, v_sdpa, window_size, enable_gqa)
-
-    return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
+    if torch.compiler.is_compiling():
+        # static shapes, no host syncs: attend over the whole cache with a per-row mask
+        return _sdpa_masked_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale, window_size)
+    if positions is None:
+        positions = cache_seqlens.tolist()
+    if any(pos != positions[0] for pos in positions):
+        # Ragged rows (e.g. continuous batching): every row sits at its own position, one batched masked call
+        return _sdpa_masked_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale, window_size,
+                                    length=max(positions) + T_new)
+    if block_table is not None or k_scale is not None:
+        # Paged and/or int8 cache: write the new k, v into the cache, then read every row back as a
+        # contiguous (B, T, H, D) cache in q's dtype and carry on as with a dense cache
+        if k is not None and v is not None:
+            _insert_kv(k_cache, v_cache, k, v, cache_seqlens, block_table, k_scale, v_scale)
+            k = v = None
+        length = max(positions) + T_new
+        k_cache = _read_kv(k_cache, k_scale, block_table, length, q.dtype)
+        v_cache = _read_kv(v_cache, v_scale, block_table, length, q.dtype)
+    return _sdpa_with_kvcache_rows(q, k_cache, v_cache, k, v, positions[0], window_size)
 
 
 # =============================================================================
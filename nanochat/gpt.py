@@ -102,10 +102,16 @@ class CausalSelfAttention(nn.Module):
         else:
             # Inference: use flash_attn_with_kvcache which handles cache management
             k_cache, v_cache = kv_cache.get_layer_cache(self.layer_idx)
+            k_scale, v_scale = kv_cache.get_layer_scales(self.layer_idx)
             y = flash_attn.flash_attn_with_kvcache(
                 q, k_cache, v_cache,
                 k=k, v=v,
                 cache_seqlens=kv_cache.cache_seqlens,
+                block_table=kv_cache.block_table,
+                k_scale=k_scale, v_scale=v_scale,
+                ring_buffer=kv_cache.is_ring_layer(self.layer_idx),
+                host_seqlens=kv_cache.host_seqlens, # positions without a device -> host sync
+                cascade=kv_cache.cascade, # rows sharing a prompt prefix, see PagedKVCache.shared_prefixes
                 causal=True,
                 window_size=window_size,
             )
@@ -246,9 +252,7 @@ class GPT(nn.Module):
         # autodetect the device from model embeddings
         if device is None:
             device = self.transformer.wte.weight.device
-        # stride the channels
-        channel_range = torch.arange(0, head_dim, 2, dtype=torch.float32, device=device)
-        inv_freq = 1.0 / (base ** (channel_range / head_dim))
+        inv_freq = self._rotary_inv_freq(head_dim, base, device)
         # stride the time steps
         t = torch.arange(seq_len, dtype=torch.float32, device=device)
         # calculate the rotation frequencies at each (time, channel) pair
@@ -258,6 +262,21 @@ class GPT(nn.Module):
         cos, sin = cos[None, :, None, :], sin[None, :, None, :] # add batch and head dims for later broadcasting
         return cos, sin
 
+    @staticmethod
+    def _rotary_inv_freq(head_dim, base=10000, device=None):
+        # stride the channels
+        channel_range = torch.arange(0, head_dim, 2, dtype=torch.float32, device=device)
+        return 1.0 / (base ** (channel_range / head_dim))
+
+    def shift_rotary(self, k, shift):
+        """
+        Re-rotate keys k (..., T, H, D) that got the rotary embeddings of positions p to those of positions p + shift.
+        Rotations compose, so this is exact up to rounding (done in fp32, not with the bf16 tables). Used by KV caches
+        that move keys to other positions (attention sinks, see KVCache).
+        """
+        angle = shift * self._rotary_inv_freq(k.size(-1), device=k.device)
+        return apply_rotary_emb(k.float(), angle.cos(), angle.sin()).to(k.dtype)
+
     def _compute_window_sizes(self, config):
         """
         Compute per-layer window sizes for sliding window attention.
@@ -365,7 +384,7 @@ class GPT(nn.Module):
                 group["initial_lr"] = group["lr"]
         return optimizers
 
-    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean'):
+    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean', logit_positions=None, num_layers=None):
         B, T = idx.size()
 
         # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim/2))
@@ -373,17 +392,36 @@ class GPT(nn.Module):
         assert idx.device == self.cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {self.cos.device}"
         assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
         # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
-        T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        if kv_cache is None:
+            cos_sin = self.cos[:, :T], self.sin[:, :T] # truncate cache to current sequence length
+        else:
+            # every row can sit at a different position (e.g. continuous batching), so gather per row
+            pos = kv_cache.cache_seqlens.long().unsqueeze(1) + torch.arange(T, device=idx.device) # (B, T)
+            cos_sin = self.cos[0, pos], self.sin[0, pos] # (B, T, 1, head_dim/2)
 
         # Forward the trunk of the Transformer
         x = self.transformer.wte(idx)
         x = norm(x)
         x0 = x  # save initial normalized embedding for x0 residual
-        for i, block in enumerate(self.transformer.h):
+        # Optionally exit early after the first num_layers blocks (self-speculative drafts): the final norm and lm_head
+        # then read the residual stream there, and the KV cache only gets the KV of those layers
+        blocks = self.transformer.h if num_layers is None else self.transformer.h[:num_layers]
+        for i, block in enumerate(blocks):
             x = self.resid_lambdas[i] * x + self.x0_lambdas[i] * x0
             ve = self.value_embeds[str(i)](idx) if str(i) in self.value_embeds else None
             x = block(x, ve, cos_sin, self.window_sizes[i], kv_cache)
+        if kv_cache is not None and len(blocks) < len(self.transformer.h):
+            kv_cache.advance(T) # the last layer would have
+
+        # Optionally keep only the positions whose logits are used (inference/eval): an int n keeps the last n
+        # positions, a (B, K) LongTensor keeps K positions per row. The final norm, lm_head, fp32 cast and softcap
+        # then run on (B, K) positions instead of (B, T), which is where the memory peaks for a large vocab.
+        if logit_positions is not None:
+            assert targets is None, "logit_positions is for inference only"
+            if isinstance(logit_positions, int):
+                x = x[:, -logit_positions:]
+            else:
+                x = x.gather(1, logit_positions.unsqueeze(-1).expand(-1, -1, x.size(-1)))
         x = norm(x)
 
         # Forward the lm_head (compute logits)
@@ -418,7 +456,7 @@ class GPT(nn.Module):
             rng.manual_seed(seed)
         ids = torch.tensor([tokens], dtype=torch.long, device=device) # add batch dim
         for _ in range(max_tokens):
-            logits = self.forward(ids) # (B, T, vocab_size)
+            logits = self.forward(ids, logit_positions=1) # (B, 1, vocab_size)
             logits = logits[:, -1, :] # (B, vocab_size)
             if top_k is not None:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
@@ -0,0 +1,295 @@
+"""
+Constrained decoding: a regex compiled into per-state token masks over the vocab.
+
+The regex is compiled into a DFA over bytes, then every token of the vocab (its bytes) is run through the DFA from
+every state at once. The result are two tables the BatchScheduler indexes per row on the device:
+- next_states (num_states, vocab_size): the state after emitting a token
+- allowed (num_states, vocab_size): which tokens keep the text a prefix of a match (masked to -inf otherwise)
+Building them is a few seconds for a 65K vocab, so they are cached on disk, keyed by the pattern and the vocab.
+
+Supported syntax (a subset of Python's re): literals, escapes \\d \\w \\s \\D \\W \\S \\n \\t \\r, classes [a-z0-9_]
+and [^...], ., groups (...) and (?:...), alternation |, and the quantifiers * + ? {m} {m,} {m,n}.
+The pattern must match the whole generated text (re.fullmatch). Everything works on bytes: . and negated classes
+match any single byte, so non-ASCII characters are only supported as literals.
+"""
+
+import os
+import hashlib
+from functools import lru_cache
+
+import torch
+
+# -----------------------------------------------------------------------------
+# Regex -> AST: ("set", bytes) one byte out of a set, ("cat", [nodes]), ("alt", [nodes]), ("repeat", node, min, max)
+
+ALL_BYTES = frozenset(range(256))
+DIGITS = frozenset(b"0123456789")
+WORD = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+SPACE = frozenset(b" \t\n\r\f\v")
+ESCAPES = {"d": DIGITS, "w": WORD, "s": SPACE, "D": ALL_BYTES - DIGITS, "W": ALL_BYTES - WORD, "S": ALL_BYTES - SPACE,
+           "n": frozenset(b"\n"), "t": frozenset(b"\t"), "r": frozenset(b"\r"), "f": frozenset(b"\f"), "v": frozenset(b"\v")}
+
+class _Parser:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.i = 0
+
+    def error(self, message):
+        return ValueError(f"{message} at position {self.i} of regex {self.pattern!r}")
+
+    def peek(self):
+        return self.pattern[self.i] if self.i < len(self.pattern) else None
+
+    def take(self):
+        c = self.peek()
+        if c is None:
+            raise self.error("unexpected end")
+        self.i += 1
+        return c
+
+    def parse(self):
+        node = self.alternation()
+        if self.peek() is not None:
+            raise self.error("unbalanced )")
+        return node
+
+    def alternation(self):
+        options = [self.concat()]
+        while self.peek() == "|":
+            self.i += 1
+            options.append(self.concat())
+        return options[0] if len(options) == 1 else ("alt", options)
+
+    def concat(self):
+        items = []
+        while self.peek() not in (None, "|", ")"):
+            items.append(self.quantified())
+        return items[0] if len(items) == 1 else ("cat", items)
+
+    def quantified(self):
+        node = self.atom()
+        while self.peek() in ("*", "+", "?", "{"):
+            c = self.take()
+            if c == "*":
+                node = ("repeat", node, 0, None)
+            elif c == "+":
+                node = ("repeat", node, 1, None)
+            elif c == "?":
+                node = ("repeat", node, 0, 1)
+            else:
+                end = self.pattern.find("}", self.i)
+                if end < 0:
+                    raise self.error("unterminated {")
+                low, _, high = self.pattern[self.i:end].partition(",")
+                try:
+                    low = int(low)
+                    high = low if "," not in self.pattern[self.i:end] else (int(high) if high else None)
+                except ValueError:
+                    raise self.error("bad repetition")
+                if high is not None and high < low:
+                    raise self.error("bad repetition")
+                self.i = end + 1
+                node = ("repeat", node, low, high)
+        return node
+
+    def atom(self):
+        c = self.take()
+        if c == "(":
+            if self.pattern.startswith("?:", self.i):
+                self.i += 2
+            node = self.alternation()
+            if self.take() != ")":
+                raise self.error("missing )")
+            return node
+        if c == "[":
+            return ("set", self.char_class())
+        if c == ".":
+            return ("set", ALL_BYTES - {ord("\n")})
+        if c == "\\":
+            c = self.take()
+            if c in ESCAPES:
+                return ("set", ESCAPES[c])
+        elif c in "*+?{":
+            raise self.error("nothing to repeat")
+        # a literal character, one node per byte of its UTF-8 encoding
+        nodes = [("set", frozenset([b])) for b in c.encode("utf-8")]
+        return nodes[0] if len(nodes) == 1 else ("cat", nodes)
+
+    def char_class(self):
+        negate = self.peek() == "^"
+        if negate:
+            self.i += 1
+        chars, first = set(), True
+        while first or self.peek() != "]":
+            first = False
+            c = self.take()
+            if c == "\\":
+                c = self.take()
+                if c in ESCAPES:
+                    chars |= ESCAPES[c]
+                    continue
+            if ord(c) > 127:
+                raise self.error("only ASCII characters are supported in character classes")
+            if self.peek() == "-" and self.pattern[self.i + 1:self.i + 2] not in ("", "]"):
+                self.i += 1
+                high = self.take()
+                if high == "\\":
+                    high = self.take()
+                if ord(c) > ord(high):
+                    raise self.error("bad character range")
+                if ord(high) > 127:
+                    raise self.error("only ASCII characters are supported in character classes")
+                chars |= set(range(ord(c), ord(high) + 1))
+            else:
+                chars.add(ord(c))
+        self.i += 1
+        return ALL_BYTES - chars if negate else frozenset(chars)
+
+# -----------------------------------------------------------------------------
+# AST -> NFA (Thompson) -> DFA (subset construction)
+
+def _build_nfa(node, edges, start):
+    """Add node to the NFA edges (per state: [(byte set or None for epsilon, target)]) from start. Returns its end state."""
+    def new_state():
+        edges.append([])
+        return len(edges) - 1
+    kind = node[0]
+    if kind == "set":
+        end = new_state()
+        edges[start].append((node[1], end))
+        return end
+    if kind == "cat":
+        for child in node[1]:
+            start = _build_nfa(child, edges, start)
+        return start
+    if kind == "alt":
+        end = new_state()
+        for child in node[1]:
+            begin = new_state()
+            edges[start].append((None, begin))
+            edges[_build_nfa(child, edges, begin)].append((None, end))
+        return end
+    _, child, low, high = node
+    for _ in range(low):
+        start = _build_nfa(child, edges, start)
+    if high is None:
+        loop = new_state()
+        edges[start].append((None, loop))
+        edges[_build_nfa(child, edges, loop)].append((None, loop))
+        return loop
+    for _ in range(high - low):
+        end = _build_nfa(child, edges, start)
+        edges[start].append((None, end))
+        start = end
+    return start
+
+def compile_dfa(pattern):
+    """
+    Compile a regex into a byte DFA. Returns (transitions, accepting): transitions[s][b] is the state after byte b
+    in state s, accepting[s] whether the bytes so far fullmatch. State 0 is the start, state 1 the dead state.
+    """
+    edges = [[]]
+    accept = _build_nfa(_Parser(pattern).parse(), edges, 0)
+
+    def closure(states):
+        stack, seen = list(states), set(states)
+        while stack:
+            for label, target in edges[stack.pop()]:
+                if label is None and target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+    ids = {closure([0]): 0, frozenset(): 1}
+    todo, transitions = list(ids), []
+    while len(transitions) < len(todo):
+        targets = [set() for _ in range(256)]
+        for state in todo[len(transitions)]:
+            for label, target in edges[state]:
+                if label is not None:
+                    for b in label:
+                        targets[b].add(target)
+        row = []
+        for b in range(256):
+            subset = closure(targets[b])
+            if subset not in ids:
+                ids[subset] = len(todo)
+                todo.append(subset)
+            row.append(ids[subset])
+        transitions.append(row)
+    return transitions, [accept in subset for subset in todo]
+
+# -----------------------------------------------------------------------------
+# DFA -> token tables
+
+class Grammar:
+    """
+    A regex as token-level tables over a vocab (a list of the bytes of every token, None for special tokens).
+    Special tokens are never allowed, except end_tokens, which are allowed once the text matches (and keep the state),
+    and free_tokens, which are allowed anywhere and do not advance the state (e.g. the tool tokens: the tool call and
+    its output are not part of the text the grammar constrains). final[s] is True when the text matches and no token
+    could extend it, so generation is done. With cache_dir, the tables are loaded from (or saved to) disk.
+    """
+
+    def __init__(self, pattern, vocab, end_tokens=(), free_tokens=(), cache_dir=None):
+        self.pattern = pattern
+        self.vocab_size = len(vocab)
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha256(repr((pattern, sorted(end_tokens), sorted(free_tokens))).encode("utf-8"))
+            for token in vocab:
+                key.update(b"\xff" if token is None else len(token).to_bytes(2, "little") + token)
+            path = os.path.join(cache_dir, f"{key.hexdigest()}.pt")
+        if path is not None and os.path.exists(path):
+            tables = torch.load(path)
+        else:
+            tables = self._build(pattern, vocab, end_tokens, free_tokens)
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                torch.save(tables, path + ".tmp")
+                os.replace(path + ".tmp", path) # atomic, concurrent processes never read a partial file
+        self.next_states, self.allowed, self.final = tables["next_states"], tables["allowed"], tables["final"]
+        self.num_states = self.final.size(0)
+        self.start = 0
+
+    @staticmethod
+    def _build(pattern, vocab, end_tokens, free_tokens):
+        transitions, accepting = compile_dfa(pattern)
+        S, V, dead = len(transitions), len(vocab), 1
+        transitions = torch.tensor(transitions, dtype=torch.long)
+        accepting = torch.tensor(accepting)
+        # run the bytes of every token through the DFA from every state at once, one byte position at a time
+        lengths = torch.tensor([len(token) if token is not None else 0 for token in vocab])
+        token_bytes = torch.zeros(V, max(int(lengths.max()), 1), dtype=torch.long)
+        for t, token in enumerate(vocab):
+            if token:
+                token_bytes[t, :len(token)] = torch.tensor(list(token))
+        states = torch.arange(S).unsqueeze(1).expand(S, V)
+        for j in range(token_bytes.size(1)):
+            states = torch.where(lengths > j, transitions[states, token_bytes[:, j]], states)
+        states = torch.where(lengths > 0, states, dead) # special (and empty) tokens lead nowhere
+        end_tokens, free_tokens = list(end_tokens), list(free_tokens)
+        text_allowed = states != dead
+        states[:, end_tokens] = torch.where(accepting, torch.arange(S), dead).unsqueeze(1)
+        states[:, free_tokens] = torch.arange(S).unsqueeze(1)
+        allowed = states != dead
+        # a row that somehow ends up in the dead state can only end
+        allowed[dead] = False
+        allowed[dead, end_tokens] = True
+        return dict(
+            next_states=states.int(),
+            allowed=allowed,
+            final=accepting & ~text_allowed.any(dim=1),
+        )
+
+def vocab_bytes(tokenizer):
+    """The bytes of every token of a RustBPETokenizer, None for the special tokens."""
+    special = {tokenizer.encode_special(name) for name in tokenizer.get_special_tokens()}
+    return [None if t in special else tokenizer.enc.decode_single_token_bytes(t) for t in range(tokenizer.get_vocab_size())]
+
+@lru_cache(maxsize=16)
+def compile_grammar(pattern, tokenizer, free_tokens=()):
+    """A Grammar for pattern over the tokenizer's vocab, ending with <|assistant_end|>, cached in memory and on disk."""
+    from nanochat.common import get_base_dir
+    end_tokens = [tokenizer.encode_special("<|assistant_end|>")]
+    return Grammar(pattern, vocab_bytes(tokenizer), end_tokens, free_tokens, cache_dir=os.path.join(get_base_dir(), "grammar_cache"))
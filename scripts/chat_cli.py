@@ -20,6 +20,10 @@ parser.add_argument('-t', '--temperature', type=float, default=0.6, help='Temper
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Top-k sampling parameter')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('--draft-model-tag', type=str, default=None, help='Smaller model (same source) to draft tokens for speculative decoding, e.g. d6')
+parser.add_argument('--draft-layers', type=int, default=None, help='Self-speculative decoding: draft with the first N blocks of the model itself (early exit), no second checkpoint')
+parser.add_argument('--num-draft-tokens', type=int, default=4, help='Tokens drafted per step for speculative decoding')
+parser.add_argument('--attention-sinks', type=int, default=0, help='Keep the first N tokens plus a recent window in the KV cache and evict the middle, so a chat can outgrow the sequence length (StreamingLLM). 0 = off')
 args = parser.parse_args()
 
 # Init the model and tokenizer
@@ -29,6 +33,9 @@ ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+draft_model = None
+if args.draft_model_tag is not None:
+    draft_model, _, _ = load_model(args.source, device, phase="eval", model_tag=args.draft_model_tag)
 
 # Special tokens for the chat state machine
 bos = tokenizer.get_bos_token_id()
@@ -36,7 +43,7 @@ user_start, user_end = tokenizer.encode_special("<|user_start|>"), tokenizer.enc
 assistant_start, assistant_end = tokenizer.encode_special("<|assistant_start|>"), tokenizer.encode_special("<|assistant_end|>")
 
 # Create Engine for efficient generation
-engine = Engine(model, tokenizer)
+engine = Engine(model, tokenizer, draft_model=draft_model, draft_layers=args.draft_layers, num_draft_tokens=args.num_draft_tokens, attention_sinks=args.attention_sinks)
 
 print("\nNanoChat Interactive Mode")
 print("-" * 50)
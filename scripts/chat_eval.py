@@ -18,6 +18,7 @@ import torch.distributed as dist
 from nanochat.common import compute_init, compute_cleanup, get_dist_info, print0, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
 from nanochat.engine import Engine
+from nanochat.grammar import compile_grammar
 
 from tasks.humaneval import HumanEval
 from tasks.mmlu import MMLU
@@ -28,38 +29,51 @@ from tasks.spellingbee import SpellingBee
 # -----------------------------------------------------------------------------
 # Generative evaluation loop (we go one problem at a time, sample, evaluate)
 
-def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None):
+# With --constrained, the completions of these tasks are decoded under a grammar that only lets them end once the
+# answer is in the form the task parses (extract_answer, extract_program); the text before it and tool calls are left free
+ANSWER_PATTERNS = {
+    'GSM8K': r"[\s\S]*#### -?[0-9][0-9,]*(\.[0-9]+)?",
+    'SpellingBee': r"[\s\S]*#### -?[0-9][0-9,]*(\.[0-9]+)?",
+    # a fenced code block, which extract_program takes over the whole completion
+    'HumanEval': r"[\s\S]*```(python)?[ \t]*\n[\s\S]*\n```[\s\S]*",
+}
+
+def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None, batch_size=1, grammar=None):
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
 
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
 
-    # Run the evaluation
+    # Run the evaluation, generating for as many problems at once as batch_size rows hold
     num_passed, total = 0, 0
-    for i in range(ddp_rank, num_problems, ddp_world_size):
-        conversation = task_object[i]
-
-        # Tokenize the prompt
-        encoded_prompt = tokenizer.render_for_completion(conversation)
-        # Get the completions
-        results, _ = engine.generate_batch(
-            encoded_prompt,
+    problems = list(range(ddp_rank, num_problems, ddp_world_size))
+    problems_per_batch = max(1, batch_size // num_samples)
+    for b in range(0, len(problems), problems_per_batch):
+        conversations = [task_object[i] for i in problems[b:b + problems_per_batch]]
+
+        # Tokenize the prompts
+        encoded_prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
+        # Get the completions of all of them in one batch
+        results, _ = engine.generate_many(
+            encoded_prompts,
             num_samples=num_samples,
             max_tokens=max_new_tokens,
             temperature=temperature,
             top_k=top_k,
+            grammar=grammar,
         )
-        # Decode the completions as text
-        prefix_length = len(encoded_prompt)
-        completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in results]
-        # Evaluate success criteria
-        outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
-        passed = any(outcomes)
-
-        # Keep stats
-        total += 1
-        num_passed += int(passed)
+        for conversation, encoded_prompt, samples in zip(conversations, encoded_prompts, results):
+            # Decode the completions as text
+            prefix_length = len(encoded_prompt)
+            completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in samples]
+            # Evaluate success criteria
+            outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
+            passed = any(outcomes)
+
+            # Keep stats
+            total += 1
+            num_passed += int(passed)
 
         # Logging (overwrite the same line in the console)
         print(f"\r\033[KRank {ddp_rank} | {num_passed}/{total} ({100*num_passed/total:.2f}%)", end='', flush=True)
@@ -113,8 +127,10 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
         prompt_ids = torch.tensor(padded_prompt_ids, dtype=torch.long, device=device)
 
         # Get the logits for the whole batch of conversations in parallel (efficiency win here)
+        # only the answer position of each row is needed, so only those go through the lm_head
+        answer_positions = torch.tensor(answer_time_positions, dtype=torch.long, device=device).unsqueeze(1)
         with torch.no_grad():
-            logits = model(prompt_ids) # (B, T, V)
+            logits = model(prompt_ids, logit_positions=answer_positions) # (B, 1, V)
 
         # Focus on the available answer on just the letters corresponding to choices
         # Note that this helps the evaluation a lot because it specifically narrows the focus to only the available letters
@@ -131,8 +147,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
                     letter_to_id_cache[letter] = encoded_letter[0]
                 letter_ids.append(letter_to_id_cache[letter])
             # focus logits just down to the answer position and the available letters of the answer
-            answer_pos = answer_time_positions[idx]
-            focus_logits = logits[idx, answer_pos, letter_ids]
+            focus_logits = logits[idx, 0, letter_ids]
             # get the argmax letter (the predicted answer)
             argmax_letter_id = focus_logits.argmax(dim=-1).item()
             predicted_letter = letters[argmax_letter_id]
@@ -158,7 +173,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
 
 def run_chat_eval(task_name, model, tokenizer, engine,
                    batch_size=1, num_samples=1, max_new_tokens=512, temperature=0.0, top_k=50,
-                   max_problems=None):
+                   max_problems=None, constrained=False, generative_batch_size=1):
     # Create the evaluation object
     task_module = {
         'HumanEval': HumanEval,
@@ -171,7 +186,11 @@ def run_chat_eval(task_name, model, tokenizer, engine,
     task_object = task_module()
     # Run the evaluation
     if task_object.eval_type == 'generative':
-        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems)
+        grammar = None
+        if constrained and task_name in ANSWER_PATTERNS:
+            tool_tokens = tuple(tokenizer.encode_special(s) for s in ["<|python_start|>", "<|python_end|>"])
+            grammar = compile_grammar(ANSWER_PATTERNS[task_name], tokenizer, free_tokens=tool_tokens)
+        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems, batch_size=generative_batch_size, grammar=grammar)
     elif task_object.eval_type == 'categorical':
         acc = run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=max_problems)
     else:
@@ -191,11 +210,17 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--num-samples', type=int, default=1)
     parser.add_argument('-k', '--top-k', type=int, default=50)
     parser.add_argument('-b', '--batch-size', type=int, default=8, help='Batch size for categorical evaluation')
+    parser.add_argument('--generative-batch-size', type=int, default=1, help='Rows decoded together for generative evaluation (1 = one problem at a time)')
     parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
     parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
     parser.add_argument('-x', '--max-problems', type=int, default=None, help='Max problems to evaluate')
+    parser.add_argument('--prompt-lookup', action='store_true', help='Speculative decoding with n-gram drafts looked up in the prompt (same outputs, faster on copy-heavy tasks)')
+    parser.add_argument('--prefix-cache-tokens', type=int, default=0, help='Keep the KV of up to this many prompt tokens around for reuse across problems (0 = off)')
+    parser.add_argument('--constrained', action='store_true', help='Decode GSM8K/SpellingBee answers under a grammar that requires the "#### <number>" ending, HumanEval ones with a fenced code block (not with --prompt-lookup)')
     parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
     args = parser.parse_args()
+    if args.constrained and args.prompt_lookup:
+        parser.error("--constrained decodes one token per step and cannot be combined with --prompt-lookup")
 
     device_type = autodetect_device_type() if args.device_type == "" else args.device_type
     ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
@@ -203,7 +228,7 @@ if __name__ == "__main__":
     autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
     model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
-    engine = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer, prefix_cache_tokens=args.prefix_cache_tokens, prompt_lookup=args.prompt_lookup)
 
     # Get the tasks to evaluate on
     all_tasks = ['ARC-Easy', 'ARC-Challenge', 'MMLU', 'GSM8K', 'HumanEval', 'SpellingBee']
@@ -230,9 +255,14 @@ if __name__ == "__main__":
                 temperature=args.temperature,
                 top_k=args.top_k,
                 max_problems=args.max_problems,
+                constrained=args.constrained,
+                generative_batch_size=args.generative_batch_size,
             )
             results[task_name] = acc
             print0(f"{task_name} accuracy: {100 * acc:.2f}%")
+            if engine.num_drafted > 0:
+                print0(f"{task_name} draft acceptance: {engine.num_accepted}/{engine.num_drafted} ({100 * engine.acceptance_rate:.2f}%)")
+                engine.num_drafted = engine.num_accepted = 0
 
     # Log to report
     from nanochat.report import get_report
@@ -51,6 +51,9 @@ parser.add_argument("--num-samples", type=int, default=16, help="number of sampl
 parser.add_argument("--max-new-tokens", type=int, default=256, help="max tokens to generate per sample")
 parser.add_argument("--temperature", type=float, default=1.0, help="sampling temperature")
 parser.add_argument("--top-k", type=int, default=50, help="top-k sampling (0 = disabled)")
+parser.add_argument("--prompt-lookup", type=int, default=0, help="speculative decoding with n-gram drafts from the prompt (same samples distribution, 0 = off)")
+parser.add_argument("--cascade", type=int, default=0, help="cascade attention: the samples of a question read its KV once per step (0 = off)")
+parser.add_argument("--prefix-cache-tokens", type=int, default=0, help="keep the KV of up to this many prompt tokens for reuse across generate calls, cleared after every update (0 = off)")
 # Optimization
 parser.add_argument("--embedding-lr", type=float, default=0.2, help="learning rate for embedding parameters (Adam)")
 parser.add_argument("--unembedding-lr", type=float, default=0.004, help="learning rate for unembedding parameters (Adam)")
@@ -78,7 +81,7 @@ wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-rl
 
 # Init model and tokenizer
 model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.model_step)
-engine = Engine(model, tokenizer) # for sampling rollouts
+engine = Engine(model, tokenizer, prefix_cache_tokens=args.prefix_cache_tokens, prompt_lookup=bool(args.prompt_lookup), cascade=bool(args.cascade)) # for sampling rollouts
 
 # -----------------------------------------------------------------------------
 # Rollout / sampling generator loop that yields batches of examples for training
@@ -107,8 +110,8 @@ def get_batch():
         generated_token_sequences = []
         masks = []
         num_sampling_steps = args.num_samples // args.device_batch_size # go sequentially to prevent OOMs
+        seed = hash((step, example_idx)) & 0x7FFFFFFF # positive half of int32
         for sampling_step in range(num_sampling_steps):
-            seed = hash((step, example_idx, sampling_step)) & 0x7FFFFFFF # positive half of int32
             with autocast_ctx:
                 generated_token_sequences_batch, masks_batch = engine.generate_batch(
                     tokens,
@@ -116,7 +119,8 @@ def get_batch():
                     max_tokens=args.max_new_tokens,
                     temperature=args.temperature,
                     top_k=args.top_k,
-                    seed=seed, # must make sure to change the seed for each sampling step
+                    seed=seed,
+                    first_sample=sampling_step * args.device_batch_size, # samples are keyed by index, the same whatever device_batch_size
                 )
             generated_token_sequences.extend(generated_token_sequences_batch)
             masks.extend(masks_batch)
@@ -159,43 +163,50 @@ def run_gsm8k_eval(task, tokenizer, engine,
     num_samples=1,
     max_completion_tokens=256,
     temperature=0.0,
-    top_k=50
+    top_k=50,
+    batch_size=None,
 ):
     """
     Evaluates GSM8K task and returns a list of records of evaluation outcomes.
     In a distributed setting, all ranks cooperate but this function will NOT
     do the reduction across ranks. This is the responsibility of the caller.
     Because the evaluation can take a while, this function will yield records one by one.
+    The samples of as many examples as batch_size rows hold (default device_batch_size) are generated together.
     """
     max_examples = min(max_examples, len(task)) if max_examples is not None else len(task)
-    for idx in range(ddp_rank, max_examples, ddp_world_size):
-        conversation = task[idx]
-        tokens = tokenizer.render_for_completion(conversation)
-        prefix_length = len(tokens)
-        # Generate k samples using batched generation inside the Engine
-        assert num_samples <= args.device_batch_size # usually this is true. we can add a loop if not...
-        generated_token_sequences, masks = engine.generate_batch(
-            tokens,
+    batch_size = batch_size or args.device_batch_size
+    assert num_samples <= batch_size # usually this is true. we can add a loop if not...
+    indices = list(range(ddp_rank, max_examples, ddp_world_size))
+    examples_per_batch = batch_size // num_samples
+    for b in range(0, len(indices), examples_per_batch):
+        batch = indices[b:b + examples_per_batch]
+        conversations = [task[idx] for idx in batch]
+        prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
+        # Generate k samples of every example using batched generation inside the Engine
+        generated, masks = engine.generate_many(
+            prompts,
             num_samples=num_samples,
             max_tokens=max_completion_tokens,
             temperature=temperature,
             top_k=top_k
         )
-        # Check each sample for correctness
-        outcomes = []
-        for sample_tokens in generated_token_sequences:
-            generated_tokens = sample_tokens[prefix_length:]
-            generated_text = tokenizer.decode(generated_tokens)
-            is_correct = task.evaluate(conversation, generated_text)
-            outcomes.append({
-                "is_correct": is_correct
-            })
-        # A bit bloated because I wanted to do more complex logging at one point.
-        record = {
-            "idx": idx,
-            "outcomes": outcomes,
-        }
-        yield record
+        for idx, conversation, tokens, generated_token_sequences in zip(batch, conversations, prompts, generated):
+            prefix_length = len(tokens)
+            # Check each sample for correctness
+            outcomes = []
+            for sample_tokens in generated_token_sequences:
+                generated_tokens = sample_tokens[prefix_length:]
+                generated_text = tokenizer.decode(generated_tokens)
+                is_correct = task.evaluate(conversation, generated_text)
+                outcomes.append({
+                    "is_correct": is_correct
+                })
+            # A bit bloated because I wanted to do more complex logging at one point.
+            record = {
+                "idx": idx,
+                "outcomes": outcomes,
+            }
+            yield record
 
 # -----------------------------------------------------------------------------
 # Training loop
@@ -252,6 +263,7 @@ for step in range(num_steps):
         })
 
     # Forward/Backward on rollouts over multiple examples in the dataset
+    engine.reset_stats() # the decode stats printed below are those of this step's rollouts
     rewards_list = []
     sequence_lengths = []
     for example_step in range(examples_per_rank):
@@ -297,6 +309,10 @@ for step in range(num_steps):
         mean_reward = mean_reward_tensor.item()
         mean_sequence_length = mean_sequence_length_tensor.item()
     print0(f"Step {step}/{num_steps} | Average reward: {mean_reward} | Average sequence length: {mean_sequence_length:.2f}")
+    if args.prompt_lookup:
+        print0(f"Step {step}/{num_steps} | Draft acceptance rate: {100 * engine.acceptance_rate:.2f}%")
+    step_ms, host_ms = engine.step_stats()
+    print0(f"Step {step}/{num_steps} | Decode step: {step_ms:.2f}ms, of which host: {host_ms:.2f}ms")
     wandb_run.log({
         "step": step,
         "reward": mean_reward,
@@ -311,6 +327,7 @@ for step in range(num_steps):
     for opt in optimizers: # then step the optimizers
         opt.step()
     model.zero_grad(set_to_none=True)
+    engine.clear_prefix_cache() # the cached KV was computed with the old weights
     wandb_run.log({
         "step": step,
         "lrm": lrm,
@@ -3,7 +3,9 @@
 Unified web chat server - serves both UI and API from a single FastAPI instance.
 
 Uses data parallelism to distribute requests across multiple GPUs. Each GPU loads
-a full copy of the model, and incoming requests are distributed to available workers.
+a full copy of the model, and incoming requests are distributed to the least busy worker.
+Each worker runs continuous batching: new requests join its running decode batch at
+the next step, and finished requests leave it right away.
 
 Launch examples:
 
@@ -47,7 +49,7 @@ from dataclasses import dataclass
 from contextlib import nullcontext
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.engine import Engine, BatchScheduler, ToolExecutor, calculator_tool, python_tool
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -57,6 +59,8 @@ MIN_TEMPERATURE = 0.0
 MAX_TEMPERATURE = 2.0
 MIN_TOP_K = 1
 MAX_TOP_K = 200
+MAX_REPETITION_PENALTY = 2.0
+MAX_FREQUENCY_PENALTY = 2.0
 MIN_MAX_TOKENS = 1
 MAX_MAX_TOKENS = 4096
 
@@ -66,6 +70,13 @@ parser.add_argument('-i', '--source', type=str, default="sft", help="Source of t
 parser.add_argument('-t', '--temperature', type=float, default=0.8, help='Default temperature for generation')
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Default top-k sampling parameter')
 parser.add_argument('-m', '--max-tokens', type=int, default=512, help='Default max tokens for generation')
+parser.add_argument('-b', '--max-batch-size', type=int, default=32, help='Max concurrent sequences decoded together per GPU')
+parser.add_argument('--prefill-chunk-size', type=int, default=512, help='Max prompt tokens prefilled per decode step, bounds the stall for users already streaming')
+parser.add_argument('--kv-int8', action='store_true', help='Store the KV cache in int8 (per token and head scales), about twice the tokens in the same memory')
+parser.add_argument('--tool', type=str, default='calculator', choices=['calculator', 'python'], help='Backend of the python tool: the restricted calculator, or real code in the nanochat.execution sandbox')
+parser.add_argument('--compile', action='store_true', help='Compile the decode step (torch.compile, CUDA graphs), slower startup')
+parser.add_argument('--kv-cache-tokens', type=int, default=65536, help='Size of the paged KV cache per GPU, in tokens (shared by all sequences)')
+parser.add_argument('--attention-sinks', type=int, default=0, help='Keep the first N tokens plus a recent window per sequence and evict the middle, so conversations can outgrow the sequence length (StreamingLLM). Uses a dense cache of max-batch-size sequences instead of the paged one. 0 = off')
 parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
 parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
 parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run the server on')
@@ -94,6 +105,49 @@ class Worker:
     engine: Engine
     tokenizer: object
     autocast_ctx: torch.amp.autocast
+    scheduler: BatchScheduler
+    streams: dict # Request -> asyncio.Queue of (token, finished) for the response streaming it, or STEP_FAILED
+    wakeup: asyncio.Event # set when a new request is submitted to an idle scheduler
+
+STEP_FAILED = None # put on the streams of a worker whose decode step raised, their requests are dropped
+
+def fail_requests(worker: Worker):
+    """A decode step raised: end every in-flight request of the worker with an error, so the scheduler can go on."""
+    for queue in worker.streams.values():
+        queue.put_nowait(STEP_FAILED)
+    # cancel everything the scheduler holds (not only the streamed requests), so the failing batch is not retried
+    scheduler = worker.scheduler
+    items = [*scheduler.rows, *scheduler.waiting] + ([scheduler.prefilling] if scheduler.prefilling is not None else [])
+    for request in {getattr(item, "request", item) for item in items} | set(worker.streams):
+        try:
+            scheduler.cancel(request)
+        except Exception:
+            logger.exception(f"Failed to cancel a request on GPU {worker.gpu_id}")
+
+async def run_scheduler(worker: Worker):
+    """Drive the continuous batching loop of a worker: one decode step for all of its in-flight requests at a time."""
+    while True:
+        if not worker.scheduler.has_work():
+            worker.wakeup.clear()
+            await worker.wakeup.wait()
+            continue
+        if worker.scheduler.idle_on_tools():
+            await asyncio.sleep(0.005) # every row waits on a tool call, don't block the event loop until one is done
+            continue
+        try:
+            with worker.autocast_ctx:
+                events = worker.scheduler.step()
+        except Exception:
+            # e.g. out of memory: the requests in flight fail, but the worker keeps serving new ones
+            logger.exception(f"Decode step failed on GPU {worker.gpu_id}")
+            fail_requests(worker)
+            await asyncio.sleep(0)
+            continue
+        for state, token, mask in events:
+            queue = worker.streams.get(state.request)
+            if queue is not None:
+                queue.put_nowait((token, state.finished))
+        await asyncio.sleep(0) # let the response streams (and new requests) run between steps
 
 class WorkerPool:
     """Pool of workers, each with a model replica on a different GPU."""
@@ -106,7 +160,7 @@ class WorkerPool:
                 num_gpus = 1 # e.g. cpu|mps
         self.num_gpus = num_gpus
         self.workers: List[Worker] = []
-        self.available_workers: asyncio.Queue = asyncio.Queue()
+        self.tasks = [] # the scheduler loop of each worker
 
     async def initialize(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
         """Load model on each GPU."""
@@ -124,28 +178,51 @@ class WorkerPool:
                 print(f"Loading model on {device_type}...")
 
             model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
-            engine = Engine(model, tokenizer)
+            engine = Engine(model, tokenizer, compile_decode=args.compile)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
+            tool_executor = ToolExecutor(python_tool if args.tool == "python" else calculator_tool)
+            if args.attention_sinks > 0:
+                # every sequence keeps its sinks and a recent window in its own row, evicting the middle as it grows
+                scheduler = engine.scheduler(
+                    max_batch_size=args.max_batch_size,
+                    prefill_chunk_size=args.prefill_chunk_size,
+                    attention_sinks=args.attention_sinks,
+                    tool_executor=tool_executor,
+                )
+            else:
+                scheduler = engine.scheduler(
+                    max_batch_size=args.max_batch_size,
+                    paged=True,
+                    num_blocks=args.kv_cache_tokens // 256,
+                    block_size=256,
+                    prefill_chunk_size=args.prefill_chunk_size,
+                    quantize_kv=args.kv_int8,
+                    prefix_cache=True, # multi-turn chats and shared system prompts reuse the KV of earlier requests
+                    tool_executor=tool_executor,
+                )
             worker = Worker(
                 gpu_id=gpu_id,
                 device=device,
                 engine=engine,
                 tokenizer=tokenizer,
-                autocast_ctx=autocast_ctx
+                autocast_ctx=autocast_ctx,
+                scheduler=scheduler,
+                streams={},
+                wakeup=asyncio.Event(),
             )
+            if args.compile:
+                print(f"Compiling the decode step for 1..{args.max_batch_size} rows...")
+                with autocast_ctx:
+                    worker.scheduler.warmup()
             self.workers.append(worker)
-            await self.available_workers.put(worker)
+            self.tasks.append(asyncio.create_task(run_scheduler(worker)))
 
         print(f"All {self.num_gpus} workers initialized!")
 
-    async def acquire_worker(self) -> Worker:
-        """Get an available worker from the pool."""
-        return await self.available_workers.get()
-
-    async def release_worker(self, worker: Worker):
-        """Return a worker to the pool."""
-        await self.available_workers.put(worker)
+    def acquire_worker(self) -> Worker:
+        """Get the worker with the fewest in-flight requests. Workers are shared, there is nothing to release."""
+        return min(self.workers, key=lambda w: len(w.streams))
 
 class ChatMessage(BaseModel):
     role: str
@@ -156,6 +233,10 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
     top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    min_p: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
 
 def validate_chat_request(request: ChatRequest):
     """Validate chat request to prevent abuse."""
@@ -212,6 +293,16 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"top_k must be between {MIN_TOP_K} and {MAX_TOP_K}"
             )
 
+    # Validate top_p, min_p and the penalties
+    if request.top_p is not None and not (0.0 < request.top_p <= 1.0):
+        raise HTTPException(status_code=400, detail="top_p must be in (0, 1]")
+    if request.min_p is not None and not (0.0 <= request.min_p <= 1.0):
+        raise HTTPException(status_code=400, detail="min_p must be between 0 and 1")
+    if request.repetition_penalty is not None and not (0.0 < request.repetition_penalty <= MAX_REPETITION_PENALTY):
+        raise HTTPException(status_code=400, detail=f"repetition_penalty must be in (0, {MAX_REPETITION_PENALTY}]")
+    if request.frequency_penalty is not None and not (-MAX_FREQUENCY_PENALTY <= request.frequency_penalty <= MAX_FREQUENCY_PENALTY):
+        raise HTTPException(status_code=400, detail=f"frequency_penalty must be between {-MAX_FREQUENCY_PENALTY} and {MAX_FREQUENCY_PENALTY}")
+
     # Validate max_tokens
     if request.max_tokens is not None:
         if not (MIN_MAX_TOKENS <= request.max_tokens <= MAX_MAX_TOKENS):
@@ -264,9 +355,10 @@ async def generate_stream(
     tokens,
     temperature=None,
     max_new_tokens=None,
-    top_k=None
+    top_k=None,
+    **sampling
 ) -> AsyncGenerator[str, None]:
-    """Generate assistant response with streaming."""
+    """Generate assistant response with streaming. sampling: top_p, min_p, repetition_penalty, frequency_penalty."""
     temperature = temperature if temperature is not None else args.temperature
     max_new_tokens = max_new_tokens if max_new_tokens is not None else args.max_tokens
     top_k = top_k if top_k is not None else args.top_k
@@ -279,16 +371,27 @@ async def generate_stream(
     # Track the last complete UTF-8 string (without replacement characters)
     last_clean_text = ""
 
-    with worker.autocast_ctx:
-        for token_column, token_masks in worker.engine.generate(
-            tokens,
-            num_samples=1,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-            seed=random.randint(0, 2**31 - 1)
-        ):
-            token = token_column[0]
+    # Submit to the worker's scheduler, the request joins its running batch at the next step
+    request = worker.scheduler.add_request(
+        tokens,
+        num_samples=1,
+        max_tokens=max_new_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        seed=random.randint(0, 2**31 - 1),
+        **{name: value for name, value in sampling.items() if value is not None}
+    )
+    queue = asyncio.Queue()
+    worker.streams[request] = queue
+    worker.wakeup.set()
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is STEP_FAILED:
+                yield f"data: {json.dumps({'error': 'Generation failed, please try again'})}\n\n"
+                return
+            token, finished = item
 
             # Stopping criteria
             if token == assistant_end or token == bos:
@@ -308,6 +411,14 @@ async def generate_stream(
                     yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
                     last_clean_text = current_text
 
+            if finished:
+                break
+    finally:
+        # Leave the batch right away if the client went away mid-stream
+        worker.streams.pop(request, None)
+        if not request.finished:
+            worker.scheduler.cancel(request)
+
     yield f"data: {json.dumps({'done': True})}\n\n"
 
 @app.post("/chat/completions")
@@ -323,63 +434,65 @@ async def chat_completions(request: ChatRequest):
         logger.info(f"[{message.role.upper()}]: {message.content}")
     logger.info("-"*20)
 
-    # Acquire a worker from the pool (will wait if all are busy)
+    # Pick the least busy worker, the request joins its running batch
     worker_pool = app.state.worker_pool
-    worker = await worker_pool.acquire_worker()
+    worker = worker_pool.acquire_worker()
 
-    try:
-        # Build conversation tokens
-        bos = worker.tokenizer.get_bos_token_id()
-        user_start = worker.tokenizer.encode_special("<|user_start|>")
-        user_end = worker.tokenizer.encode_special("<|user_end|>")
-        assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
-        assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-
-        conversation_tokens = [bos]
-        for message in request.messages:
-            if message.role == "user":
-                conversation_tokens.append(user_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(user_end)
-            elif message.role == "assistant":
-                conversation_tokens.append(assistant_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(assistant_end)
-
-        conversation_tokens.append(assistant_start)
-
-        # Streaming response with worker release after completion
-        response_tokens = []
-        async def stream_and_release():
-            try:
-                async for chunk in generate_stream(
-                    worker,
-                    conversation_tokens,
-                    temperature=request.temperature,
-                    max_new_tokens=request.max_tokens,
-                    top_k=request.top_k
-                ):
-                    # Accumulate response for logging
-                    chunk_data = json.loads(chunk.replace("data: ", "").strip())
-                    if "token" in chunk_data:
-                        response_tokens.append(chunk_data["token"])
-                    yield chunk
-            finally:
-                # Log the assistant response to console
-                full_response = "".join(response_tokens)
-                logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
-                logger.info("="*20)
-                # Release worker back to pool after streaming is done
-                await worker_pool.release_worker(worker)
-
-        return StreamingResponse(
-            stream_and_release(),
-            media_type="text/event-stream"
+    # Build conversation tokens
+    bos = worker.tokenizer.get_bos_token_id()
+    user_start = worker.tokenizer.encode_special("<|user_start|>")
+    user_end = worker.tokenizer.encode_special("<|user_end|>")
+    assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
+    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
+
+    conversation_tokens = [bos]
+    for message in request.messages:
+        if message.role == "user":
+            conversation_tokens.append(user_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(user_end)
+        elif message.role == "assistant":
+            conversation_tokens.append(assistant_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(assistant_end)
+
+    conversation_tokens.append(assistant_start)
+    if len(conversation_tokens) >= worker.scheduler.max_seq_len and not worker.scheduler.attention_sinks:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Conversation is too long. Maximum {worker.scheduler.max_seq_len} tokens allowed"
         )
-    except Exception as e:
-        # Make sure to release worker even on error
-        await worker_pool.release_worker(worker)
-        raise e
+
+    # Streaming response
+    response_tokens = []
+    async def stream_and_log():
+        try:
+            async for chunk in generate_stream(
+                worker,
+                conversation_tokens,
+                temperature=request.temperature,
+                max_new_tokens=request.max_tokens,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                min_p=request.min_p,
+                repetition_penalty=request.repetition_penalty,
+                frequency_penalty=request.frequency_penalty,
+            ):
+                # Accumulate response for logging
+                chunk_data = json.loads(chunk.replace("data: ", "").strip())
+                if "token" in chunk_data:
+                    response_tokens.append(chunk_data["token"])
+                yield chunk
+        finally:
+            # Log the assistant response to console
+            full_response = "".join(response_tokens)
+            logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
+            logger.info("="*20)
+
+    return StreamingResponse(
+        stream_and_log(),
+        media_type="text/event-stream"
+    )
 
 @app.get("/health")
 async def health():
@@ -389,7 +502,7 @@ async def health():
         "status": "ok",
         "ready": worker_pool is not None and len(worker_pool.workers) > 0,
         "num_gpus": worker_pool.num_gpus if worker_pool else 0,
-        "available_workers": worker_pool.available_workers.qsize() if worker_pool else 0
+        "active_requests": sum(len(w.streams) for w in worker_pool.workers) if worker_pool else 0
     }
 
 @app.get("/stats")
@@ -398,12 +511,14 @@ async def stats():
     worker_pool = app.state.worker_pool
     return {
         "total_workers": len(worker_pool.workers),
-        "available_workers": worker_pool.available_workers.qsize(),
-        "busy_workers": len(worker_pool.workers) - worker_pool.available_workers.qsize(),
+        "active_requests": sum(len(w.streams) for w in worker_pool.workers),
         "workers": [
             {
                 "gpu_id": w.gpu_id,
-                "device": str(w.device)
+                "device": str(w.device),
+                "active_requests": len(w.streams),
+                "active_rows": w.scheduler.num_active,
+                "waiting_requests": len(w.scheduler.waiting),
             } for w in worker_pool.workers
         ]
     }
@@ -16,18 +16,18 @@ Note on test structure:
 import torch
 import pytest
 import nanochat.flash_attention as fa_module
-from nanochat.flash_attention import flash_attn, HAS_FA3
-from nanochat.engine import KVCache
+from nanochat.flash_attention import flash_attn, HAS_FA
+from nanochat.engine import KVCache, PagedKVCache
 
 
 def set_impl(impl):
-    """Set the implementation override ('fa3', 'sdpa', or None for auto)."""
+    """Set the implementation override ('fa', 'sdpa', or None for auto)."""
     fa_module._override_impl = impl
 
 
 def run_both_impls(fn):
     """Run a function with both FA3 and SDPA, return both outputs."""
-    set_impl('fa3')
+    set_impl('fa')
     out_fa3 = fn()
     set_impl('sdpa')
     out_sdpa = fn()
@@ -47,7 +47,7 @@ def assert_close(t1, t2, name, atol=1e-2, rtol=1e-2):
 # =============================================================================
 # FA3 vs SDPA comparison tests (require Hopper GPU)
 # =============================================================================
-@pytest.mark.skipif(not HAS_FA3, reason="FA3 required to compare implementations")
+@pytest.mark.skipif(not HAS_FA, reason="FA3 required to compare implementations")
 class TestFA3VsSDPA:
     """Compare FA3 and SDPA produce identical results. Requires Hopper GPU."""
 
@@ -178,6 +178,50 @@ class TestFA3VsSDPA:
         max_diff, mean_diff = assert_close(y_fa3, y_sdpa, "single_token")
         print(f"single_token: max_diff={max_diff:.6f}, mean_diff={mean_diff:.6f}")
 
+    def test_kvcache_int8(self):
+        """FA and SDPA dequantize an int8 cache the same way."""
+        B, T_max, H, D = 2, 64, 4, 32
+        q = torch.randn(B, 9, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        k = torch.randn(B, 9, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        v = torch.randn(B, 9, H, D, device=self.DEVICE, dtype=self.DTYPE)
+
+        def run():
+            k_cache = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=torch.int8)
+            v_cache = torch.zeros_like(k_cache)
+            k_scale = torch.zeros(B, T_max, H, device=self.DEVICE, dtype=self.DTYPE)
+            v_scale = torch.zeros_like(k_scale)
+            cache_seqlens = torch.tensor([0, 5], dtype=torch.int32, device=self.DEVICE)
+            return flash_attn.flash_attn_with_kvcache(
+                q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
+                k_scale=k_scale, v_scale=v_scale, causal=True, window_size=(T_max, 0)
+            )
+
+        y_fa3, y_sdpa = run_both_impls(run)
+        max_diff, mean_diff = assert_close(y_fa3, y_sdpa, "int8")
+        print(f"int8: max_diff={max_diff:.6f}, mean_diff={mean_diff:.6f}")
+
+    def test_kvcache_ring_buffer(self):
+        """FA and SDPA read a sliding-window ring buffer cache the same way."""
+        B, R, H, D, window = 2, 12, 4, 32, 8
+        chunks = [[torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(3)] for T in [15, 1, 1, 4]] # q, k, v
+
+        def run():
+            k_cache = torch.zeros(B, R, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v_cache = torch.zeros_like(k_cache)
+            cache_seqlens = torch.tensor([0, 5], dtype=torch.int32, device=self.DEVICE)
+            ys = []
+            for q, k, v in chunks:
+                ys.append(flash_attn.flash_attn_with_kvcache(
+                    q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
+                    causal=True, window_size=(window, 0), ring_buffer=True
+                ))
+                cache_seqlens += q.size(1)
+            return torch.cat(ys, dim=1)
+
+        y_fa3, y_sdpa = run_both_impls(run)
+        max_diff, mean_diff = assert_close(y_fa3, y_sdpa, "ring")
+        print(f"ring: max_diff={max_diff:.6f}, mean_diff={mean_diff:.6f}")
+
     def test_backward_gradients_match(self):
         """Verify gradients are similar between FA3 and SDPA."""
         B, T, H, D = 2, 32, 4, 16
@@ -195,7 +239,7 @@ class TestFA3VsSDPA:
             loss.backward()
             return y.detach(), q.grad.detach(), k.grad.detach(), v.grad.detach()
 
-        set_impl('fa3')
+        set_impl('fa')
         y_fa3, q_grad_fa3, k_grad_fa3, v_grad_fa3 = run()
         set_impl('sdpa')
         y_sdpa, q_grad_sdpa, k_grad_sdpa, v_grad_sdpa = run()
@@ -299,6 +343,152 @@ class TestSDPAOnly:
         assert cache.get_pos() == T_prefill + 1
         set_impl(None)
 
+    def test_kvcache_paged_matches_dense(self):
+        """A paged cache (block pool + block table) gives the same outputs as a dense cache."""
+        set_impl('sdpa')
+        B, T_max, H, D = 2, 64, 4, 32
+        block_size, num_blocks = 8, 32
+        dense_k = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        dense_v = torch.zeros_like(dense_k)
+        pool_k = torch.zeros(num_blocks, block_size, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        pool_v = torch.zeros_like(pool_k)
+        # scattered, non-contiguous blocks for each row
+        block_table = torch.randperm(num_blocks, device=self.DEVICE)[:B * T_max // block_size].view(B, -1).int()
+        seqlens_dense = torch.zeros(B, dtype=torch.int32, device=self.DEVICE)
+        seqlens_paged = torch.zeros(B, dtype=torch.int32, device=self.DEVICE)
+
+        for T in [11, 1, 1, 5]: # prefill, two decode steps, a multi-token chunk
+            q = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            y_dense = flash_attn.flash_attn_with_kvcache(q, dense_k, dense_v, k=k, v=v,
+                cache_seqlens=seqlens_dense, causal=True, window_size=(T_max, 0))
+            y_paged = flash_attn.flash_attn_with_kvcache(q, pool_k, pool_v, k=k, v=v,
+                cache_seqlens=seqlens_paged, block_table=block_table, causal=True, window_size=(T_max, 0))
+            seqlens_dense += T
+            seqlens_paged += T
+            assert_close(y_dense, y_paged, f"paged_T{T}", atol=1e-5, rtol=1e-5)
+        set_impl(None)
+
+    def test_kvcache_int8_close_to_full_precision(self):
+        """An int8 cache (dense or paged, ragged positions) stays within quantization error of a full precision one."""
+        set_impl('sdpa')
+        B, T_max, H, D = 2, 64, 4, 32
+        block_size, num_blocks = 8, 16
+        full_k = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        full_v = torch.zeros_like(full_k)
+        int8_k = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=torch.int8)
+        int8_v = torch.zeros_like(int8_k)
+        scales = [torch.zeros(B, T_max, H, device=self.DEVICE, dtype=self.DTYPE) for _ in range(2)]
+        pool_k = torch.zeros(num_blocks, block_size, H, D, device=self.DEVICE, dtype=torch.int8)
+        pool_v = torch.zeros_like(pool_k)
+        pool_scales = [torch.zeros(num_blocks, block_size, H, device=self.DEVICE, dtype=self.DTYPE) for _ in range(2)]
+        block_table = torch.randperm(num_blocks, device=self.DEVICE).view(B, -1).int()
+        seqlens = torch.tensor([0, 7], dtype=torch.int32, device=self.DEVICE) # rows at different positions
+
+        for T in [11, 1, 1, 5]:
+            q = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            kwargs = dict(k=k, v=v, cache_seqlens=seqlens, causal=True, window_size=(T_max, 0))
+            y_full = flash_attn.flash_attn_with_kvcache(q, full_k, full_v, **kwargs)
+            y_int8 = flash_attn.flash_attn_with_kvcache(q, int8_k, int8_v, k_scale=scales[0], v_scale=scales[1], **kwargs)
+            y_paged = flash_attn.flash_attn_with_kvcache(q, pool_k, pool_v, block_table=block_table,
+                k_scale=pool_scales[0], v_scale=pool_scales[1], **kwargs)
+            seqlens += T
+            assert_close(y_full, y_int8, f"int8_T{T}", atol=3e-2, rtol=0)
+            assert_close(y_int8, y_paged, f"int8_paged_T{T}", atol=1e-5, rtol=1e-5)
+        set_impl(None)
+
+    def test_kvcache_ring_buffer_matches_full_cache(self):
+        """A ring buffer of the last R >= window positions gives the same attention as the full cache, chunks longer than R included."""
+        set_impl('sdpa')
+        B, T_max, R, H, D, window = 2, 64, 12, 4, 32, 8
+        full_k = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        full_v = torch.zeros_like(full_k)
+        ring_k = torch.zeros(B, R, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        ring_v = torch.zeros_like(ring_k)
+        seqlens = torch.tensor([0, 7], dtype=torch.int32, device=self.DEVICE) # rows at different positions
+
+        for T in [15, 1, 1, 5, 1]:
+            q = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v = torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            kwargs = dict(k=k, v=v, cache_seqlens=seqlens, causal=True, window_size=(window, 0))
+            y_full = flash_attn.flash_attn_with_kvcache(q, full_k, full_v, **kwargs)
+            y_ring = flash_attn.flash_attn_with_kvcache(q, ring_k, ring_v, ring_buffer=True, **kwargs)
+            seqlens += T
+            assert_close(y_full, y_ring, f"ring_T{T}", atol=1e-5, rtol=1e-5)
+        set_impl(None)
+
+    def test_kvcache_ragged_rows_match_one_row_at_a_time(self):
+        """Rows at different positions go through one batched masked call, matching every row run on its own."""
+        set_impl('sdpa')
+        B, T_max, H, D, block_size = 3, 32, 4, 16, 8
+        for window in [T_max, 5]:
+            for paged in [False, True]:
+                shape = (B * T_max // block_size, block_size, H, D) if paged else (B, T_max, H, D)
+                k_cache, v_cache = (torch.zeros(shape, device=self.DEVICE, dtype=self.DTYPE) for _ in range(2))
+                rows_k, rows_v = (torch.zeros(B, 1, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(2))
+                block_table = torch.randperm(shape[0], device=self.DEVICE).view(B, -1).int() if paged else None
+                seqlens = torch.tensor([0, 3, 9], dtype=torch.int32, device=self.DEVICE)
+                for T in [6, 1, 1, 3]:
+                    q, k, v = (torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(3))
+                    y = flash_attn.flash_attn_with_kvcache(q, k_cache, v_cache, k=k, v=v, cache_seqlens=seqlens,
+                        block_table=block_table, causal=True, window_size=(window, 0), host_seqlens=seqlens.cpu())
+                    for b in range(B):
+                        y_row = flash_attn.flash_attn_with_kvcache(q[b:b+1], rows_k[b], rows_v[b], k=k[b:b+1], v=v[b:b+1],
+                            cache_seqlens=seqlens[b:b+1], causal=True, window_size=(window, 0))
+                        assert_close(y[b:b+1], y_row, f"ragged_T{T}_w{window}_row{b}", atol=1e-5, rtol=1e-5)
+                    seqlens += T
+        assert fa_module._attention_mask(6, 6, 5, torch.device(self.DEVICE)) is fa_module._attention_mask(6, 6, 5, torch.device(self.DEVICE))
+        set_impl(None)
+
+    def test_kvcache_cascade_matches_paged(self):
+        """Cascade attention (shared prefix once per group, merged by log-sum-exp) matches reading every row's blocks."""
+        set_impl('sdpa')
+        H, Hk, D = 4, 2, 16
+        cache = PagedKVCache(batch_size=5, num_heads=Hk, seq_len=32, head_dim=D, num_layers=1,
+                             device=self.DEVICE, dtype=self.DTYPE, num_blocks=32, block_size=4)
+        cache.k_cache.normal_()
+        cache.v_cache.normal_()
+        for row, length in [(0, 10), (3, 9)]: # two prompts, forked into rows 0-2 and 3-4
+            assert cache.reserve(row, length)
+            cache.set_pos(row, [length])
+        cache.fork_row(0, 1, 3)
+        cache.fork_row(3, 4, 5)
+        cache.set_pos(0, [10, 12, 11, 9, 13]) # the samples have generated different amounts since
+        for row in range(5):
+            assert cache.reserve(row, 20)
+        cascade = cache.shared_prefixes(0, 5)
+        assert [(g[0].tolist(), g[2]) for g in cascade.groups] == [([0, 1, 2], 8), ([3, 4], 8)]
+        k_cache, v_cache = cache.get_layer_cache(0)
+        for T in [1, 3]:
+            q = torch.randn(5, T, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k, v = (torch.randn(5, T, Hk, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(2))
+            kwargs = dict(k=k, v=v, cache_seqlens=cache.cache_seqlens, block_table=cache.block_table, causal=True,
+                          window_size=(-1, 0), host_seqlens=cache.host_seqlens)
+            y = flash_attn.flash_attn_with_kvcache(q, k_cache.clone(), v_cache.clone(), **kwargs)
+            y_cascade = flash_attn.flash_attn_with_kvcache(q, k_cache, v_cache, cascade=cascade, **kwargs)
+            assert_close(y, y_cascade, f"cascade_T{T}", atol=1e-5, rtol=1e-5)
+        set_impl(None)
+
+    def test_kvcache_static_shapes_match(self):
+        """The static shape path (whole cache, per-row mask, used under torch.compile) matches the ragged one."""
+        set_impl('sdpa')
+        B, T_max, H, D = 3, 32, 4, 16
+        for window in [T_max, 5]:
+            caches = [torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(4)]
+            seqlens = torch.tensor([0, 3, 9], dtype=torch.int32, device=self.DEVICE)
+            for T in [6, 1, 1, 3]:
+                q, k, v = (torch.randn(B, T, H, D, device=self.DEVICE, dtype=self.DTYPE) for _ in range(3))
+                y = flash_attn.flash_attn_with_kvcache(q, caches[0], caches[1], k=k, v=v,
+                    cache_seqlens=seqlens, causal=True, window_size=(window, 0))
+                y_static = fa_module._sdpa_masked_kvcache(q, caches[2], caches[3], k, v, seqlens, None, None, None, (window, 0))
+                seqlens += T
+                assert_close(y, y_static, f"static_T{T}_w{window}", atol=1e-5, rtol=1e-5)
+        set_impl(None)
+
 
 # =============================================================================
 # Override mechanism tests
@@ -306,23 +496,23 @@ class TestSDPAOnly:
 class TestOverrideMechanism:
     """Test that the override mechanism works correctly."""
 
-    @pytest.mark.skipif(not HAS_FA3, reason="FA3 required")
-    def test_override_fa3(self):
-        """Test that override='fa3' uses FA3."""
-        set_impl('fa3')
-        assert fa_module._use_fa3() == True
+    @pytest.mark.skipif(not HAS_FA, reason="FA3 required")
+    def test_override_fa(self):
+        """Test that override='fa' uses FA."""
+        set_impl('fa')
+        assert fa_module._use_fa() == True
         set_impl(None)
 
     def test_override_sdpa(self):
         """Test that override='sdpa' uses SDPA."""
         set_impl('sdpa')
-        assert fa_module._use_fa3() == False
+        assert fa_module._use_fa() == False
         set_impl(None)
 
     def test_override_auto(self):
         """Test that override=None uses auto-detection."""
         set_impl(None)
-        assert fa_module._use_fa3() == HAS_FA3
+        assert fa_module._use_fa() == HAS_FA
 
 
 if __name__ == "__main__":
@@ -332,7 +522,7 @@ if __name__ == "__main__":
         print(f"CUDA device: {torch.cuda.get_device_name()}")
         major, minor = torch.cuda.get_device_capability()
         print(f"Compute capability: {major}.{minor}")
-    print(f"HAS_FA3: {HAS_FA3}")
+    print(f"HAS_FA: {HAS_FA}")
     print()
 
     pytest.main([__file__, "-v", "-s"])
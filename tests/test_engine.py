@@ -4,8 +4,16 @@ Test Engine class. Example run:
 python -m pytest tests/test_engine.py -v
 """
 
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 import torch
-from nanochat.engine import KVCache, Engine
+from nanochat.engine import KVCache, KVPool, PagedKVCache, PrefixCache, NgramIndex, Engine, token_probs, sample_from_probs, counter_uniforms, _num_candidates
+from nanochat.engine import ToolExecutor, calculator_tool, python_tool
+from nanochat.grammar import Grammar, compile_dfa
 from dataclasses import dataclass
 
 
@@ -36,7 +44,7 @@ class MockModel:
     def get_device(self):
         return self._device
 
-    def forward(self, ids, kv_cache=None):
+    def forward(self, ids, kv_cache=None, logit_positions=None):
         """Return uniform logits so sampling is spread across vocab."""
         B, T = ids.shape
         # With FA3, flash_attn_with_kvcache updates cache in-place and we advance position
@@ -44,7 +52,16 @@ class MockModel:
             kv_cache.advance(T)
         # Uniform logits -> equal probability for all tokens
         logits = torch.zeros(B, T, self.vocab_size)
-        return logits
+        return self.keep(logits, logit_positions)
+
+    @staticmethod
+    def keep(logits, logit_positions):
+        # same semantics as GPT.forward(logit_positions=...)
+        if logit_positions is None:
+            return logits
+        if isinstance(logit_positions, int):
+            return logits[:, -logit_positions:]
+        return logits.gather(1, logit_positions.unsqueeze(-1).expand(-1, -1, logits.size(-1)))
 
 
 class ByteTokenizer:
@@ -265,3 +282,844 @@ def test_different_seeds_introduce_variation_when_temperature_nonzero():
 
     # Sanity check: sampling actually introduces variation
     assert len(outputs) > 1, "All seeds produced the same output which is statistically highly improbable."
+
+
+# -----------------------------------------------------------------------------
+# Tests with a tiny real GPT (CPU, float32)
+
+def make_tiny_gpt(seed=0, **kwargs):
+    """A small randomly initialized GPT. The zero-init projections are re-randomized so outputs depend on context."""
+    from nanochat.gpt import GPT, GPTConfig
+    torch.manual_seed(seed)
+    config = GPTConfig(**{**dict(sequence_len=64, vocab_size=262, n_layer=2, n_head=4, n_kv_head=2, n_embd=64), **kwargs})
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for block in model.transformer.h:
+            torch.nn.init.normal_(block.attn.c_proj.weight, std=0.02)
+            torch.nn.init.normal_(block.mlp.c_proj.weight, std=0.02)
+        torch.nn.init.normal_(model.lm_head.weight, std=0.5)
+    model.eval()
+    return model
+
+
+def test_engine_matches_naive_generate():
+    """Greedy Engine.generate must reproduce the naive full-recompute GPT.generate."""
+    model = make_tiny_gpt()
+    engine = Engine(model, ByteTokenizer())
+    prompt = [261, 72, 101, 108, 108, 111]
+    reference = list(model.generate(prompt, max_tokens=12, temperature=0.0))
+    results, _ = engine.generate_batch(prompt, max_tokens=12, temperature=0.0)
+    assert results[0][len(prompt):] == reference[:len(results[0]) - len(prompt)]
+
+
+@pytest.mark.slow
+def test_compiled_decode_matches_eager():
+    """Warmed up batch sizes decode with the compiled step, with the same tokens as eager; other sizes run eager."""
+    model = make_tiny_gpt()
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)
+    engine = Engine(model, ByteTokenizer(), compile_decode=True)
+    engine.warmup(num_samples=2)
+    assert len(engine.compiled_decode.shapes) == 2 # 2 rows, and 1 once a sample finishes
+    calls = []
+    compiled = engine.compiled_decode.compiled
+    engine.compiled_decode.compiled = lambda ids, kv_cache: (calls.append(ids.size(0)), compiled(ids, kv_cache))[1]
+    results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)
+    assert results == expected and len(calls) == 19 # every decode step after the prefill
+    results, _ = engine.generate_batch(prompt, num_samples=3, max_tokens=20, temperature=0.0) # not warmed up: eager
+    assert results == expected[:1] * 3 and len(calls) == 19
+
+
+def test_scheduler_requests_join_running_batch():
+    """Requests joining a running batch (at different positions) must produce the same tokens as when run alone."""
+    model = make_tiny_gpt()
+    engine = Engine(model, ByteTokenizer())
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 87, 111], [261, 65, 66, 67, 68, 69, 70, 71, 72]]
+    expected = [engine.generate_batch(p, max_tokens=10, temperature=0.0)[0][0] for p in prompts]
+
+    scheduler = engine.scheduler(max_batch_size=4, max_seq_len=32)
+    requests = [scheduler.add_request(prompts[0], max_tokens=10, temperature=0.0)]
+    outputs = {}
+    num_steps = 0
+    while scheduler.has_work():
+        if num_steps in (2, 5): # late arrivals join the batch mid-flight
+            requests.append(scheduler.add_request(prompts[len(requests)], max_tokens=10, temperature=0.0))
+        for state, token, mask in scheduler.step():
+            output = outputs.setdefault(id(state.request), list(state.request.tokens))
+            if token not in (260, 261): # terminal tokens are not part of generate_batch results
+                output.append(token)
+        num_steps += 1
+    for request, exp in zip(requests, expected):
+        assert outputs[id(request)] == exp
+
+
+def test_generate_many_matches_generate_batch():
+    """Prompts of different lengths prefilled in one forward (varlen) and decoded together get the same samples as alone."""
+    model = make_tiny_gpt()
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 87, 111], [261, 65, 66, 67, 68, 69, 70, 71, 72], [261, 88, 89]]
+    kwargs = dict(num_samples=2, max_tokens=10, temperature=0.8, top_k=50)
+    expected = [Engine(model, ByteTokenizer()).generate_batch(p, **kwargs) for p in prompts]
+    prefill_shapes = []
+    forward = model.forward
+    def recording_forward(ids, **fwd_kwargs):
+        if ids.size(1) > 1:
+            prefill_shapes.append(tuple(ids.shape))
+        return forward(ids, **fwd_kwargs)
+    model.forward = recording_forward
+    for engine_kwargs, max_batch_size in [({}, None), ({}, 4), (dict(prefix_cache_tokens=64, block_size=4), None), (dict(quantize_kv=True), 6)]:
+        prefill_shapes.clear()
+        engine = Engine(model, ByteTokenizer(), **engine_kwargs)
+        results, masks = engine.generate_many(prompts, max_batch_size=max_batch_size, **kwargs)
+        assert [(r, m) for r, m in zip(results, masks)] == expected
+        assert any(shape[0] > 1 for shape in prefill_shapes) # several prompts in one prefill forward
+    # ring buffers (sliding-window layers) would lose kept positions to the padding: only equal lengths go together
+    engine = Engine(model, ByteTokenizer())
+    assert engine.scheduler(max_seq_len=45).kv_cache.ring_size > 0
+    prompts = [[261, 72, 101], [261, 87, 111], [261, 65, 66, 67, 68], [261, 88, 89]]
+    kwargs["max_tokens"] = 40 # a cache longer than the smaller window
+    expected = [engine.generate_batch(p, **kwargs) for p in prompts]
+    prefill_shapes.clear()
+    results, masks = engine.generate_many(prompts, **kwargs)
+    assert [(r, m) for r, m in zip(results, masks)] == expected
+    assert prefill_shapes == [(2, 3), (1, 5), (1, 3)]
+
+
+def test_scheduler_finished_rows_leave_batch():
+    """Rows that finish are removed from the batch immediately instead of being forwarded until the slowest row ends."""
+    model = MockModel()
+    batch_sizes = []
+    forward = model.forward
+    def recording_forward(ids, kv_cache=None, **kwargs):
+        batch_sizes.append(ids.size(0))
+        return forward(ids, kv_cache=kv_cache, **kwargs)
+    model.forward = recording_forward
+    scheduler = Engine(model, ByteTokenizer()).scheduler(max_batch_size=4, max_seq_len=64)
+    prompt = [261, 72, 101, 108, 108, 111]
+    for max_tokens in [2, 4, 8]:
+        scheduler.add_request(prompt, max_tokens=max_tokens)
+    while scheduler.has_work():
+        scheduler.step()
+    assert batch_sizes[0] == 3 # the three prompts are prefilled together
+    assert batch_sizes[1:] == [3, 2, 2, 1, 1, 1, 1]
+    assert scheduler.num_active == 0
+
+
+def test_generate_batch_compacts_finished_samples():
+    """Samples of one prompt that finish early stop being forwarded, and their results stay at their own index."""
+    model = FixedDistributionModel({65: 0.0, 260: 0.0}) # every step ends the row with probability 1/2
+    batch_sizes = []
+    forward = model.forward
+    def recording_forward(ids, kv_cache=None, **kwargs):
+        batch_sizes.append(ids.size(0))
+        return forward(ids, kv_cache=kv_cache, **kwargs)
+    model.forward = recording_forward
+    prompt = [261, 72, 101, 108, 108, 111]
+    results, masks = Engine(model, ByteTokenizer()).generate_batch(prompt, num_samples=8, max_tokens=30, seed=1)
+    decode_sizes = batch_sizes[1:] # skip the single prefill
+    lengths = [len(r) - len(prompt) for r in results] # sampled 'A's, every row then ended with <|assistant_end|>
+    assert decode_sizes == sorted(decode_sizes, reverse=True) and decode_sizes[0] < 8 # shrinks as rows finish
+    assert sum(decode_sizes) == sum(lengths) # row i is forwarded once per 'A' it sampled
+    assert len(set(lengths)) > 1 and all(r[len(prompt):] == [65] * n for r, n in zip(results, lengths))
+    assert all(m == [0] * len(prompt) + [1] * n for m, n in zip(masks, lengths))
+
+
+def test_generate_recycles_kv_storage():
+    """Calls of the same capacity class run on the storage of the previous one, with the same results as fresh caches."""
+    model = make_tiny_gpt()
+    kwargs = dict(num_samples=3, max_tokens=8, temperature=0.8, seed=3)
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 87, 111], [261, 65, 66, 67, 68, 69, 70]]
+    for engine_kwargs in [{}, dict(quantize_kv=True), dict(cascade=True, block_size=4)]:
+        expected = [Engine(model, ByteTokenizer(), **engine_kwargs).generate_batch(p, **kwargs) for p in prompts]
+        engine = Engine(model, ByteTokenizer(), **engine_kwargs)
+        assert [engine.generate_batch(p, **kwargs) for p in prompts] == expected # stale KV of the last call is ignored
+        pool = engine.kv_pool
+        assert pool.num_reuses == 2 * pool.num_allocs and len(pool.free) == pool.num_allocs
+        assert engine.generate_many(prompts, **kwargs) == tuple(map(list, zip(*expected))) # 9 rows: a larger class
+        assert len(pool.free) == pool.num_allocs # everything came back
+    pool = KVPool(max_bytes=0)
+    pool.release(pool.alloc((2, 3), torch.float32, "cpu", (4, 256)))
+    assert pool.free == [] # over the budget, dropped
+
+
+def test_kv_pool_stays_within_its_budget():
+    """Calls of many shapes don't pile up storage: the pool keeps at most kv_pool_bytes, recently used classes first."""
+    model = make_tiny_gpt()
+    prompt = [261, 72, 101, 108, 108, 111]
+    cache_bytes = 2 * 2 * 256 * 2 * 16 * 4 # K and V of one row: 2 layers, 256 positions, 2 heads of 16, float32
+    budget = 6 * cache_bytes
+    engine = Engine(model, ByteTokenizer(), kv_pool_bytes=budget)
+    for num_samples in [1, 2, 1, 2, 4, 8, 3, 16, 4]:
+        engine.generate_batch(prompt, num_samples=num_samples, max_tokens=4, seed=num_samples)
+        assert engine.kv_pool.num_bytes <= budget
+    assert engine.kv_pool.num_reuses > 0 # the small classes kept coming back
+    shapes = [tuple(t.shape) for t in engine.kv_pool.free]
+    assert (2, 4, 256, 2, 16) in shapes # the last one used is kept, the 8 and 16 row classes are not
+    assert all(shape[1] <= 4 for shape in shapes)
+
+
+def test_logprobs_match_a_teacher_forced_forward():
+    """The logprobs recorded while sampling are those of a forward over the finished sequences, top alternatives included."""
+    model = make_tiny_gpt()
+    prompt = [261, 72, 101, 108, 108, 111]
+    kwargs = dict(num_samples=3, max_tokens=12, temperature=0.9, seed=7)
+    expected = Engine(model, ByteTokenizer()).generate_batch(prompt, **kwargs)
+    for engine_kwargs in [{}, dict(draft_layers=1, num_draft_tokens=3)]:
+        engine = Engine(model, ByteTokenizer(), **engine_kwargs)
+        results, masks, logprobs = engine.generate_batch(prompt, logprobs=3, **kwargs)
+        if not engine_kwargs:
+            assert (results, masks) == expected
+        for result, scores in zip(results, logprobs):
+            assert len(scores) == len(result) - len(prompt)
+            reference = torch.log_softmax(model.forward(torch.tensor([result]))[0, len(prompt) - 1:-1], dim=-1)
+            top = reference.topk(3, dim=-1)
+            for t, (token, (logprob, alternatives)) in enumerate(zip(result[len(prompt):], scores)):
+                assert abs(logprob - reference[t, token].item()) < 1e-4
+                assert [token for token, _ in alternatives] == top.indices[t].tolist()
+                assert all(abs(lp - ref) < 1e-4 for (_, lp), ref in zip(alternatives, top.values[t].tolist()))
+        many = engine.generate_many([prompt, prompt[:3]], logprobs=3, **kwargs)
+        assert many[0][0] == results # prefilled along with another prompt, the same up to rounding
+        assert all([lp for lp, _ in a] == pytest.approx([lp for lp, _ in b], abs=1e-4) for a, b in zip(many[2][0], logprobs))
+    _, _, logprobs = Engine(model, ByteTokenizer()).generate_batch(prompt, logprobs=0, **kwargs)
+    assert all(alternatives == [] for scores in logprobs for _, alternatives in scores)
+
+
+BYTE_VOCAB = [bytes([i]) for i in range(256)] + [None] * 6 # ByteTokenizer: raw bytes, then the special tokens
+
+
+def test_grammar_tables_follow_the_regex():
+    """The byte DFA agrees with re.fullmatch, and the token tables allow exactly the tokens that keep a match possible."""
+    pattern = r"[\s\S]*#### -?[0-9][0-9,]*(\.[0-9]+)?"
+    transitions, accepting = compile_dfa(pattern)
+    for text in ["#### 42", "so 2+2=4\n#### -1,000.5", "#### ", "#### 4.", "## 4", "x#### 7y", "#### 1#### 2"]:
+        state = 0
+        for b in text.encode():
+            state = transitions[state][b]
+        assert accepting[state] == bool(re.fullmatch(pattern, text))
+    grammar = Grammar(pattern.removeprefix(r"[\s\S]*"), BYTE_VOCAB, end_tokens=[260], free_tokens=[256, 257])
+    state = grammar.start
+    for b in b"#### ":
+        assert grammar.allowed[state, b]
+        state = int(grammar.next_states[state, b])
+    allowed = grammar.allowed[state].nonzero().squeeze(1).tolist()
+    assert allowed == [ord("-")] + list(b"0123456789") + [256, 257] # a number, or a tool call, nothing else
+    state = int(grammar.next_states[state, ord("7")])
+    assert grammar.allowed[state, 260] and not grammar.final[state] # may end, or go on
+    assert grammar.allowed[state, 256] and int(grammar.next_states[state, 256]) == state # tool tokens are free
+    letter = Grammar("[ABCD]", BYTE_VOCAB, end_tokens=[260])
+    assert letter.allowed[letter.start].nonzero().squeeze(1).tolist() == list(b"ABCD")
+    assert letter.final[int(letter.next_states[letter.start, ord("B")])] # nothing can follow
+
+
+def test_grammar_tables_are_cached_on_disk(tmp_path, monkeypatch):
+    """The tables are built once per pattern and vocab, later Grammars load them."""
+    builds = []
+    build = Grammar._build
+    monkeypatch.setattr(Grammar, "_build", staticmethod(lambda *args: builds.append(args[0]) or build(*args)))
+    grammar = Grammar(r"\d+(\.\d+)?", BYTE_VOCAB, end_tokens=[260], cache_dir=tmp_path)
+    cached = Grammar(r"\d+(\.\d+)?", BYTE_VOCAB, end_tokens=[260], cache_dir=tmp_path)
+    assert torch.equal(cached.next_states, grammar.next_states) and torch.equal(cached.allowed, grammar.allowed)
+    Grammar(r"\d+", BYTE_VOCAB, end_tokens=[260], cache_dir=tmp_path) # another pattern
+    Grammar(r"\d+", BYTE_VOCAB[:-1], end_tokens=[260], cache_dir=tmp_path) # another vocab
+    assert builds == [r"\d+(\.\d+)?", r"\d+", r"\d+"]
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_constrained_generation_matches_the_grammar():
+    """Every constrained sample matches the regex and stops as soon as it can't go on, other requests are unaffected."""
+    model = make_tiny_gpt()
+    prompt = [261, 72, 101, 108, 108, 111]
+    number = Grammar(r"-?[0-9]{1,3}(\.[0-9])?", BYTE_VOCAB, end_tokens=[260])
+    letter = Grammar("[ABCD]", BYTE_VOCAB, end_tokens=[260])
+    engine = Engine(model, ByteTokenizer())
+    results, masks = engine.generate_many([prompt, prompt[:3]], num_samples=4, max_tokens=20, seed=3, grammar=number)
+    for samples in results:
+        for result in samples:
+            completion = result[len(prompt) if len(result) > len(prompt) and result[:len(prompt)] == prompt else 3:]
+            text = bytes(token for token in completion if token < 256).decode()
+            assert re.fullmatch(r"-?[0-9]{1,3}(\.[0-9])?", text)
+            assert len(completion) <= 7 # a final state (three digits and a decimal) ends the row without <|assistant_end|>
+    results, _ = engine.generate_batch(prompt, num_samples=8, max_tokens=20, temperature=1.0, grammar=letter)
+    assert all(len(result) == len(prompt) + 1 and chr(result[-1]) in "ABCD" for result in results)
+    # constrained and unconstrained rows side by side, through preemption of a paged cache
+    def run(**grammar):
+        scheduler = engine.scheduler(max_batch_size=4, max_seq_len=32, paged=True, num_blocks=8, block_size=4)
+        constrained = scheduler.add_request(prompt, num_samples=2, max_tokens=12, seed=1, **grammar)
+        plain = scheduler.add_request(prompt, num_samples=2, max_tokens=12, seed=5)
+        while scheduler.has_work():
+            scheduler.step()
+        return constrained, [state.current_tokens for state in plain.rows]
+
+    constrained, mixed = run(grammar=number)
+    assert mixed == run()[1]
+    for state in constrained.rows:
+        text = bytes(token for token in state.current_tokens[len(prompt):] if token < 256).decode()
+        assert re.fullmatch(r"-?[0-9]{1,3}(\.[0-9])?", text)
+    # drafts are not constrained, so speculative decoding refuses a grammar
+    with pytest.raises(ValueError):
+        Engine(model, ByteTokenizer(), prompt_lookup=True).generate_batch(prompt, max_tokens=5, grammar=letter)
+
+
+def test_paged_kv_cache_fork_shares_full_blocks():
+    """Forked rows share the full blocks of the prompt and only copy the partial last block."""
+    cache = PagedKVCache(batch_size=4, num_heads=2, seq_len=32, head_dim=4, num_layers=2,
+                         device="cpu", dtype=torch.float32, num_blocks=16, block_size=4)
+    assert cache.reserve(0, 10) # 3 blocks
+    cache.k_cache[:, cache.row_blocks[0]] = torch.randn(2, 3, 4, 2, 4)
+    cache.set_pos(0, [10])
+    cache.fork_row(0, 1, 4)
+    assert cache.num_free_blocks == 16 - 3 - 3 # one private copy of the last block per forked row
+    for row in range(1, 4):
+        assert cache.row_blocks[row][:2] == cache.row_blocks[0][:2]
+        assert torch.equal(cache.k_cache[:, cache.row_blocks[row][2]], cache.k_cache[:, cache.row_blocks[0][2]])
+    assert cache.cache_seqlens.tolist() == cache.host_seqlens.tolist() == [10, 10, 10, 10]
+    for row in range(4):
+        cache.free_row(row)
+    assert cache.num_free_blocks == 16
+
+
+def test_cascade_attention_matches_plain(monkeypatch):
+    """The samples of a prompt attend to its shared blocks together: same outputs, the prompt KV stored once."""
+    import nanochat.flash_attention as fa_module
+    model = make_tiny_gpt()
+    prompt = [261] + list(range(65, 85))
+    kwargs = dict(num_samples=4, max_tokens=12, temperature=0.8)
+    expected = Engine(model, ByteTokenizer()).generate_batch(prompt, **kwargs)
+    num_cascades = []
+    cascade_kvcache = fa_module._cascade_kvcache
+    monkeypatch.setattr(fa_module, "_cascade_kvcache", lambda *args: (num_cascades.append(1), cascade_kvcache(*args))[1])
+    engine = Engine(model, ByteTokenizer(), cascade=True, block_size=4)
+    assert engine.generate_batch(prompt, **kwargs) == expected
+    assert len(num_cascades) > 0
+    scheduler = engine._generate_scheduler(4, len(prompt), 12, 4)
+    assert scheduler.kv_cache.num_blocks == 6 + 4 * 4 # the prompt once, then room for every sample's own tokens
+    assert Engine(model, ByteTokenizer(), cascade=True, block_size=4).generate_many([prompt, prompt[:9]], **kwargs)[0][0] == expected[0]
+
+
+def test_paged_scheduler_matches_dense():
+    """The paged KV cache (with a pool small enough to force preemption) must not change any output."""
+    model = make_tiny_gpt()
+    engine = Engine(model, ByteTokenizer())
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 87, 111], [261, 65, 66, 67, 68, 69, 70, 71, 72]]
+
+    def run(**kwargs):
+        scheduler = engine.scheduler(max_batch_size=4, max_seq_len=32, **kwargs)
+        requests = [scheduler.add_request(p, num_samples=2, max_tokens=12, temperature=0.0) for p in prompts]
+        while scheduler.has_work():
+            scheduler.step()
+        return [[state.current_tokens for state in r.rows] for r in requests], scheduler
+
+    dense, _ = run()
+    paged, scheduler = run(paged=True, num_blocks=64, block_size=4)
+    assert paged == dense
+    assert scheduler.kv_cache.num_free_blocks == 64
+    tiny, scheduler = run(paged=True, num_blocks=12, block_size=4) # not enough blocks for all rows at once
+    assert tiny == dense
+    assert scheduler.kv_cache.num_free_blocks == 12
+
+
+
+def test_cancel_drops_requests_at_any_stage():
+    """Cancelling (e.g. after a failed step) empties the scheduler whether a request decodes, prefills or waits."""
+    engine = Engine(make_tiny_gpt(), ByteTokenizer())
+    scheduler = engine.scheduler(max_batch_size=2, max_seq_len=32, paged=True, num_blocks=8, block_size=4, prefill_chunk_size=3)
+    requests = [scheduler.add_request(p, max_tokens=20) for p in ([261, 72, 101], [261, 65, 66, 67, 68], [261, 1, 2, 3, 4, 5])]
+    scheduler.step()
+    scheduler.step()
+    assert scheduler.num_active > 0 and scheduler.prefilling is not None and scheduler.waiting
+    for request in requests:
+        scheduler.cancel(request) # outside inference mode, as from a server's request handler
+    assert not scheduler.has_work() and scheduler.kv_cache.num_free_blocks == 8
+    request = scheduler.add_request([261, 72], max_tokens=4)
+    while scheduler.has_work():
+        scheduler.step()
+    assert request.finished
+
+def test_prefix_cache_match_and_lru_eviction():
+    """Cached prefixes are matched block by block and evicted least recently used first, leaves before parents."""
+    kv = PagedKVCache(batch_size=2, num_heads=1, seq_len=16, head_dim=4, num_layers=1,
+                      device="cpu", dtype=torch.float32, num_blocks=6, block_size=4)
+    cache = PrefixCache(kv)
+    a, b = list(range(10)), list(range(4)) + list(range(20, 28))
+    for row, tokens in enumerate([a, b]):
+        assert kv.reserve(row, len(tokens))
+        cache.insert(tokens, kv.row_blocks[row])
+    assert cache.num_blocks == 4 # [0:4] is shared, the partial last block of a is not cached
+    assert cache.match(b + [7]) == [kv.row_blocks[0][0]] + kv.row_blocks[1][1:]
+    assert cache.match([0, 1, 2]) == []
+    kv.free_row(0)
+    kv.free_row(1)
+    assert kv.num_free_blocks == 2 and kv.num_available_blocks == 6
+    assert cache.evict(1) == 1 # b was matched last, so the tail of a goes first
+    assert cache.match(a) == [0]
+    assert cache.evict(2) == 2 # the tail of b, then its parent once that became a leaf
+    assert cache.match(b) == [0]
+    cache.clear()
+    assert kv.num_free_blocks == 6
+
+
+def test_prefix_cache_skips_cached_prefill():
+    """With a prefix cache, a prompt that extends an earlier one only prefills its new tokens, with the same outputs."""
+    model = make_tiny_gpt()
+    plain = Engine(model, ByteTokenizer())
+    engine = Engine(model, ByteTokenizer(), prefix_cache_tokens=64, block_size=4)
+    forwarded = []
+    forward = model.forward
+    def counting_forward(idx, *args, **kwargs):
+        forwarded.append(idx.size(1))
+        return forward(idx, *args, **kwargs)
+    model.forward = counting_forward
+    first = [261] + list(range(65, 75))
+    second = first + [32, 100, 101]
+    for prompt in [first, second]:
+        expected, _ = plain.generate_batch(prompt, num_samples=2, max_tokens=6, temperature=0.0)
+        forwarded.clear()
+        results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=6, temperature=0.0)
+        assert results == expected
+    assert forwarded[0] == len(second) - 8 # the first two blocks of the prompt came from the cache
+
+
+class FixedDistributionModel(MockModel):
+    """Mock model whose next token distribution is the same everywhere, given as {token: logit} (the rest is never sampled)."""
+    def __init__(self, logits):
+        super().__init__()
+        self.logits = torch.full((self.vocab_size,), -float("inf"))
+        for token, logit in logits.items():
+            self.logits[token] = logit
+
+    def forward(self, ids, kv_cache=None, logit_positions=None):
+        B, T = ids.shape
+        if kv_cache is not None:
+            kv_cache.advance(T)
+        return self.keep(self.logits.expand(B, T, -1).clone(), logit_positions)
+
+
+class TransitionModel(MockModel):
+    """Mock model that deterministically predicts next_token[current token] (and token 0 for anything else)."""
+    def __init__(self, next_token):
+        super().__init__()
+        self.table = torch.zeros(self.vocab_size, dtype=torch.long)
+        for a, b in next_token.items():
+            self.table[a] = b
+
+    def forward(self, ids, kv_cache=None, logit_positions=None):
+        B, T = ids.shape
+        if kv_cache is not None:
+            kv_cache.advance(T)
+        return self.keep(torch.nn.functional.one_hot(self.table[ids], self.vocab_size).float() * 10.0, logit_positions)
+
+
+def test_speculative_greedy_matches_plain():
+    """With temperature 0, speculative decoding returns exactly the plain greedy tokens, whatever the draft model."""
+    model = make_tiny_gpt()
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)
+    for draft in [model, make_tiny_gpt(seed=1)]:
+        engine = Engine(model, ByteTokenizer(), draft_model=draft, num_draft_tokens=3)
+        results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)
+        assert results == expected
+    scheduler = Engine(model, ByteTokenizer(), draft_model=model, num_draft_tokens=3).scheduler(paged=True, num_blocks=16, block_size=4)
+    request = scheduler.add_request(prompt, max_tokens=20, temperature=0.0)
+    num_steps = 0
+    while scheduler.has_work():
+        scheduler.step()
+        num_steps += 1
+    assert request.rows[0].current_tokens == expected[0]
+    # prefill + 5 verify steps of up to 4 tokens each, every draft kept (the last step stops early at max_tokens)
+    assert num_steps == 6 and (scheduler.num_drafted, scheduler.num_accepted) == (15, 14)
+
+
+def test_self_speculative_early_exit():
+    """Drafts from the first blocks of the model itself, on its own KV cache, keep the plain greedy tokens."""
+    model = make_tiny_gpt(n_layer=4) # windows (32, 0) x 3 and (64, 0): ring buffers from 32 tokens on
+    prompt = [261] + list(range(65, 90))
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, num_samples=2, max_tokens=30, temperature=0.0)
+    for draft_layers in [1, 3]:
+        for scheduler_kwargs in [{}, dict(paged=True, num_blocks=64, block_size=4)]:
+            scheduler = Engine(model, ByteTokenizer(), draft_layers=draft_layers, num_draft_tokens=3).scheduler(**scheduler_kwargs)
+            assert not hasattr(scheduler, "draft_kv_cache")
+            request = scheduler.add_request(prompt, num_samples=2, max_tokens=30, temperature=0.0)
+            while scheduler.has_work():
+                scheduler.step()
+            assert [state.current_tokens for state in request.rows] == expected
+            assert scheduler.num_accepted > 0
+    # an early exit with the cache gives the logits of the same early exit over the whole sequence
+    ids = torch.tensor([prompt])
+    m = model.config
+    kv_cache = KVCache(batch_size=1, num_heads=m.n_kv_head, seq_len=64, head_dim=m.n_embd // m.n_head, num_layers=m.n_layer,
+                       device="cpu", dtype=torch.float32)
+    model.forward(ids[:, :20], kv_cache=kv_cache)
+    early = torch.cat([model.forward(ids[:, t:t + 1], kv_cache=kv_cache, num_layers=2) for t in range(20, 26)], dim=1)
+    assert kv_cache.get_pos() == 26
+    torch.testing.assert_close(early, model.forward(ids, num_layers=2)[:, 20:], atol=1e-4, rtol=0)
+
+
+def test_speculative_sampling_keeps_the_model_distribution():
+    """Rejection sampling must turn the draft's proposals into samples from the model's distribution."""
+    p = torch.tensor([0.5, 0.3, 0.15, 0.05])
+    model = FixedDistributionModel({65 + i: logit for i, logit in enumerate(p.log().tolist())})
+    draft = FixedDistributionModel({65 + i: 0.0 for i in range(4)}) # uniform over the same 4 tokens
+    engine = Engine(model, ByteTokenizer(), draft_model=draft, num_draft_tokens=4)
+    results, _ = engine.generate_batch([261], num_samples=64, max_tokens=25, temperature=1.0)
+    tokens = torch.tensor([t for r in results for t in r[1:]])
+    freq = torch.bincount(tokens - 65, minlength=4).float() / len(tokens)
+    assert len(tokens) == 64 * 25
+    assert torch.allclose(freq, p, atol=0.03)
+
+
+def test_speculative_tool_use_forced_tokens():
+    """The calculator still runs and forces its output tokens while speculating, with the same tokens and masks."""
+    tokenizer = ByteTokenizer()
+    ps, pe, os_, oe, ae = 256, 257, 258, 259, 260
+    d2, plus, d3, d5, bang = (ord(c) for c in "2+35!")
+    model = TransitionModel({261: ps, ps: d2, d2: plus, plus: d3, d3: pe, pe: 0, oe: bang, bang: ae})
+    draft = TransitionModel({261: ps, ps: d2, d2: plus, plus: d5, d3: pe, pe: os_, os_: d5, d5: oe, oe: bang, bang: ae})
+    expected = Engine(model, tokenizer).generate_batch([261], max_tokens=20, temperature=0.0)
+    assert expected[0][0] == [261, ps, d2, plus, d3, pe, os_, d5, oe, bang]
+    for k in [1, 2, 4]:
+        assert Engine(model, tokenizer, draft_model=draft, num_draft_tokens=k).generate_batch([261], max_tokens=20, temperature=0.0) == expected
+
+
+def test_tool_state_machine_runs_on_host_only_when_needed():
+    """Plain decode picks forced tokens and spots tool tokens on the device, the host tool logic only sees those rows."""
+    tokenizer = ByteTokenizer()
+    ps, pe, os_, oe, ae = 256, 257, 258, 259, 260
+    d2, plus, d3, d5, bang, a = (ord(c) for c in "2+35!A")
+    model = TransitionModel({261: ps, ps: d2, d2: plus, plus: d3, d3: pe, pe: 0, oe: bang, bang: ae, 72: a, a: a})
+    scheduler = Engine(model, tokenizer).scheduler(max_batch_size=2, max_seq_len=64)
+    tool_calls = []
+    run_tool = scheduler._run_tool
+    scheduler._run_tool = lambda state, token: (tool_calls.append(token), run_tool(state, token))
+    device_calls = []
+    device = scheduler._device
+    scheduler._device = lambda fn, *args, **kwargs: (device_calls.append(fn), device(fn, *args, **kwargs))[1]
+    tool = scheduler.add_request([261], max_tokens=20, temperature=0.0)
+    plain = scheduler.add_request([72], max_tokens=20, temperature=0.0)
+    while scheduler.has_work():
+        scheduler.step()
+    assert tool.rows[0].current_tokens == [261, ps, d2, plus, d3, pe, os_, d5, oe, bang, ae]
+    assert plain.rows[0].current_tokens == [72] + [a] * 20
+    assert tool_calls == [ps, d2, plus, d3, pe, os_, d5, oe] # the python block and the forced result, nothing else
+    # the timings themselves depend on the machine: only that every step went through the timed device calls
+    assert scheduler.num_steps == 20 and len(device_calls) >= 2 * scheduler.num_steps # a forward and a copy per step
+    assert scheduler.device_time >= 0 and scheduler.host_time >= 0
+
+
+@pytest.mark.parametrize("cache_kwargs", [{}, dict(paged=True, block_size=16), dict(quantize_kv=True)])
+def test_decode_step_reads_only_the_sampled_tokens(monkeypatch, cache_kwargs):
+    """A plain decode step blocks on the device once: positions and sort widths come from their host copies."""
+    model = make_tiny_gpt()
+    scheduler = Engine(model, ByteTokenizer()).scheduler(max_batch_size=3, max_seq_len=64, **cache_kwargs)
+    scheduler.add_request([261, 72, 101], num_samples=2, max_tokens=30, temperature=0.7, top_k=50, top_p=0.9)
+    scheduler.add_request([261, 72], max_tokens=30, temperature=0.0)
+    scheduler.step() # prefill
+    scheduler.step()
+    host = scheduler.kv_cache.host_seqlens.untyped_storage().data_ptr()
+    reads = []
+    for name in ["item", "tolist", "__bool__", "__int__", "__float__", "__index__", "cpu", "numpy"]:
+        def counted(self, *args, _read=getattr(torch.Tensor, name), _name=name, **kwargs):
+            if self.untyped_storage().data_ptr() != host:
+                reads.append(_name)
+            return _read(self, *args, **kwargs)
+        monkeypatch.setattr(torch.Tensor, name, counted)
+    scheduler.step()
+    monkeypatch.undo()
+    assert scheduler.num_active == 3 and scheduler.kv_cache.get_pos() == 5
+    assert scheduler.kv_cache.host_seqlens.tolist() == scheduler.kv_cache.cache_seqlens.tolist()
+    assert reads == ["tolist"] # the sampled tokens and their flags, in _emit_batch
+
+
+def test_tool_executor_parks_row_until_result():
+    """With a ToolExecutor a row waiting on its tool call is parked, the other rows keep decoding meanwhile."""
+    tokenizer = ByteTokenizer()
+    ps, pe, os_, oe, ae = 256, 257, 258, 259, 260
+    d2, plus, d3, d5, bang, a = (ord(c) for c in "2+35!A")
+    model = TransitionModel({261: ps, ps: d2, d2: plus, plus: d3, d3: pe, pe: 0, oe: bang, bang: ae, 72: a, a: a})
+    release = threading.Event()
+    def slow_calculator(expr):
+        release.wait()
+        return calculator_tool(expr)
+    executor = ToolExecutor(slow_calculator)
+    scheduler = Engine(model, tokenizer, tool_executor=executor).scheduler(max_batch_size=2, max_seq_len=64)
+    tool = scheduler.add_request([261], max_tokens=20, temperature=0.0)
+    plain = scheduler.add_request([72], max_tokens=20, temperature=0.0)
+    for _ in range(10):
+        scheduler.step()
+    assert tool.rows[0].current_tokens == [261, ps, d2, plus, d3, pe] # parked since step 5
+    assert plain.rows[0].current_tokens == [72] + [a] * 10
+    assert scheduler.num_parked == 1 and scheduler.kv_cache.cache_seqlens[0].item() == scheduler.kv_cache.get_pos() == 5
+    release.set()
+    while scheduler.has_work():
+        scheduler.step()
+    assert tool.rows[0].current_tokens == [261, ps, d2, plus, d3, pe, os_, d5, oe, bang, ae]
+    assert plain.rows[0].current_tokens == [72] + [a] * 20
+    assert scheduler.num_parked == 0
+    executor.shutdown()
+    # a backend that fails (or times out) forces nothing, like a calculator error
+    executor = ToolExecutor(lambda expr: time.sleep(1), timeout=0.05)
+    results, _ = Engine(model, tokenizer, tool_executor=executor).generate_batch([261], max_tokens=8, temperature=0.0)
+    assert results[0] == [261, ps, d2, plus, d3, pe, 0, 0, 0]
+    executor.shutdown()
+
+
+def test_python_tool_runs_in_sandbox():
+    assert python_tool("print(6 * 7)") == "42"
+    assert python_tool("raise ValueError()") is None
+
+
+def test_use_calculator_whitelist():
+    """The calculator does arithmetic and str.count, and gives None for anything else, from any thread."""
+    from nanochat.engine import use_calculator
+    assert use_calculator("12/60") == 0.2 and use_calculator("1,000 * (3 + 4)") == 7000 and use_calculator("-7//2") == -4
+    assert use_calculator("'strawberry'.count('r')") == 3
+    for expr in ["2**10", "1/0", "x + 1", "().__class__", "'ab' * 3", "'a'.upper()", "print(1)", "9" * 400 + "*9", "1 +"]:
+        assert use_calculator(expr) is None, expr
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(use_calculator, ["6*7", "'banana'.count('a')"])) == [42, 3]
+
+
+def test_token_probs_per_row_settings():
+    """Rows with different sampling settings are processed together exactly as each would be on its own."""
+    logits = torch.randn(5, 40, generator=torch.Generator().manual_seed(0))
+    counts = torch.zeros(5, 40)
+    counts[:, :3] = torch.tensor([2.0, 1.0, 0.0])
+    settings = [
+        dict(temperature=0.0),
+        dict(temperature=0.7, top_k=5),
+        dict(temperature=1.0, top_p=0.6),
+        dict(temperature=1.3, min_p=0.2, top_k=20),
+        dict(temperature=1.0, repetition_penalty=1.5, frequency_penalty=0.5),
+    ]
+    defaults = dict(top_k=0, top_p=1.0, min_p=0.0, repetition_penalty=1.0, frequency_penalty=0.0)
+    batched = token_probs(logits, counts=counts, **{
+        name: torch.tensor([float(row.get(name, default)) for row in settings])
+        for name, default in dict(temperature=1.0, **defaults).items()
+    })
+    # with the per-row sort widths, the top_p row is sorted apart from the others: same result
+    num_candidates = [_num_candidates(row.get("top_k", 0), row.get("top_p", 1.0), 40) for row in settings]
+    torch.testing.assert_close(token_probs(logits, counts=counts, num_candidates=num_candidates, **{
+        name: torch.tensor([float(row.get(name, default)) for row in settings])
+        for name, default in dict(temperature=1.0, **defaults).items()
+    }), batched)
+    for i, row in enumerate(settings):
+        alone = token_probs(logits[i:i + 1], counts=counts[i:i + 1], **row)
+        torch.testing.assert_close(batched[i:i + 1], alone)
+    assert batched[0].max() == 1 and batched[0].argmax() == logits[0].argmax() # greedy
+    assert (batched[1] > 0).sum() == 5
+    kept = batched[2] > 0 # the smallest set of most likely tokens holding 60% of the mass
+    full = logits[2].softmax(-1)
+    assert full[kept].sum() >= 0.6 and full[kept].sum() - full[kept].min() < 0.6
+    assert (batched[3][batched[3] > 0] >= 0.2 * batched[3].max()).all()
+    penalized = logits[4].clone()
+    penalized[:2] = torch.where(penalized[:2] > 0, penalized[:2] / 1.5, penalized[:2] * 1.5) - 0.5 * counts[4, :2]
+    torch.testing.assert_close(batched[4], penalized.softmax(-1))
+    # inverse CDF sampling only ever picks tokens with some probability
+    samples = sample_from_probs(batched[1].expand(1000, -1), torch.rand(1000, generator=torch.Generator().manual_seed(1)))
+    assert set(samples.tolist()) == set(batched[1].nonzero()[:, 0].tolist())
+
+
+def test_scheduler_mixed_sampling_settings():
+    """Requests with different sampling settings share the decode batch, each sampled with its own."""
+    model = FixedDistributionModel({65: 1.0, 66: 0.0})
+    scheduler = Engine(model, ByteTokenizer()).scheduler(max_batch_size=4, max_seq_len=64)
+    prompt = [261, 72, 101, 108, 108, 111]
+    plain = scheduler.add_request(prompt, max_tokens=6, temperature=0.0)
+    penalized = scheduler.add_request(prompt, max_tokens=6, temperature=0.0, frequency_penalty=2.0)
+    top_k = scheduler.add_request(prompt, num_samples=2, max_tokens=6, temperature=1.0, top_k=1)
+    while scheduler.has_work():
+        scheduler.step()
+    assert plain.rows[0].current_tokens[len(prompt):] == [65] * 6
+    assert penalized.rows[0].current_tokens[len(prompt):] == [65, 66] * 3 # every 'A' costs 2, every 'B' too
+    assert all(state.current_tokens[len(prompt):] == [65] * 6 for state in top_k.rows)
+    assert scheduler.num_using["frequency_penalty"] == 0 and scheduler.num_using["top_k"] == 0
+
+
+def test_samples_do_not_depend_on_batch_layout():
+    """A request's samples depend only on its seed: not on its rows, its neighbours, compaction or how it is split."""
+    model = MockModel()
+    prompt = [261, 72, 101, 108, 108, 111]
+
+    def run(requests, max_batch_size):
+        scheduler = Engine(model, ByteTokenizer()).scheduler(max_batch_size=max_batch_size, max_seq_len=64)
+        added = [scheduler.add_request(prompt, max_tokens=max_tokens, seed=seed, num_samples=num_samples, first_sample=first)
+                 for num_samples, max_tokens, seed, first in requests]
+        while scheduler.has_work():
+            scheduler.step()
+        return [state.current_tokens for request in added for state in request.rows]
+
+    alone = run([(4, 12, 7, 0)], max_batch_size=4)
+    assert len({tuple(tokens) for tokens in alone}) == 4
+    # behind other requests (other rows), next to rows that finish early (compaction), in a bigger batch
+    crowded = run([(3, 2, 1, 0), (1, 20, 2, 0), (4, 12, 7, 0)], max_batch_size=8)
+    assert crowded[4:] == alone
+    # split in two requests of two samples
+    assert run([(2, 12, 7, 2), (2, 12, 7, 0)], max_batch_size=2) == alone[2:] + alone[:2]
+    u = counter_uniforms(torch.tensor(3), torch.arange(100_000))
+    assert 0 <= u.min() and u.max() < 1 and abs(u.mean() - 0.5) < 0.01
+    assert (torch.histc(u, bins=10, min=0, max=1) - 10_000).abs().max() < 500
+
+
+def test_ngram_index_proposes_latest_continuation():
+    index = NgramIndex(max_ngram=2)
+    tokens = [1, 2, 3, 4, 2, 3, 5, 9, 2, 3]
+    assert index.propose(tokens, 3) == [5, 9, 2] # [2, 3] last occurred before 5
+    assert index.propose(tokens + [7], 3) == [] # 7 was never seen
+    assert index.propose(tokens + [7, 4], 3) == [2, 3, 5] # falls back to the 1-gram [4]
+
+
+def test_prompt_lookup_speculation():
+    """Prompt lookup drafting keeps greedy outputs unchanged, and copies of earlier spans are accepted wholesale."""
+    model = TransitionModel({65: 66, 66: 67, 67: 68, 68: 65}) # cycles through ABCD
+    prompt = [261, 65, 66, 67, 68, 65]
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, num_samples=2, max_tokens=30, temperature=0.0)
+    engine = Engine(model, ByteTokenizer(), prompt_lookup=True, num_draft_tokens=4)
+    results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=30, temperature=0.0)
+    assert results == expected
+    assert engine.acceptance_rate > 0.9
+    engine.reset_stats() # per call (e.g. per RL step) stats
+    assert engine.num_drafted == engine.num_steps == 0 and engine.step_stats() == (0.0, 0.0)
+    engine.generate_batch(prompt, max_tokens=5, temperature=0.0)
+    assert 0 < engine.num_steps <= 5
+    tiny = make_tiny_gpt()
+    expected, _ = Engine(tiny, ByteTokenizer()).generate_batch(prompt, max_tokens=20, temperature=0.0)
+    results, _ = Engine(tiny, ByteTokenizer(), prompt_lookup=True).generate_batch(prompt, max_tokens=20, temperature=0.0)
+    assert results == expected
+
+
+def test_chunked_prefill_interleaves_with_decode():
+    """A long prompt is prefilled a chunk per step while the running rows keep decoding, with unchanged outputs."""
+    model = make_tiny_gpt()
+    engine = Engine(model, ByteTokenizer())
+    short, long = [261, 72, 105], [261] + list(range(65, 95))
+
+    def run(**kwargs):
+        scheduler = engine.scheduler(max_batch_size=4, max_seq_len=48, **kwargs)
+        first = scheduler.add_request(short, max_tokens=12, temperature=0.0)
+        scheduler.step()
+        second = scheduler.add_request(long, num_samples=2, max_tokens=6, temperature=0.0)
+        emitted = []
+        while scheduler.has_work():
+            emitted.append(sum(1 for state, _, _ in scheduler.step() if state.request is first))
+        return [s.current_tokens for r in (first, second) for s in r.rows], emitted
+
+    expected, _ = run()
+    for kwargs in [dict(), dict(paged=True, num_blocks=32, block_size=4, prefix_cache=True)]:
+        forwarded = []
+        forward = model.forward
+        model.forward = lambda idx, *args, **kw: forwarded.append(idx.size(1)) or forward(idx, *args, **kw)
+        results, emitted = run(prefill_chunk_size=8, **kwargs)
+        del model.forward
+        assert results == expected
+        assert max(forwarded) == 8
+        assert emitted[:11] == [1] * 11 # the first request streams a token every step while the second prefills
+
+
+def test_gpt_forward_logit_positions():
+    """Keeping only some positions gives the same logits as slicing the full output."""
+    model = make_tiny_gpt()
+    idx = torch.randint(0, 256, (3, 10))
+    full = model.forward(idx)
+    assert torch.allclose(model.forward(idx, logit_positions=2), full[:, -2:], atol=1e-5)
+    positions = torch.tensor([[0, 9], [4, 4], [7, 1]])
+    expected = torch.stack([full[b, positions[b]] for b in range(3)])
+    assert torch.allclose(model.forward(idx, logit_positions=positions), expected, atol=1e-5)
+
+
+def test_int8_kv_cache_accuracy():
+    """The int8 KV cache is much smaller than fp32 and barely moves the logits (teacher forced through the cache)."""
+    model = make_tiny_gpt()
+    m = model.config
+    ids = torch.randint(0, 256, (4, 48), generator=torch.Generator().manual_seed(0))
+
+    def run(quantize):
+        kv_cache = KVCache(batch_size=4, num_heads=m.n_kv_head, seq_len=64, head_dim=m.n_embd // m.n_head,
+                           num_layers=m.n_layer, device="cpu", dtype=torch.float32, quantize=quantize)
+        logits = [model.forward(ids[:, :16], kv_cache=kv_cache)] # prefill, then decode one token at a time
+        logits += [model.forward(ids[:, t:t + 1], kv_cache=kv_cache) for t in range(16, 48)]
+        num_bytes = sum(t.numel() * t.element_size() for t in (kv_cache.k_cache, kv_cache.v_cache, kv_cache.k_scale, kv_cache.v_scale) if t is not None)
+        return torch.cat(logits, dim=1), num_bytes
+
+    (full, full_bytes), (int8, int8_bytes) = run(False), run(True)
+    assert full_bytes / int8_bytes > 3 # 64 / (16 + 4) bytes per token and head at head_dim=16, approaches 4 for larger heads
+    logp_full, logp_int8 = full.log_softmax(-1), int8.log_softmax(-1)
+    kl = (logp_full.exp() * (logp_full - logp_int8)).sum(-1).mean()
+    assert kl < 1e-4 # measured ~1e-6
+    assert (full.argmax(-1) == int8.argmax(-1)).float().mean() > 0.98 # measured ~0.995
+    prompt = [261] + list(range(65, 100)) # greedy can flip on a near tie, this prompt has none
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, max_tokens=20, temperature=0.0)
+    results, _ = Engine(model, ByteTokenizer(), quantize_kv=True).generate_batch(prompt, max_tokens=20, temperature=0.0)
+    assert results == expected
+
+
+def test_ring_kv_cache_matches_full_cache():
+    """Sliding-window layers keep only their window in a ring buffer, without changing any logit."""
+    model = make_tiny_gpt() # windows (32, 0) and (64, 0)
+    m = model.config
+    ids = torch.randint(0, 256, (2, 100), generator=torch.Generator().manual_seed(0))
+    kv_kwargs = dict(batch_size=2, num_heads=m.n_kv_head, seq_len=128, head_dim=m.n_embd // m.n_head,
+                     num_layers=m.n_layer, device="cpu", dtype=torch.float32)
+    kv_cache = KVCache(**kv_kwargs, window_sizes=model.window_sizes)
+    assert kv_cache.ring_size == 64 and kv_cache.k_cache.size(0) == 0 # both windows are shorter than the cache
+    full_bytes = KVCache(**kv_kwargs).k_cache.numel()
+    assert kv_cache.k_ring.numel() == full_bytes // 2
+    # ragged rows: prefill 30 and 45 tokens (in chunks longer than the smaller window), then decode together
+    logits = [model.forward(ids[0:1, :30], kv_cache=kv_cache.rows(0, 1))]
+    logits += [model.forward(ids[1:2, t:t + 15], kv_cache=kv_cache.rows(1, 2)) for t in range(0, 45, 15)]
+    decoded = [model.forward(torch.stack([ids[0, 30 + t], ids[1, 45 + t]]).unsqueeze(1), kv_cache=kv_cache) for t in range(50)]
+    decoded = torch.cat(decoded, dim=1)
+    expected = model.forward(ids)
+    torch.testing.assert_close(logits[0], expected[0:1, :30], atol=1e-4, rtol=0)
+    torch.testing.assert_close(torch.cat(logits[1:], dim=1), expected[1:2, :45], atol=1e-4, rtol=0)
+    torch.testing.assert_close(decoded[0], expected[0, 30:80], atol=1e-4, rtol=0)
+    torch.testing.assert_close(decoded[1], expected[1, 45:95], atol=1e-4, rtol=0)
+    # speculative decoding rolls back rejected drafts, the rings keep room for them
+    prompt = [261] + list(range(65, 100))
+    expected, _ = Engine(model, ByteTokenizer()).generate_batch(prompt, max_tokens=40, temperature=0.0)
+    results, _ = Engine(model, ByteTokenizer(), draft_model=make_tiny_gpt(seed=1), num_draft_tokens=3).generate_batch(prompt, max_tokens=40, temperature=0.0)
+    assert results == expected
+
+
+def test_kv_cache_attention_sinks_evict_the_middle():
+    """make_room keeps the sinks and moves the latest positions down, their keys rotated as if computed there."""
+    from nanochat.gpt import apply_rotary_emb
+    model = make_tiny_gpt()
+    D = 16
+    def rotated(k, positions): # k (layers, T, H, D) with the rotary embeddings of positions
+        angle = positions.float()[:, None] * model._rotary_inv_freq(D)
+        return apply_rotary_emb(k, angle.cos()[:, None], angle.sin()[:, None])
+    kv_cache = KVCache(batch_size=2, num_heads=2, seq_len=20, head_dim=D, num_layers=2, device="cpu", dtype=torch.float32,
+                       attention_sinks=4, shift_keys=model.shift_rotary)
+    k, v = torch.randn(2, 20, 2, D), torch.randn(2, 20, 2, D)
+    kv_cache.k_cache[:, 1] = rotated(k, torch.arange(20))
+    kv_cache.v_cache[:, 1] = v
+    kv_cache.set_pos(0, [3, 20])
+    kv_cache.make_room(0, 1)
+    kv_cache.make_room(1, 1) # full: a quarter of the 16 window positions go, the oldest after the sinks
+    assert kv_cache.host_seqlens.tolist() == [3, 16] and kv_cache.cache_seqlens.tolist() == [3, 16]
+    torch.testing.assert_close(kv_cache.k_cache[:, 1, :4], rotated(k[:, :4], torch.arange(4)))
+    torch.testing.assert_close(kv_cache.k_cache[:, 1, 4:16], rotated(k[:, 8:], torch.arange(4, 16)), atol=1e-5, rtol=0)
+    torch.testing.assert_close(kv_cache.v_cache[:, 1, :16], torch.cat([v[:, :4], v[:, 8:]], dim=1))
+    kv_cache.make_room(1, 4) # fits
+    assert kv_cache.host_seqlens.tolist() == [3, 16]
+
+
+def test_attention_sinks_generate_past_the_cache():
+    """With attention sinks a conversation outgrows sequence_len: the cache stays bounded and evicts the middle."""
+    model = make_tiny_gpt() # sequence_len 64
+    kwargs = dict(num_samples=2, temperature=1.0, seed=5)
+    prompt = [261] + list(range(65, 85))
+    # nothing to evict: the same samples as the ring buffered cache
+    engine = Engine(model, ByteTokenizer(), attention_sinks=4)
+    assert engine.generate_batch(prompt, max_tokens=30, **kwargs) == Engine(model, ByteTokenizer()).generate_batch(prompt, max_tokens=30, **kwargs)
+    forwards = []
+    forward = model.forward
+    def recording_forward(ids, kv_cache=None, **fwd_kwargs):
+        forwards.append((ids.size(1), kv_cache.host_seqlens.max().item()))
+        return forward(ids, kv_cache=kv_cache, **fwd_kwargs)
+    model.forward = recording_forward
+    long_prompt = [261] + [65 + i % 26 for i in range(150)] # over twice the cache
+    results, masks = engine.generate_batch(long_prompt, max_tokens=100, **kwargs)
+    assert all(T + pos <= 64 for T, pos in forwards) # never past the cache, nor the rotary embeddings of its positions
+    assert [T for T, _ in forwards[:6]] == [30] * 5 + [1] # 151 prompt tokens in chunks of half the window, evicting along the way
+    assert max(len(r) - len(long_prompt) for r in results) > 64 # and rows keep decoding past a full cache
+    assert all(m[:len(long_prompt)] == [0] * len(long_prompt) for m in masks)